@@ -0,0 +1,103 @@
+# proxy/bench_fork.py
+"""
+/v1/fork（共通 prefix を1回だけ prefill）と、同じ K 枝を独立した
+/v1/chat/completions として並列に投げた場合の wall-clock を比較する。
+
+例:
+  python proxy/bench_fork.py --proxy http://127.0.0.1:18080 --k 3 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import Any, Dict, List
+
+from aiohttp import ClientSession
+
+
+PREFIX = [
+    {
+        "role": "system",
+        "content": "あなたは「トイレ利用後のアンケート」を行う日本語システムです。出力は必ず日本語のみ。",
+    },
+    {"role": "user", "content": "トイレの清潔さについて、最初の質問を3択で作ってください。"},
+    {"role": "assistant", "content": "トイレの清潔さはいかがでしたか？ 1:満足した 2:普通だった 3:気になった"},
+]
+
+
+def suffix_for(answer: int) -> str:
+    return f"ユーザーは {answer} を選びました。同じテーマで一段具体的な深掘り質問を3択で作ってください。"
+
+
+async def _read_sse(resp) -> List[Dict[str, Any]]:
+    events = []
+    buf = b""
+    async for chunk in resp.content.iter_chunked(4096):
+        buf += chunk
+        while b"\n" in buf:
+            line, buf = buf.split(b"\n", 1)
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[len(b"data:"):].strip()
+            if payload == b"[DONE]":
+                continue
+            try:
+                events.append(json.loads(payload))
+            except Exception:
+                pass
+    return events
+
+
+async def run_fork(session: ClientSession, proxy: str, k: int, params: Dict[str, Any]) -> Dict[str, Any]:
+    body = dict(params, messages=PREFIX, suffixes=[suffix_for(i + 1) for i in range(k)], stream=True)
+    t0 = time.perf_counter()
+    async with session.post(f"{proxy}/v1/fork", json=body) as resp:
+        events = await _read_sse(resp)
+    wall = (time.perf_counter() - t0) * 1000.0
+    summary = next((e for e in events if e.get("object") == "fork.summary"), {})
+    return {"wall_ms": wall, "summary": summary}
+
+
+async def run_independent(session: ClientSession, proxy: str, k: int, params: Dict[str, Any]) -> Dict[str, Any]:
+    async def one(i: int):
+        body = dict(params, messages=PREFIX + [{"role": "user", "content": suffix_for(i + 1)}], stream=True)
+        async with session.post(f"{proxy}/v1/chat/completions", json=body) as resp:
+            await _read_sse(resp)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(k)])
+    return {"wall_ms": (time.perf_counter() - t0) * 1000.0}
+
+
+async def main_async(args):
+    params = {"temperature": 0.5, "max_tokens": args.max_tokens, "top_p": 0.9, "top_k": 40}
+    fork_ms: List[float] = []
+    indep_ms: List[float] = []
+    async with ClientSession() as session:
+        for _ in range(args.repeat):
+            # 順番の影響（直前の prompt cache）を減らすため交互に測る
+            r = await run_fork(session, args.proxy, args.k, params)
+            fork_ms.append(r["wall_ms"])
+            print(f"[fork]        {r['wall_ms']:8.1f} ms  {json.dumps(r['summary'], ensure_ascii=False)}", flush=True)
+            r = await run_independent(session, args.proxy, args.k, params)
+            indep_ms.append(r["wall_ms"])
+            print(f"[independent] {r['wall_ms']:8.1f} ms", flush=True)
+
+    f = statistics.median(fork_ms)
+    i = statistics.median(indep_ms)
+    print(f"\nk={args.k} median: fork={f:.1f}ms independent={i:.1f}ms speedup={i / f if f else 0:.2f}x")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark /v1/fork vs K independent requests")
+    p.add_argument("--proxy", default="http://127.0.0.1:18080")
+    p.add_argument("--k", type=int, default=3)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--max-tokens", type=int, default=64)
+    asyncio.run(main_async(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
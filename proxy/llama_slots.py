@@ -0,0 +1,162 @@
+# proxy/llama_slots.py
+import json
+import time
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+from aiohttp import ClientResponse, ClientSession
+
+
+# -----------------------------
+# llama.cpp server の非OpenAI API（テンプレート適用 / prefill / slot 操作）
+# -----------------------------
+async def llama_props(session: ClientSession, llama_base: str) -> Dict[str, Any]:
+    async with session.get(f"{llama_base}/props") as resp:
+        return await resp.json(content_type=None)
+
+
+async def llama_apply_template(session: ClientSession, llama_base: str, messages: List[Dict[str, Any]]) -> str:
+    """
+    チャットテンプレートを適用した生プロンプト文字列を返す（生成はしない）。
+    """
+    async with session.post(f"{llama_base}/apply-template", json={"messages": messages}) as resp:
+        if resp.status >= 400:
+            raise RuntimeError(f"apply-template failed {resp.status}: {await resp.text()}")
+        obj = await resp.json(content_type=None)
+        return obj.get("prompt") or ""
+
+
+async def llama_prefill(
+    session: ClientSession,
+    llama_base: str,
+    prompt: Any,
+    id_slot: int = -1,
+) -> Dict[str, Any]:
+    """
+    n_predict=0 で prompt だけ評価し、slot の KV キャッシュを温める。
+    prompt は文字列でもトークン配列でもよい。
+    """
+    req = {"prompt": prompt, "n_predict": 0, "cache_prompt": True, "id_slot": id_slot}
+    t0 = time.perf_counter()
+    async with session.post(f"{llama_base}/completion", json=req) as resp:
+        obj = await resp.json(content_type=None)
+        if resp.status >= 400:
+            raise RuntimeError(f"prefill failed {resp.status}: {obj}")
+    obj["wall_ms"] = (time.perf_counter() - t0) * 1000.0
+    return obj
+
+
+async def llama_idle_slots(
+    session: ClientSession,
+    llama_base: str,
+    reserved: Iterable[int] = (),
+) -> Optional[List[int]]:
+    """
+    GET /slots から、処理中でなく reserved にも含まれない slot 番号を返す。
+    llama-server が /slots を出していない（--no-slots）・取れないときは None（どの slot が空いているか分からない）。
+    """
+    try:
+        async with session.get(f"{llama_base}/slots") as resp:
+            if resp.status >= 400:
+                return None
+            slots = await resp.json(content_type=None)
+    except Exception:
+        return None
+    if not isinstance(slots, list):
+        return None
+    skip = set(reserved)
+    idle = []
+    for sl in slots:
+        if not isinstance(sl, dict) or not isinstance(sl.get("id"), int) or sl["id"] in skip:
+            continue
+        # 新しい llama-server は is_processing、古いものは state（0 = idle）
+        busy = sl["is_processing"] if "is_processing" in sl else sl.get("state", 0) != 0
+        if not busy:
+            idle.append(sl["id"])
+    return idle
+
+
+async def llama_slot_action(
+    session: ClientSession,
+    llama_base: str,
+    id_slot: int,
+    action: str,
+    filename: str,
+) -> Dict[str, Any]:
+    """
+    /slots/{id}?action=save|restore。llama-server 側に --slot-save-path が必要。
+    """
+    t0 = time.perf_counter()
+    async with session.post(
+        f"{llama_base}/slots/{id_slot}",
+        params={"action": action},
+        json={"filename": filename},
+    ) as resp:
+        obj = await resp.json(content_type=None)
+        if resp.status >= 400:
+            raise RuntimeError(f"slot {action} failed {resp.status}: {obj}")
+    obj["wall_ms"] = (time.perf_counter() - t0) * 1000.0
+    return obj
+
+
+async def iter_llama_completion_stream(resp: ClientResponse) -> AsyncIterator[Dict[str, Any]]:
+    """
+    /completion (stream=true) の SSE をイベント(dict)単位で返す。
+    """
+    buf = b""
+    async for chunk in resp.content.iter_chunked(4096):
+        buf += chunk
+        while b"\n" in buf:
+            raw_line, buf = buf.split(b"\n", 1)
+            line = raw_line.rstrip(b"\r").decode("utf-8", errors="ignore")
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if not payload or payload == "[DONE]":
+                continue
+            try:
+                obj = json.loads(payload)
+            except Exception:
+                continue
+            if isinstance(obj, dict):
+                yield obj
+
+
+def llama_stop_to_finish_reason(obj: Dict[str, Any]) -> Optional[str]:
+    if not obj.get("stop"):
+        return None
+    if obj.get("stop_type") == "limit" or obj.get("truncated"):
+        return "length"
+    return "stop"
+
+
+def common_prefix(texts: List[str]) -> str:
+    if not texts:
+        return ""
+    lo = min(texts)
+    hi = max(texts)
+    n = 0
+    for a, b in zip(lo, hi):
+        if a != b:
+            break
+        n += 1
+    return lo[:n]
+
+
+def openai_params_to_llama_completion(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    /v1/chat/completions のサンプリング指定 → /completion 形式
+    """
+    out: Dict[str, Any] = {}
+    for k in ("temperature", "top_p", "top_k", "repeat_penalty", "min_p", "seed"):
+        if data.get(k) is not None:
+            out[k] = data[k]
+    if data.get("max_tokens") is not None:
+        out["n_predict"] = int(data["max_tokens"])
+    stop = data.get("stop")
+    if stop:
+        out["stop"] = [stop] if isinstance(stop, str) else list(stop)
+    # 出力制約（GBNF / JSON schema）は /completion でも同名で効く
+    for k in ("grammar", "json_schema"):
+        if data.get(k):
+            out[k] = data[k]
+    return out
@@ -9,16 +9,51 @@ from typing import Any, Dict, List, Optional, Tuple
 import aiohttp
 from aiohttp import web, ClientSession
 
+from llama_slots import (
+    common_prefix,
+    iter_llama_completion_stream,
+    llama_apply_template,
+    llama_idle_slots,
+    llama_prefill,
+    llama_props,
+    llama_slot_action,
+    llama_stop_to_finish_reason,
+    openai_params_to_llama_completion,
+)
+from request_trace import TRACE_HEADER, RequestTrace, SpanFileExporter, start_trace
+from slot_store import SlotSnapshotStore
+from token_stats import (
+    OpenAISSESniffer,
+    StageTokenMetrics,
+    TokenizeCache,
+    count_prompt_tokens_llama,
+    llama_tokenize,
+    print_token_usage,
+    usage_from_gemini,
+    usage_from_llama_response,
+)
+
 
 # -----------------------------
 # Defaults
 # -----------------------------
 PROXY_HOST = "127.0.0.1"
 PROXY_PORT = 18080
+SLOT_STATE_DIR_DEFAULT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "var")
+# X-SLM-Trace 付きリクエストの span（request_trace.py）
+TRACE_PATH_DEFAULT = os.path.join(SLOT_STATE_DIR_DEFAULT, "spans.jsonl")
 
 LLAMA_BASE_DEFAULT = "http://127.0.0.1:8080"  # llama.cpp server base
+# slm_demo が id_slot を固定して使う slot（config.PRESENCE_PREFILL_SLOT）。fork / slot store はここを避ける。
+# PRESENCE_PREFILL は既定で無効なので、既定では何も予約しない（使うときに --reserved-slot で指定する）
+RESERVED_SLOTS_DEFAULT = tuple(int(x) for x in os.getenv("PROXY_RESERVED_SLOTS", "").split(",") if x.strip())
 GEMINI_BASE = "https://generativelanguage.googleapis.com/v1beta"
 GEMINI_MODEL_DEFAULT = "gemini-2.5-flash"
+# これ未満の maxOutputTokens では思考を無効化する
+GEMINI_THINKING_MIN_TOKENS = 1024
+
+# proxy が実際に使った backend をクライアントへ返すヘッダ
+BACKEND_HEADER = "X-SLM-Backend"
 
 
 # -----------------------------
@@ -28,7 +63,8 @@ def print_input_only(data: dict, backend: str):
     print("\n=== LLM INPUT ===", flush=True)
     print(
         f"backend={backend} temp={data.get('temperature')} max_tokens={data.get('max_tokens')} "
-        f"top_p={data.get('top_p')} top_k={data.get('top_k')} stream={data.get('stream')}",
+        f"top_p={data.get('top_p')} top_k={data.get('top_k')} stream={data.get('stream')}"
+        f"{' grammar' if data.get('grammar') else ''}{' json_schema' if data.get('json_schema') else ''}",
         flush=True,
     )
     msgs = data.get("messages") or []
@@ -77,10 +113,11 @@ def openai_messages_to_gemini(messages: List[Dict[str, Any]]) -> Tuple[Optional[
     return system_instruction, contents
 
 
-def openai_params_to_gemini_generation_config(data: Dict[str, Any]) -> Dict[str, Any]:
+def openai_params_to_gemini_generation_config(data: Dict[str, Any], model: str = "") -> Dict[str, Any]:
     """
     OpenAI互換パラメータ → Gemini generationConfig 変換。
     重要: max_tokens が小さすぎると finishReason=MAX_TOKENS で即打ち切られる。
+    （2.5 系は思考トークンも maxOutputTokens に含まれるため、小さい上限では思考を切る）
     """
     cfg: Dict[str, Any] = {}
 
@@ -103,14 +140,19 @@ def openai_params_to_gemini_generation_config(data: Dict[str, Any]) -> Dict[str,
         except Exception:
             max_out = 512
 
-    # あまりに小さい値は実用にならないので底上げ（必要なら下げてOK）
-    if max_out < 64:
-        max_out = 2048
+    # 0 以下は「未指定」とみなす
+    if max_out <= 0:
+        max_out = 512
 
     # 念のため過大値をクリップ（モデル上限はモデルによる）
     if max_out > 8192:
         max_out = 8192
 
+    # 予測で絞った小さい上限（max_tokens_predictor）を思考トークンで食い潰さない
+    # flash 系のみ thinkingBudget=0 が使える
+    if max_out < GEMINI_THINKING_MIN_TOKENS and "flash" in (model or ""):
+        cfg["thinkingConfig"] = {"thinkingBudget": 0}
+
     cfg["maxOutputTokens"] = max_out
 
     # あるなら stop を変換（OpenAIの stop は文字列 or 配列）
@@ -121,14 +163,47 @@ def openai_params_to_gemini_generation_config(data: Dict[str, Any]) -> Dict[str,
         elif isinstance(stop, list):
             cfg["stopSequences"] = [s for s in stop if isinstance(s, str)]
 
+    # 出力制約: JSON schema は responseSchema へ。GBNF (grammar) は Gemini に相当機能が無いので捨てる
+    schema = data.get("json_schema")
+    if isinstance(schema, dict):
+        cfg["responseMimeType"] = "application/json"
+        cfg["responseSchema"] = json_schema_to_gemini_schema(schema)
+    elif data.get("grammar"):
+        print("[gemini] grammar は未対応のため無視します（json_schema なら responseSchema に変換）", flush=True)
+
     return cfg
 
 
+# Gemini の responseSchema が受け付けるキー（OpenAPI 3.0 のサブセット）
+_GEMINI_SCHEMA_KEYS = ("type", "properties", "items", "required", "minItems", "maxItems", "enum", "description", "nullable")
+
+
+def json_schema_to_gemini_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for k in _GEMINI_SCHEMA_KEYS:
+        if k not in schema:
+            continue
+        v = schema[k]
+        if k == "properties" and isinstance(v, dict):
+            v = {name: json_schema_to_gemini_schema(sub) for name, sub in v.items() if isinstance(sub, dict)}
+        elif k == "items" and isinstance(v, dict):
+            v = json_schema_to_gemini_schema(v)
+        elif k == "type" and isinstance(v, str):
+            v = v.upper()
+        out[k] = v
+    return out
+
+
 
 # -----------------------------
 # OpenAI-like SSE helpers
 # -----------------------------
-def make_openai_stream_chunk(model: str, content_delta: str, created: Optional[int] = None) -> bytes:
+def make_openai_stream_chunk(
+    model: str,
+    content_delta: str,
+    created: Optional[int] = None,
+    index: int = 0,
+) -> bytes:
     if created is None:
         created = int(time.time())
     payload = {
@@ -136,23 +211,60 @@ def make_openai_stream_chunk(model: str, content_delta: str, created: Optional[i
         "object": "chat.completion.chunk",
         "created": created,
         "model": model,
-        "choices": [{"index": 0, "delta": {"content": content_delta}, "finish_reason": None}],
+        "choices": [{"index": index, "delta": {"content": content_delta}, "finish_reason": None}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def make_openai_stream_finish_chunk(
+    model: str,
+    finish_reason: str,
+    usage: Optional[Dict[str, Any]] = None,
+    created: Optional[int] = None,
+    index: int = 0,
+) -> bytes:
+    if created is None:
+        created = int(time.time())
+    payload: Dict[str, Any] = {
+        "id": "chatcmpl-proxy",
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": index, "delta": {}, "finish_reason": finish_reason}],
     }
+    if usage:
+        payload["usage"] = usage
     return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
 
 
+def gemini_finish_reason_to_openai(fr: Optional[str]) -> str:
+    if fr == "MAX_TOKENS":
+        return "length"
+    if fr in ("SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"):
+        return "content_filter"
+    return "stop"
+
+
 def make_openai_stream_done() -> bytes:
     return b"data: [DONE]\n\n"
 
 
-def make_openai_nonstream_response(model: str, full_text: str) -> Dict[str, Any]:
-    return {
+def make_openai_nonstream_response(
+    model: str,
+    full_text: str,
+    finish_reason: str = "stop",
+    usage: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    out: Dict[str, Any] = {
         "id": "chatcmpl-proxy",
         "object": "chat.completion",
         "created": int(time.time()),
         "model": model,
-        "choices": [{"index": 0, "message": {"role": "assistant", "content": full_text}, "finish_reason": "stop"}],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": full_text}, "finish_reason": finish_reason}],
     }
+    if usage:
+        out["usage"] = usage
+    return out
 
 
 # -----------------------------
@@ -166,7 +278,7 @@ async def gemini_generate_content(
 ) -> Dict[str, Any]:
     url = f"{GEMINI_BASE}/models/{model}:generateContent"
     system_instruction, contents = openai_messages_to_gemini(data.get("messages", []))
-    gen_cfg = openai_params_to_gemini_generation_config(data)
+    gen_cfg = openai_params_to_gemini_generation_config(data, model)
 
     req: Dict[str, Any] = {"contents": contents}
     if system_instruction is not None:
@@ -194,7 +306,7 @@ async def gemini_stream_generate_content(
     url = f"{GEMINI_BASE}/models/{model}:streamGenerateContent"
 
     system_instruction, contents = openai_messages_to_gemini(data.get("messages", []))
-    gen_cfg = openai_params_to_gemini_generation_config(data)
+    gen_cfg = openai_params_to_gemini_generation_config(data, model)
 
     req: Dict[str, Any] = {
         "contents": contents,
@@ -255,6 +367,8 @@ async def proxy_gemini_stream_as_openai_sse(
     data: Dict[str, Any],
     api_key: str,
     model: str,
+    usage_out: Optional[Dict[str, Any]] = None,
+    trace: Optional[RequestTrace] = None,
 ) -> web.StreamResponse:
     proxy_resp = web.StreamResponse(
         status=200,
@@ -262,16 +376,24 @@ async def proxy_gemini_stream_as_openai_sse(
             "Content-Type": "text/event-stream; charset=utf-8",
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
+            BACKEND_HEADER: "gemini",
         },
     )
     await proxy_resp.prepare(request)
 
     created = int(time.time())
+    usage: Dict[str, Any] = usage_out if usage_out is not None else {}
+    finish_reason: Optional[str] = None
     session: Optional[ClientSession] = None
     resp: Optional[aiohttp.ClientResponse] = None
 
     try:
+        if trace is not None:
+            # Gemini へは id を送れないので proxy 側の区切りだけ残す
+            trace.mark("upstream_send")
         session, resp = await gemini_stream_generate_content(data=data, api_key=api_key, model=model)
+        if trace is not None:
+            trace.mark("upstream_headers")
 
         if resp.status >= 400:
             err_text = await resp.text()
@@ -291,7 +413,7 @@ async def proxy_gemini_stream_as_openai_sse(
         data_lines: List[str] = []
 
         async def _flush_event():
-            nonlocal last_text, data_lines
+            nonlocal last_text, data_lines, finish_reason
 
             if not data_lines:
                 return
@@ -309,6 +431,10 @@ async def proxy_gemini_stream_as_openai_sse(
             except Exception:
                 return
 
+            # usageMetadata は最終イベントほど正確なので上書きしていく
+            if isinstance(ev, dict) and ev.get("usageMetadata"):
+                usage.update(usage_from_gemini(ev))
+
             # まずテキストを抽出して流す（←順番が重要）
             cur_text = _extract_text_from_gemini_event(ev if isinstance(ev, dict) else {})
             if cur_text:
@@ -320,6 +446,8 @@ async def proxy_gemini_stream_as_openai_sse(
                     last_text = (last_text + cur_text) if last_text else cur_text
 
                 if delta:
+                    if trace is not None:
+                        trace.mark("first_chunk")
                     await proxy_resp.write(
                         make_openai_stream_chunk(
                             model=model,
@@ -333,6 +461,8 @@ async def proxy_gemini_stream_as_openai_sse(
             cands = ev.get("candidates") if isinstance(ev, dict) else None
             if isinstance(cands, list) and cands:
                 fr = (cands[0] or {}).get("finishReason")
+                if fr:
+                    finish_reason = gemini_finish_reason_to_openai(fr)
                 # STOP以外（MAX_TOKENS等）は「終了」扱いで抜ける
                 if fr and fr != "STOP":
                     raise StopAsyncIteration
@@ -369,12 +499,18 @@ async def proxy_gemini_stream_as_openai_sse(
                 data_lines.append(line[len("data:"):].lstrip())
 
         await _flush_event()
+        if trace is not None:
+            trace.mark("last_chunk")
 
+        await proxy_resp.write(make_openai_stream_finish_chunk(model, finish_reason or "stop", usage, created))
         await proxy_resp.write(make_openai_stream_done())
         await proxy_resp.write_eof()
         return proxy_resp
 
     except StopAsyncIteration:
+        if trace is not None:
+            trace.mark("last_chunk")
+        await proxy_resp.write(make_openai_stream_finish_chunk(model, finish_reason or "stop", usage, created))
         await proxy_resp.write(make_openai_stream_done())
         try:
             await proxy_resp.write_eof()
@@ -401,29 +537,261 @@ async def proxy_gemini_stream_as_openai_sse(
 
 
 
+# -----------------------------
+# Token accounting
+# -----------------------------
+STAGE_HEADER = "X-SLM-Stage"
+
+
+def record_usage(
+    app: web.Application,
+    stage: str,
+    backend: str,
+    prompt_tokens: Optional[int],
+    completion_tokens: Optional[int],
+) -> None:
+    app["token_metrics"].record(stage, backend, prompt_tokens, completion_tokens)
+    print_token_usage(stage, backend, prompt_tokens, completion_tokens)
+
+
+async def record_llama_usage(
+    app: web.Application,
+    session: ClientSession,
+    llama_base: str,
+    stage: str,
+    data: Dict[str, Any],
+    completion_text: str,
+    completion_tokens: Optional[int],
+    prompt_tokens: Optional[int] = None,
+) -> None:
+    """
+    prompt / completion とも upstream が返した usage / timings の値を使う（テンプレート分も含む）。
+    返ってこなかったときだけ tokenize で数える（prompt はメッセージ断片ごと・キャッシュ付きで、テンプレート分は含まない）。
+    """
+    try:
+        if prompt_tokens is None:
+            prompt_tokens = await count_prompt_tokens_llama(
+                session, llama_base, app["tokenize_cache"], data.get("messages") or []
+            )
+        if completion_tokens is None and completion_text:
+            completion_tokens = len(await llama_tokenize(session, llama_base, completion_text))
+    except Exception as e:
+        print(f"[tokens] tokenize failed: {e}", flush=True)
+    record_usage(app, stage, "local", prompt_tokens, completion_tokens)
+
+
+async def relay_stream(
+    resp: aiohttp.ClientResponse,
+    proxy_resp: web.StreamResponse,
+    sniffer: OpenAISSESniffer,
+    trace: Optional[RequestTrace] = None,
+) -> None:
+    """
+    upstream の SSE をそのまま中継する。クライアントが切断したら（キャンセル・早期終了）
+    ここで抜けて upstream の接続も閉じる → llama.cpp 側の生成も止まる。
+    """
+    try:
+        async for chunk in resp.content.iter_chunked(4096):
+            if trace is not None:
+                trace.mark("first_chunk")
+            sniffer.feed(chunk)
+            await proxy_resp.write(chunk)
+            await asyncio.sleep(0)
+    except ConnectionResetError:
+        print("[proxy] client disconnected; aborting upstream generation", flush=True)
+        resp.close()
+        if trace is not None:
+            trace.mark("last_chunk")
+            trace.attrs["aborted"] = True
+        return
+    if trace is not None:
+        trace.mark("last_chunk")
+    try:
+        await proxy_resp.write_eof()
+    except Exception:
+        pass
+
+
+async def handle_llama_passthrough(request: web.Request) -> web.StreamResponse:
+    """
+    llama.cpp のネイティブ API（/completion, /tokenize, /apply-template 等）をそのまま中継する。
+    事前トークナイズ経路（slm_demo/pretokenized.py）用。local backend のみ。
+    """
+    cfg: ProxyConfig = request.app["cfg"]
+    backend = (cfg.backend or "local").lower().strip()
+    if backend not in ("local", "llama", "llamacpp"):
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": f"{request.path} is only available with the local backend"}, ensure_ascii=False),
+            content_type="application/json",
+        )
+
+    trace = start_trace(
+        request.app.get("span_exporter"), request.headers, request.headers.get(STAGE_HEADER) or "unknown", "local", request.path
+    )
+    target_url = f"{cfg.llama_base}{request.path}"
+    body = await request.read()
+    data: Dict[str, Any] = {}
+    if body:
+        try:
+            data = json.loads(body)
+        except Exception:
+            data = {}
+
+    headers = {"Content-Type": "application/json"} if body else {}
+    if trace is not None:
+        # llama-server は使わないが、前段にログを取る reverse proxy などがあれば同じ id で追える
+        headers[TRACE_HEADER] = trace.request_id
+        trace.mark("upstream_send")
+    async with ClientSession() as session:
+        async with session.request(
+            request.method,
+            target_url,
+            data=body or None,
+            headers=headers or None,
+        ) as resp:
+            if trace is not None:
+                trace.mark("upstream_headers")
+            if not data.get("stream"):
+                text = await resp.text()
+                if trace is not None:
+                    trace.mark("first_chunk")
+                    trace.finish(timings=_timings_of(text), status=resp.status)
+                return web.Response(
+                    status=resp.status,
+                    text=text,
+                    content_type="application/json",
+                    headers={BACKEND_HEADER: "local"},
+                )
+
+            proxy_resp = web.StreamResponse(
+                status=resp.status,
+                headers={
+                    "Content-Type": "text/event-stream; charset=utf-8",
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                    BACKEND_HEADER: "local",
+                },
+            )
+            await proxy_resp.prepare(request)
+            sniffer = OpenAISSESniffer()
+            await relay_stream(resp, proxy_resp, sniffer, trace)
+            if trace is not None:
+                trace.finish(timings=sniffer.timings, status=resp.status)
+
+    prompt = data.get("prompt")
+    if isinstance(prompt, list) and all(isinstance(t, int) for t in prompt):
+        record_usage(
+            request.app,
+            request.headers.get(STAGE_HEADER) or "unknown",
+            "local",
+            len(prompt),
+            sniffer.completion_tokens(),
+        )
+    return proxy_resp
+
+
+async def handle_prefill(request: web.Request) -> web.Response:
+    """
+    POST /v1/prefill {"messages": [...], "id_slot": n}
+    チャットテンプレートを適用したプロンプトを n_predict=0 で評価し、slot の KV を温めるだけ（生成しない）。
+    本番の /v1/chat/completions を同じ id_slot で送れば、llama.cpp は一致する先頭の prefill を省く。local backend のみ。
+    """
+    cfg: ProxyConfig = request.app["cfg"]
+    backend = (cfg.backend or "local").lower().strip()
+    if backend not in ("local", "llama", "llamacpp"):
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": f"{request.path} is only available with the local backend"}, ensure_ascii=False),
+            content_type="application/json",
+        )
+
+    stage = request.headers.get(STAGE_HEADER) or "unknown"
+    trace = start_trace(request.app.get("span_exporter"), request.headers, stage, "local", request.path)
+    data = await request.json()
+    id_slot = int(data.get("id_slot", -1))
+    if trace is not None:
+        trace.mark("upstream_send")
+    async with ClientSession() as session:
+        prompt = await llama_apply_template(session, cfg.llama_base, data.get("messages") or [])
+        pre = await llama_prefill(session, cfg.llama_base, prompt, id_slot=id_slot)
+    timings = pre.get("timings") if isinstance(pre.get("timings"), dict) else {}
+    if trace is not None:
+        # 応答は1回で返るので、ヘッダ・最初の chunk は同じ時刻にする（prefill は llama.prefill の span で見る）
+        trace.mark("upstream_headers")
+        trace.mark("first_chunk")
+        trace.finish(timings=timings, id_slot=id_slot)
+    out = {
+        "id_slot": pre.get("id_slot", id_slot),
+        "wall_ms": pre["wall_ms"],
+        "timings": timings,
+    }
+    print(f"[prefill] stage={stage} slot={out['id_slot']} prompt_n={timings.get('prompt_n')} prompt_ms={timings.get('prompt_ms')}", flush=True)
+    return web.Response(
+        text=json.dumps(out, ensure_ascii=False),
+        content_type="application/json",
+        headers={BACKEND_HEADER: "local"},
+    )
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    out = {
+        "stages": request.app["token_metrics"].snapshot(),
+        "tokenize_cache": request.app["tokenize_cache"].snapshot(),
+    }
+    if request.app.get("slot_store") is not None:
+        out["slot_snapshots"] = request.app["slot_store"].snapshot()
+    return web.Response(text=json.dumps(out, ensure_ascii=False), content_type="application/json")
+
+
 # -----------------------------
 # Main handler
 # -----------------------------
 class ProxyConfig:
-    def __init__(self, backend: str, llama_base: str, gemini_api_key: Optional[str], gemini_model: str):
+    def __init__(
+        self,
+        backend: str,
+        llama_base: str,
+        gemini_api_key: Optional[str],
+        gemini_model: str,
+        reserved_slots: Tuple[int, ...] = (),
+    ):
         self.backend = backend
         self.llama_base = llama_base
         self.gemini_api_key = gemini_api_key
         self.gemini_model = gemini_model
+        # クライアントが id_slot を固定して使う slot（人感 prefill の PRESENCE_PREFILL_SLOT）。fork と slot store は触らない
+        self.reserved_slots = tuple(reserved_slots)
+
+
+def _timings_of(text: str) -> Optional[Dict[str, Any]]:
+    # 非 stream 応答の llama.cpp timings（span 用。無ければ None）
+    try:
+        obj = json.loads(text)
+    except Exception:
+        return None
+    return obj.get("timings") if isinstance(obj, dict) and isinstance(obj.get("timings"), dict) else None
 
 
 async def handle_chat(request: web.Request) -> web.StreamResponse:
     cfg: ProxyConfig = request.app["cfg"]
+    stage = request.headers.get(STAGE_HEADER) or "unknown"
+    backend = (cfg.backend or "local").lower().strip()
+    trace = start_trace(request.app.get("span_exporter"), request.headers, stage, backend, request.path)
     data = await request.json()
     print_input_only(data, backend=cfg.backend)
 
-    backend = (cfg.backend or "local").lower().strip()
-
     # local passthrough (llama.cpp OpenAI-compatible)
     if backend in ("local", "llama", "llamacpp"):
+        if request.app.get("slot_store") is not None:
+            request.app["slot_store"].observe_request(data.get("messages") or [])
         target_url = f"{cfg.llama_base}/v1/chat/completions"
+        headers = {}
+        if trace is not None:
+            headers[TRACE_HEADER] = trace.request_id
+            trace.mark("upstream_send")
         async with ClientSession() as session:
-            async with session.post(target_url, json=data) as resp:
+            async with session.post(target_url, json=data, headers=headers) as resp:
+                if trace is not None:
+                    trace.mark("upstream_headers")
                 if data.get("stream"):
                     proxy_resp = web.StreamResponse(
                         status=resp.status,
@@ -431,20 +799,46 @@ async def handle_chat(request: web.Request) -> web.StreamResponse:
                             "Content-Type": "text/event-stream; charset=utf-8",
                             "Cache-Control": "no-cache",
                             "Connection": "keep-alive",
+                            BACKEND_HEADER: "local",
                         },
                     )
                     await proxy_resp.prepare(request)
-                    async for chunk in resp.content.iter_chunked(4096):
-                        await proxy_resp.write(chunk)
-                        await asyncio.sleep(0)
-                    try:
-                        await proxy_resp.write_eof()
-                    except Exception:
-                        pass
+                    sniffer = OpenAISSESniffer()
+                    await relay_stream(resp, proxy_resp, sniffer, trace)
+                    if trace is not None:
+                        trace.finish(timings=sniffer.timings, status=resp.status)
+                    await record_llama_usage(
+                        request.app, session, cfg.llama_base, stage, data,
+                        completion_text=sniffer.text,
+                        completion_tokens=sniffer.completion_tokens(),
+                        prompt_tokens=sniffer.prompt_tokens(),
+                    )
                     return proxy_resp
 
                 text = await resp.text()
-                return web.Response(status=resp.status, text=text, content_type="application/json")
+                if trace is not None:
+                    trace.mark("first_chunk")
+                    trace.finish(timings=_timings_of(text), status=resp.status)
+                completion_text = ""
+                usage: Dict[str, Optional[int]] = {"prompt_tokens": None, "completion_tokens": None}
+                try:
+                    obj = json.loads(text)
+                    completion_text = obj["choices"][0]["message"]["content"] or ""
+                    usage = usage_from_llama_response(obj)
+                except Exception:
+                    pass
+                await record_llama_usage(
+                    request.app, session, cfg.llama_base, stage, data,
+                    completion_text=completion_text,
+                    completion_tokens=usage["completion_tokens"],
+                    prompt_tokens=usage["prompt_tokens"],
+                )
+                return web.Response(
+                    status=resp.status,
+                    text=text,
+                    content_type="application/json",
+                    headers={BACKEND_HEADER: "local"},
+                )
 
     # gemini
     if backend in ("gemini", "google", "ai_studio", "aistudio"):
@@ -457,28 +851,247 @@ async def handle_chat(request: web.Request) -> web.StreamResponse:
         model = cfg.gemini_model or GEMINI_MODEL_DEFAULT
 
         if data.get("stream"):
-            return await proxy_gemini_stream_as_openai_sse(request, data, cfg.gemini_api_key, model)
+            usage: Dict[str, Any] = {}
+            proxy_resp = await proxy_gemini_stream_as_openai_sse(
+                request, data, cfg.gemini_api_key, model, usage_out=usage, trace=trace
+            )
+            if trace is not None:
+                trace.finish(model=model, completion_tokens=usage.get("completion_tokens"))
+            record_usage(request.app, stage, "gemini", usage.get("prompt_tokens"), usage.get("completion_tokens"))
+            return proxy_resp
 
+        if trace is not None:
+            trace.mark("upstream_send")
         obj = await gemini_generate_content(data=data, api_key=cfg.gemini_api_key, model=model)
+        usage = usage_from_gemini(obj)
+        if trace is not None:
+            # 非 stream は応答ヘッダと本文を分けて測れないので同じ時刻にする
+            trace.mark("upstream_headers")
+            trace.mark("first_chunk")
+            trace.finish(model=model, completion_tokens=usage["completion_tokens"])
+        record_usage(request.app, stage, "gemini", usage["prompt_tokens"], usage["completion_tokens"])
 
         # extract full text
         full_text = ""
+        finish_reason = "stop"
         try:
             cand0 = (obj.get("candidates") or [])[0]
             content = cand0.get("content") or {}
             parts = content.get("parts") or []
             full_text = "".join([p.get("text", "") for p in parts if isinstance(p.get("text"), str)])
+            finish_reason = gemini_finish_reason_to_openai(cand0.get("finishReason"))
         except Exception:
             full_text = ""
 
-        out = make_openai_nonstream_response(model=model, full_text=full_text)
-        return web.Response(status=200, text=json.dumps(out, ensure_ascii=False), content_type="application/json")
+        out = make_openai_nonstream_response(model=model, full_text=full_text, finish_reason=finish_reason, usage=usage)
+        return web.Response(
+            status=200,
+            text=json.dumps(out, ensure_ascii=False),
+            content_type="application/json",
+            headers={BACKEND_HEADER: "gemini"},
+        )
 
     raise web.HTTPBadRequest(
         text=json.dumps({"error": f"Unknown backend: {backend}"}, ensure_ascii=False),
         content_type="application/json",
     )
 
+# -----------------------------
+# Fork: 共通 prefix + K 個の末尾ターンを 1 ジョブで生成
+# -----------------------------
+def fork_branch_messages(data: Dict[str, Any]) -> List[List[Dict[str, Any]]]:
+    """
+    {"messages": [...共通prefix...], "suffixes": ["...", [{"role": ..., "content": ...}], ...]}
+    → 枝ごとの完全なメッセージ列
+    """
+    prefix = list(data.get("messages") or [])
+    branches: List[List[Dict[str, Any]]] = []
+    for sfx in data.get("suffixes") or []:
+        if isinstance(sfx, str):
+            sfx = [{"role": "user", "content": sfx}]
+        elif isinstance(sfx, dict):
+            sfx = [sfx]
+        branches.append(prefix + list(sfx))
+    return branches
+
+
+def make_fork_summary_event(summary: Dict[str, Any]) -> bytes:
+    payload = {"object": "fork.summary", **summary}
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def fork_local(
+    cfg: "ProxyConfig",
+    data: Dict[str, Any],
+    branches: List[List[Dict[str, Any]]],
+    emit,
+    lock: asyncio.Lock,
+) -> Dict[str, Any]:
+    """
+    1) 各枝をテンプレート適用し、文字列の共通 prefix を求める
+    2) GET /slots で空いている slot を K 個選ぶ（cfg.reserved_slots は使わない）
+    3) 選んだ先頭の slot で共通 prefix だけ prefill（1回）
+    4) その slot を保存し、残りの slot へ restore（KV のコピー）
+    5) K 枝を id_slot 固定・cache_prompt で並列ストリーム生成
+
+    空き slot が K 個無い・/slots が取れないときは slot を固定せず（id_slot=-1）各枝が自前で prefill する。
+    slot の選択が重ならないよう fork は lock で1本ずつ流し、KV コピーの一時ファイルもプロセスごとに1つを使い回す。
+    """
+    t0 = time.perf_counter()
+    summary: Dict[str, Any] = {"backend": "local", "k": len(branches)}
+    sampling = openai_params_to_llama_completion(data)
+    model = data.get("model") or "local"
+
+    async with lock, ClientSession() as session:
+        props = await llama_props(session, cfg.llama_base)
+        n_slots = int(props.get("total_slots") or 1)
+        usable = n_slots - len({i for i in cfg.reserved_slots if 0 <= i < n_slots})
+        if len(branches) > usable:
+            raise web.HTTPBadRequest(
+                text=json.dumps(
+                    {"error": f"k={len(branches)} exceeds llama.cpp slots ({n_slots}, reserved {list(cfg.reserved_slots)})"},
+                    ensure_ascii=False,
+                ),
+                content_type="application/json",
+            )
+
+        prompts = [await llama_apply_template(session, cfg.llama_base, msgs) for msgs in branches]
+        prefix = common_prefix(prompts)
+        summary["prefix_chars"] = len(prefix)
+
+        idle = await llama_idle_slots(session, cfg.llama_base, cfg.reserved_slots)
+        slots: Optional[List[int]] = idle[: len(branches)] if idle is not None and len(idle) >= len(branches) else None
+        summary["slots"] = slots
+        summary["prefill_ms"] = None
+        summary["kv_copy"] = False
+        t_copy = time.perf_counter()
+        if slots is not None:
+            pre = await llama_prefill(session, cfg.llama_base, prefix, id_slot=slots[0])
+            summary["prefill_ms"] = pre["wall_ms"]
+
+            # KV コピー（slot-save-path 未設定なら各 slot が自前で prefill する）
+            t_copy = time.perf_counter()
+            if len(branches) > 1:
+                fname = f"fork-{os.getpid()}.bin"
+                try:
+                    await llama_slot_action(session, cfg.llama_base, slots[0], "save", fname)
+                    await asyncio.gather(*[
+                        llama_slot_action(session, cfg.llama_base, i, "restore", fname)
+                        for i in slots[1:]
+                    ])
+                    summary["kv_copy"] = True
+                except Exception as e:
+                    print(f"[fork] slot copy skipped: {e}", flush=True)
+        else:
+            print(f"[fork] idle slots unavailable ({idle}); branches pick their own slots", flush=True)
+        summary["copy_ms"] = (time.perf_counter() - t_copy) * 1000.0
+
+        completion_tokens: List[Optional[int]] = [None] * len(branches)
+
+        async def _run_branch(i: int, prompt: str):
+            id_slot = slots[i] if slots is not None else -1
+            req = dict(sampling, prompt=prompt, id_slot=id_slot, cache_prompt=True, stream=True)
+            async with session.post(f"{cfg.llama_base}/completion", json=req) as resp:
+                finish_reason = None
+                async for ev in iter_llama_completion_stream(resp):
+                    content = ev.get("content")
+                    if isinstance(content, str) and content:
+                        await emit(make_openai_stream_chunk(model, content, index=i))
+                    finish_reason = llama_stop_to_finish_reason(ev) or finish_reason
+                    if ev.get("stop"):
+                        completion_tokens[i] = ev.get("tokens_predicted")
+                await emit(make_openai_stream_finish_chunk(model, finish_reason or "stop", index=i))
+
+        await asyncio.gather(*[_run_branch(i, p) for i, p in enumerate(prompts)])
+
+    summary["completion_tokens"] = completion_tokens
+    summary["wall_ms"] = (time.perf_counter() - t0) * 1000.0
+    return summary
+
+
+async def fork_gemini(
+    cfg: "ProxyConfig",
+    data: Dict[str, Any],
+    branches: List[List[Dict[str, Any]]],
+    emit,
+) -> Dict[str, Any]:
+    """
+    Gemini には KV 共有が無いので、K 枝を並列に投げて枝ごとに多重化するだけ。
+    """
+    t0 = time.perf_counter()
+    model = cfg.gemini_model or GEMINI_MODEL_DEFAULT
+
+    async def _run_branch(i: int, msgs: List[Dict[str, Any]]):
+        obj = await gemini_generate_content(data=dict(data, messages=msgs), api_key=cfg.gemini_api_key, model=model)
+        text = ""
+        finish_reason = "stop"
+        try:
+            cand0 = (obj.get("candidates") or [])[0]
+            parts = (cand0.get("content") or {}).get("parts") or []
+            text = "".join([p.get("text", "") for p in parts if isinstance(p.get("text"), str)])
+            finish_reason = gemini_finish_reason_to_openai(cand0.get("finishReason"))
+        except Exception:
+            pass
+        if text:
+            await emit(make_openai_stream_chunk(model, text, index=i))
+        await emit(make_openai_stream_finish_chunk(model, finish_reason, usage_from_gemini(obj), index=i))
+
+    await asyncio.gather(*[_run_branch(i, msgs) for i, msgs in enumerate(branches)])
+    return {"backend": "gemini", "k": len(branches), "wall_ms": (time.perf_counter() - t0) * 1000.0}
+
+
+async def handle_fork(request: web.Request) -> web.StreamResponse:
+    """
+    POST /v1/fork
+    枝 i の出力は choices[0].index = i の OpenAI 互換 chunk として 1 本の SSE に多重化する。
+    最後に {"object": "fork.summary", ...}（prefill/copy/wall の時間）を流してから [DONE]。
+    """
+    cfg: ProxyConfig = request.app["cfg"]
+    data = await request.json()
+    branches = fork_branch_messages(data)
+    if not branches:
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": "suffixes is empty"}, ensure_ascii=False),
+            content_type="application/json",
+        )
+
+    backend = (cfg.backend or "local").lower().strip()
+    proxy_resp = web.StreamResponse(
+        status=200,
+        headers={
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            BACKEND_HEADER: backend,
+        },
+    )
+    write_lock = asyncio.Lock()
+
+    async def emit(chunk: bytes):
+        async with write_lock:
+            if not proxy_resp.prepared:
+                await proxy_resp.prepare(request)
+            await proxy_resp.write(chunk)
+
+    if backend in ("local", "llama", "llamacpp"):
+        summary = await fork_local(cfg, data, branches, emit, request.app["fork_lock"])
+    elif backend in ("gemini", "google", "ai_studio", "aistudio"):
+        summary = await fork_gemini(cfg, data, branches, emit)
+    else:
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": f"Unknown backend: {backend}"}, ensure_ascii=False),
+            content_type="application/json",
+        )
+
+    print(f"[fork] {json.dumps(summary, ensure_ascii=False)}", flush=True)
+    await emit(make_fork_summary_event(summary))
+    await emit(make_openai_stream_done())
+    try:
+        await proxy_resp.write_eof()
+    except Exception:
+        pass
+    return proxy_resp
+
 
 def build_arg_parser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(description="Proxy: local llama.cpp or Gemini (AI Studio)")
@@ -487,9 +1100,55 @@ def build_arg_parser() -> argparse.ArgumentParser:
     p.add_argument("--backend", default=os.getenv("LLM_BACKEND", "local"), help="local (default) or gemini")
     p.add_argument("--llama-base", default=os.getenv("LLAMA_BASE", LLAMA_BASE_DEFAULT))
     p.add_argument("--gemini-model", default=os.getenv("GEMINI_MODEL", GEMINI_MODEL_DEFAULT))
+    p.add_argument(
+        "--slot-state-dir",
+        default=os.getenv("SLOT_STATE_DIR", SLOT_STATE_DIR_DEFAULT),
+        help="hot prefix スナップショットの manifest 置き場（本体は llama-server の --slot-save-path）",
+    )
+    p.add_argument(
+        "--uds",
+        default=os.getenv("PROXY_UDS"),
+        help="TCP に加えてこの Unix ドメインソケットでも待ち受ける（slm_demo 側は SLM_LLAMA_UDS）",
+    )
+    p.add_argument(
+        "--trace-path",
+        default=os.getenv("PROXY_TRACE_PATH", TRACE_PATH_DEFAULT),
+        help="X-SLM-Trace 付きリクエストの span（JSON Lines）の書き出し先",
+    )
+    p.add_argument("--trace", action="store_true", help="X-SLM-Trace 付きリクエストの span を書き出す（既定は無効）")
+    p.add_argument(
+        "--reserved-slot",
+        type=int,
+        action="append",
+        default=None,
+        help="fork / slot store が使わない llama.cpp の slot（複数可。既定は PROXY_RESERVED_SLOTS。無ければ予約なし。PRESENCE_PREFILL を使うならその slot を指定）",
+    )
+    p.add_argument(
+        "--no-slot-persist",
+        action="store_true",
+        help="slot の保存/復元（再起動後の prefix 再 prefill 回避）を無効化",
+    )
     return p
 
 
+async def _start_slot_store(app: web.Application):
+    store: SlotSnapshotStore = app["slot_store"]
+    app["slot_store_task"] = asyncio.create_task(store.run())
+
+
+async def _close_span_exporter(app: web.Application):
+    await asyncio.get_running_loop().run_in_executor(None, app["span_exporter"].close)
+
+
+async def _stop_slot_store(app: web.Application):
+    app["slot_store"].enabled = False
+    app["slot_store_task"].cancel()
+    try:
+        await app["slot_store_task"]
+    except (asyncio.CancelledError, Exception):
+        pass
+
+
 def main():
     args = build_arg_parser().parse_args()
     backend = (args.backend or "local").lower().strip()
@@ -499,18 +1158,40 @@ def main():
         llama_base=args.llama_base,
         gemini_api_key=os.getenv("GEMINI_API_KEY"),
         gemini_model=args.gemini_model,
+        reserved_slots=tuple(args.reserved_slot if args.reserved_slot is not None else RESERVED_SLOTS_DEFAULT),
     )
 
     app = web.Application()
     app["cfg"] = cfg
+    app["token_metrics"] = StageTokenMetrics()
+    app["tokenize_cache"] = TokenizeCache()
+    app["fork_lock"] = asyncio.Lock()
+    app["slot_store"] = None
+    app["span_exporter"] = SpanFileExporter(args.trace_path) if args.trace else None
+    if app["span_exporter"] is not None:
+        app.on_cleanup.append(_close_span_exporter)
+    if backend in ("local", "llama", "llamacpp") and not args.no_slot_persist:
+        app["slot_store"] = SlotSnapshotStore(cfg.llama_base, args.slot_state_dir, reserved=cfg.reserved_slots)
+        app.on_startup.append(_start_slot_store)
+        app.on_cleanup.append(_stop_slot_store)
     app.router.add_post("/v1/chat/completions", handle_chat)
+    app.router.add_post("/v1/fork", handle_fork)
+    app.router.add_post("/v1/prefill", handle_prefill)
+    for path in ("/completion", "/tokenize", "/detokenize", "/apply-template"):
+        app.router.add_post(path, handle_llama_passthrough)
+    for path in ("/v1/models", "/props", "/health"):
+        app.router.add_get(path, handle_llama_passthrough)
+    app.router.add_get("/metrics", handle_metrics)
 
     print(
-        f"[proxy] host={args.host} port={args.port} backend={cfg.backend} llama_base={cfg.llama_base} gemini_model={cfg.gemini_model}",
+        f"[proxy] host={args.host} port={args.port} uds={args.uds} backend={cfg.backend} llama_base={cfg.llama_base} gemini_model={cfg.gemini_model}",
         flush=True,
     )
 
-    web.run_app(app, host=args.host, port=args.port)
+    if args.uds and os.path.exists(args.uds):
+        # 前回の異常終了で残ったソケットファイル
+        os.unlink(args.uds)
+    web.run_app(app, host=args.host, port=args.port, path=args.uds)
 
 
 if __name__ == "__main__":
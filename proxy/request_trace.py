@@ -0,0 +1,151 @@
+# proxy/request_trace.py
+"""
+クライアント（slm_demo/span_trace.py）が X-SLM-Trace ヘッダで送ってきた request id ごとに、
+proxy の中の区切り時刻を集めて span にし、JSON Lines で書き出す。
+
+  proxy.queue   : リクエスト受信 → upstream へ送信（本文の読み込み・変換など proxy 内の待ち）
+  proxy.connect : upstream へ送信 → 応答ヘッダ（接続・upstream の受け付け）
+  proxy.ttft    : 応答ヘッダ → 最初の chunk（llama.cpp の prefill / Gemini の応答待ち）
+  proxy.relay   : 最初の chunk → 最後の chunk（生成しながらの中継）
+  llama.prefill / llama.decode : llama.cpp が返した timings（prompt_ms / predicted_ms）。あれば足す
+"""
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+TRACE_HEADER = "X-SLM-Trace"
+# これを超えたら <path>.1 へ回して新しいファイルに書く（1世代だけ残す）
+TRACE_MAX_BYTES = 32 * 1024 * 1024
+
+_SPANS = (
+    ("proxy.queue", "recv", "upstream_send"),
+    ("proxy.connect", "upstream_send", "upstream_headers"),
+    ("proxy.ttft", "upstream_headers", "first_chunk"),
+    ("proxy.relay", "first_chunk", "last_chunk"),
+)
+
+
+class SpanFileExporter:
+    """
+    span を JSON Lines で追記する（行の形式は slm_demo/span_trace.py と同じ）。
+
+    - export() はキューに積むだけで戻る（aiohttp のハンドラから呼ぶので、イベントループでファイル I/O をしない）
+    - 書き込みスレッドは最初の export() で起動し、溜まった分をまとめて1回の write で追記する
+    - ファイルが max_bytes を超えたら <path>.1 に回す（古い .1 は消える）
+    """
+
+    def __init__(self, path: str, max_bytes: int = TRACE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.exported = 0
+        self.failed = 0
+        self._q: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self, spans: List[Dict[str, Any]]) -> None:
+        if not spans:
+            return
+        self._q.put("".join(json.dumps(s, ensure_ascii=False) + "\n" for s in spans))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+                self._thread.start()
+
+    def close(self, timeout: float = 2.0) -> None:
+        """
+        積んである分を書き切って書き込みスレッドを止める
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return
+        self._q.put(None)
+        thread.join(timeout)
+
+    def _writer_loop(self) -> None:
+        while True:
+            lines = [self._q.get()]
+            while True:
+                try:
+                    lines.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in lines
+            buf = "".join(x for x in lines if x is not None)
+            if buf:
+                try:
+                    self._write(buf)
+                    self.exported += buf.count("\n")
+                except OSError as e:
+                    self.failed += buf.count("\n")
+                    print(f"[trace] export failed: {e}", flush=True)
+            if stop:
+                return
+
+    def _write(self, buf: str) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        try:
+            if os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except FileNotFoundError:
+            pass
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(buf)
+
+
+class RequestTrace:
+    def __init__(self, exporter: SpanFileExporter, request_id: str, stage: str, backend: str, path: str):
+        self.exporter = exporter
+        self.request_id = request_id
+        self.stage = stage
+        self.attrs: Dict[str, Any] = {"backend": backend, "path": path}
+        self.t: Dict[str, float] = {"recv": time.time()}
+
+    def mark(self, name: str) -> None:
+        # 同じ区切りは最初の1回だけ
+        self.t.setdefault(name, time.time())
+
+    def _span(self, name: str, start: float, end: float, **attrs) -> Dict[str, Any]:
+        return {
+            "trace": self.request_id.split(".", 1)[0],
+            "req": self.request_id,
+            "stage": self.stage,
+            "proc": "proxy",
+            "name": name,
+            "start": round(start, 6),
+            "ms": round(max(0.0, end - start) * 1000.0, 3),
+            "attrs": dict(self.attrs, **attrs),
+        }
+
+    def finish(self, timings: Optional[Dict[str, Any]] = None, **attrs) -> None:
+        """
+        区切り時刻から span を作って書き出す。途中で切れた（クライアント切断など）区間は書かない
+        """
+        self.attrs.update(attrs)
+        self.t.setdefault("last_chunk", time.time())
+        spans = [self._span(name, self.t[a], self.t[b]) for name, a, b in _SPANS if a in self.t and b in self.t]
+        if timings and "first_chunk" in self.t:
+            # llama.cpp 内の時間。prefill は最初の chunk の直前、decode は最後の chunk までに置く
+            prompt_ms = timings.get("prompt_ms")
+            predicted_ms = timings.get("predicted_ms")
+            if isinstance(prompt_ms, (int, float)):
+                end = self.t["first_chunk"]
+                spans.append(self._span("llama.prefill", end - prompt_ms / 1000.0, end, prompt_n=timings.get("prompt_n")))
+            if isinstance(predicted_ms, (int, float)):
+                end = self.t["last_chunk"]
+                spans.append(self._span("llama.decode", end - predicted_ms / 1000.0, end, predicted_n=timings.get("predicted_n")))
+        self.exporter.export(spans)
+
+
+def start_trace(exporter: Optional[SpanFileExporter], headers, stage: str, backend: str, path: str) -> Optional[RequestTrace]:
+    """
+    X-SLM-Trace が付いたリクエストだけを追う（付いていなければ / exporter が無ければ None）
+    """
+    request_id = headers.get(TRACE_HEADER)
+    if exporter is None or not request_id:
+        return None
+    return RequestTrace(exporter, request_id, stage, backend, path)
@@ -0,0 +1,240 @@
+# proxy/slot_store.py
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout
+
+from llama_slots import (
+    common_prefix,
+    llama_apply_template,
+    llama_idle_slots,
+    llama_prefill,
+    llama_props,
+    llama_slot_action,
+)
+
+
+async def llama_model_hash(session: ClientSession, llama_base: str) -> str:
+    """
+    読み込まれているモデルの識別子。/v1/models の id+meta と /props の model_path から作る。
+    モデルを差し替えると値が変わるので、古いスナップショットを誤って復元しない。
+    """
+    async with session.get(f"{llama_base}/v1/models") as resp:
+        models = await resp.json(content_type=None)
+    props = await llama_props(session, llama_base)
+    key = {
+        "models": [{"id": m.get("id"), "meta": m.get("meta")} for m in (models.get("data") or [])],
+        "model_path": props.get("model_path"),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def prefix_name(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+def restore_plan(entries: Dict[str, Dict[str, Any]], model_hash: Optional[str], slots: List[int]) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    manifest のエントリを slot に1対1で割り当てる（同じ slot に重ねて restore すると最後の1つしか残らない）。
+    モデルが一致するものを新しい順に、空いている slot の数まで。溢れた古いものは戻さない
+    """
+    current = [e for e in entries.values() if e.get("model_hash") == model_hash]
+    current.sort(key=lambda e: e.get("saved_at") or 0.0, reverse=True)
+    return list(zip(slots, current))
+
+
+class SlotSnapshotStore:
+    """
+    よく使う prefix（SYSTEM_PROMPT 等の system メッセージ）の KV を llama.cpp の slot save で保存し、
+    llama-server が再起動して戻ってきたら空いている slot へ1つずつ restore する。
+
+    - スナップショット本体は llama-server の --slot-save-path 配下（ファイル名だけ proxy が決める）
+    - ファイル名と manifest にモデルハッシュを入れ、現在のモデルと一致するものだけを復元する
+    - manifest に cold prefill 時間と restore 時間を残し、/metrics で比較できるようにする
+    - スナップショットを取る prefill も restore も、GET /slots で空いている slot だけを使う。reserved（クライアントが
+      id_slot を固定して使う slot）は触らない。空きが無ければ次の poll まで待つ
+    """
+
+    def __init__(
+        self,
+        llama_base: str,
+        state_dir: str,
+        poll_s: float = 5.0,
+        max_prefixes: int = 4,
+        reserved: Iterable[int] = (),
+    ):
+        self.llama_base = llama_base
+        self.reserved = tuple(reserved)
+        self.state_dir = state_dir
+        self.poll_s = poll_s
+        self.max_prefixes = max_prefixes
+        self.manifest_path = os.path.join(state_dir, "slot_manifest.json")
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.model_hash: Optional[str] = None
+        self.upstream_up = False
+        self.enabled = True
+        self._pending: Dict[str, str] = {}   # name -> system テキスト
+        self._wake = asyncio.Event()
+        self.load()
+
+    # -------- manifest --------
+    def load(self) -> None:
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("entries") or {}
+        except Exception as e:
+            print(f"[slots] manifest load failed: {e}", flush=True)
+
+    def save(self) -> None:
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"entries": self.entries}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def _key(self, name: str, model_hash: str) -> str:
+        return f"{name}-{model_hash}"
+
+    # -------- hot prefix の学習 --------
+    def observe_request(self, messages: List[Dict[str, Any]]) -> None:
+        """
+        先頭の system メッセージを hot prefix 候補にする（初見のものだけスナップショットを予約）。
+        """
+        if not self.enabled or not messages:
+            return
+        m0 = messages[0] or {}
+        if m0.get("role") != "system" or not isinstance(m0.get("content"), str) or not m0["content"]:
+            return
+        name = prefix_name(m0["content"])
+        if self.model_hash and self._key(name, self.model_hash) in self.entries:
+            return
+        if name in self._pending:
+            return
+        known = {e["name"] for e in self.entries.values()}
+        if name not in known and len(known) + len(self._pending) >= self.max_prefixes:
+            return
+        self._pending[name] = m0["content"]
+        self._wake.set()
+
+    # -------- バックグラウンド --------
+    async def run(self) -> None:
+        timeout = ClientTimeout(total=120)
+        async with ClientSession(timeout=timeout) as session:
+            while self.enabled:
+                up = await self._health(session)
+                if up and not self.upstream_up:
+                    # 起動時 or 再起動から復帰: モデルを確認して一致するスナップショットを戻す
+                    try:
+                        self.model_hash = await llama_model_hash(session, self.llama_base)
+                        await self.restore_all(session)
+                    except Exception as e:
+                        print(f"[slots] restore failed: {e}", flush=True)
+                self.upstream_up = up
+
+                if up and self._pending:
+                    name = next(iter(self._pending))
+                    system = self._pending.pop(name)
+                    try:
+                        if not await self.snapshot_prefix(session, name, system):
+                            # 空いている slot が無い（本番が走っている）。次の poll でやり直す
+                            self._pending[name] = system
+                    except Exception as e:
+                        print(f"[slots] snapshot failed: {e}", flush=True)
+
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.poll_s)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _health(self, session: ClientSession) -> bool:
+        try:
+            async with session.get(f"{self.llama_base}/health") as resp:
+                return resp.status == 200
+        except Exception:
+            return False
+
+    async def _prefix_prompt(self, session: ClientSession, system: str) -> str:
+        # system だけをテンプレートに通すと末尾に生成用の装飾が付くことがあるので、
+        # user だけ違う 2 通りの共通部分を「system 部分の生プロンプト」とみなす
+        a = await llama_apply_template(session, self.llama_base, [{"role": "system", "content": system}, {"role": "user", "content": "a"}])
+        b = await llama_apply_template(session, self.llama_base, [{"role": "system", "content": system}, {"role": "user", "content": "b"}])
+        return common_prefix([a, b])
+
+    async def snapshot_prefix(self, session: ClientSession, name: str, system: str) -> bool:
+        """
+        空いている slot で prefix だけ prefill して保存する。空きが無い（/slots が取れない場合も含む）なら False
+        """
+        if not self.model_hash:
+            return True
+        idle = await llama_idle_slots(session, self.llama_base, self.reserved)
+        if not idle:
+            return False
+        slot = idle[-1]
+        prompt = await self._prefix_prompt(session, system)
+        filename = f"hot-{name}-{self.model_hash}.bin"
+
+        pre = await llama_prefill(session, self.llama_base, prompt, id_slot=slot)
+        saved = await llama_slot_action(session, self.llama_base, slot, "save", filename)
+
+        self.entries[self._key(name, self.model_hash)] = {
+            "name": name,
+            "system": system,
+            "model_hash": self.model_hash,
+            "filename": filename,
+            "n_tokens": saved.get("n_saved"),
+            "cold_prefill_ms": pre["wall_ms"],
+            "restore_ms": None,
+            "saved_at": time.time(),
+        }
+        self.save()
+        print(
+            f"[slots] saved {filename} from slot {slot} tokens={saved.get('n_saved')} cold_prefill={pre['wall_ms']:.1f}ms",
+            flush=True,
+        )
+        return True
+
+    async def restore_all(self, session: ClientSession) -> None:
+        idle = await llama_idle_slots(session, self.llama_base, self.reserved)
+        if idle is None:
+            # /slots が無い llama-server。戻ってきた直後なので reserved 以外は空とみなす
+            props = await llama_props(session, self.llama_base)
+            idle = [i for i in range(int(props.get("total_slots") or 1)) if i not in self.reserved]
+        # モデルが変わった古いスナップショットは restore_plan で落ちる
+        plan = restore_plan(self.entries, self.model_hash, idle)
+        for e in self.entries.values():
+            e["restored_slot"] = None
+        for slot, e in plan:
+            try:
+                r = await llama_slot_action(session, self.llama_base, slot, "restore", e["filename"])
+            except Exception as ex:
+                print(f"[slots] restore {e['filename']} to slot {slot} failed: {ex}", flush=True)
+                continue
+            e["restore_ms"] = r["wall_ms"]
+            e["restored_slot"] = slot
+            print(
+                f"[slots] restored {e['filename']} to slot {slot}: "
+                f"restore={e['restore_ms']:.1f}ms vs cold prefill={e['cold_prefill_ms']:.1f}ms",
+                flush=True,
+            )
+        skipped = sum(1 for e in self.entries.values() if e.get("model_hash") == self.model_hash) - len(plan)
+        if skipped > 0:
+            print(f"[slots] {skipped} snapshot(s) not restored: only {len(idle)} idle slot(s)", flush=True)
+        self.save()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "model_hash": self.model_hash,
+            "upstream_up": self.upstream_up,
+            "pending": len(self._pending),
+            "entries": {
+                k: {kk: vv for kk, vv in e.items() if kk != "system"}
+                for k, e in self.entries.items()
+            },
+        }
@@ -0,0 +1,44 @@
+# test_request_trace.py
+import json
+
+from request_trace import TRACE_HEADER, SpanFileExporter, start_trace
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_trace_is_written_off_the_caller_and_flushed_on_close(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    exporter = SpanFileExporter(str(path))
+    trace = start_trace(exporter, {TRACE_HEADER: "abc.stage0.1"}, "stage0", "local", "/v1/chat/completions")
+    for name in ("upstream_send", "upstream_headers", "first_chunk"):
+        trace.mark(name)
+    trace.finish(timings={"prompt_ms": 5.0, "prompt_n": 3}, status=200)
+    exporter.close()
+
+    spans = read_lines(path)
+    assert [s["name"] for s in spans] == ["proxy.queue", "proxy.connect", "proxy.ttft", "proxy.relay", "llama.prefill"]
+    assert all(s["trace"] == "abc" and s["req"] == "abc.stage0.1" for s in spans)
+    assert exporter.exported == 5
+
+
+def test_no_trace_without_header_or_exporter(tmp_path):
+    exporter = SpanFileExporter(str(tmp_path / "spans.jsonl"))
+    assert start_trace(exporter, {}, "stage0", "local", "/x") is None
+    assert start_trace(None, {TRACE_HEADER: "abc.stage0.1"}, "stage0", "local", "/x") is None
+    exporter.close()    # 一度も書いていなければスレッドも無い
+    assert not (tmp_path / "spans.jsonl").exists()
+
+
+def test_file_rotates_past_max_bytes(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    exporter = SpanFileExporter(str(path), max_bytes=1)
+    exporter.export([{"n": 1}])
+    exporter.close()
+    exporter = SpanFileExporter(str(path), max_bytes=1)
+    exporter.export([{"n": 2}])
+    exporter.close()
+    assert read_lines(path) == [{"n": 2}]
+    assert read_lines(str(path) + ".1") == [{"n": 1}]
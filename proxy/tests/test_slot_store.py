@@ -0,0 +1,115 @@
+# test_slot_store.py
+import asyncio
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from slot_store import SlotSnapshotStore, restore_plan
+
+
+def entry(name, model_hash, saved_at):
+    return {
+        "name": name,
+        "model_hash": model_hash,
+        "filename": f"hot-{name}-{model_hash}.bin",
+        "cold_prefill_ms": 100.0,
+        "restore_ms": None,
+        "saved_at": saved_at,
+    }
+
+
+def entries():
+    return {
+        "a-m1": entry("a", "m1", 10.0),
+        "b-m1": entry("b", "m1", 30.0),
+        "c-m1": entry("c", "m1", 20.0),
+        "d-m0": entry("d", "m0", 99.0),   # 前のモデルのスナップショット
+    }
+
+
+def test_restore_plan_maps_newest_entries_to_distinct_slots():
+    plan = restore_plan(entries(), "m1", [1, 2, 3])
+    assert [(slot, e["name"]) for slot, e in plan] == [(1, "b"), (2, "c"), (3, "a")]
+
+
+def test_restore_plan_drops_oldest_when_slots_run_out():
+    plan = restore_plan(entries(), "m1", [2])
+    assert [(slot, e["name"]) for slot, e in plan] == [(2, "b")]
+    assert restore_plan(entries(), "m1", []) == []
+
+
+def test_restore_plan_skips_other_models():
+    assert [e["name"] for _, e in restore_plan(entries(), "m0", [0, 1])] == ["d"]
+    assert restore_plan(entries(), "m2", [0, 1]) == []
+
+
+def fake_llama(slots, fail=()):
+    """
+    GET /slots と POST /slots/{id}?action=restore だけの llama-server。restore された (slot, filename) を記録する
+    """
+    restored = []
+
+    async def get_slots(request):
+        if slots is None:
+            return web.json_response({"error": "disabled"}, status=501)
+        return web.json_response(slots)
+
+    async def props(request):
+        return web.json_response({"total_slots": 4})
+
+    async def slot_action(request):
+        body = await request.json()
+        slot = int(request.match_info["id"])
+        if body["filename"] in fail:
+            return web.json_response({"error": "file not found"}, status=400)
+        restored.append((slot, body["filename"]))
+        return web.json_response({"id_slot": slot, "n_restored": 10})
+
+    app = web.Application()
+    app.router.add_get("/slots", get_slots)
+    app.router.add_get("/props", props)
+    app.router.add_post("/slots/{id}", slot_action)
+    return app, restored
+
+
+def run_restore(tmp_path, slots, reserved=(0,), fail=()):
+    app, restored = fake_llama(slots, fail)
+
+    async def run():
+        async with TestServer(app) as server:
+            store = SlotSnapshotStore(str(server.make_url("")).rstrip("/"), str(tmp_path), reserved=reserved)
+            store.entries = entries()
+            store.model_hash = "m1"
+            async with ClientSession() as session:
+                await store.restore_all(session)
+            return store
+
+    return asyncio.run(run()), restored
+
+
+def test_restore_all_uses_idle_unreserved_slots(tmp_path):
+    slots = [
+        {"id": 0, "is_processing": False},   # reserved
+        {"id": 1, "is_processing": False},
+        {"id": 2, "is_processing": True},    # 本番が使用中
+        {"id": 3, "is_processing": False},
+    ]
+    store, restored = run_restore(tmp_path, slots)
+    assert restored == [(1, "hot-b-m1.bin"), (3, "hot-c-m1.bin")]
+    assert store.entries["b-m1"]["restored_slot"] == 1
+    assert store.entries["c-m1"]["restored_slot"] == 3
+    assert store.entries["a-m1"]["restored_slot"] is None
+    assert store.entries["d-m0"]["restored_slot"] is None
+
+
+def test_restore_all_continues_after_a_failed_entry(tmp_path):
+    slots = [{"id": i, "state": 0} for i in range(4)]    # 古い llama-server の形式
+    store, restored = run_restore(tmp_path, slots, fail=("hot-b-m1.bin",))
+    assert restored == [(2, "hot-c-m1.bin"), (3, "hot-a-m1.bin")]
+    assert store.entries["b-m1"]["restored_slot"] is None
+    assert store.entries["b-m1"]["restore_ms"] is None
+
+
+def test_restore_all_falls_back_to_props_without_slots_endpoint(tmp_path):
+    store, restored = run_restore(tmp_path, None, reserved=(0, 1))
+    assert restored == [(2, "hot-b-m1.bin"), (3, "hot-c-m1.bin")]
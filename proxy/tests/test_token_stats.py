@@ -0,0 +1,112 @@
+# test_token_stats.py
+import asyncio
+import json
+
+from token_stats import (
+    OpenAISSESniffer,
+    StageTokenMetrics,
+    TokenizeCache,
+    llama_tokenize_cached,
+    prompt_tokens_of,
+)
+
+
+def sse(obj) -> bytes:
+    return ("data: " + json.dumps(obj, ensure_ascii=False) + "\n\n").encode("utf-8")
+
+
+def test_tokenize_cache_counts_hits_and_evicts_lru():
+    cache = TokenizeCache(max_entries=2)
+    assert cache.get("m", "a") is None
+    cache.put("m", "a", [1])
+    cache.put("m", "b", [2])
+    assert cache.get("m", "a") == [1]    # a を最近使ったので b が先に追い出される
+    cache.put("m", "c", [3])
+    assert cache.get("m", "b") is None
+    assert cache.get("m", "a") == [1]
+    assert cache.get("other", "a") is None   # モデルが違えば別のエントリ
+    assert cache.snapshot() == {"entries": 2, "hits": 2, "misses": 3}
+
+
+class _FakeResp:
+    def __init__(self, obj):
+        self.obj = obj
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self, content_type=None):
+        return self.obj
+
+
+class _FakeSession:
+    def __init__(self):
+        self.calls = []
+
+    def post(self, url, json=None):
+        self.calls.append((url, json["content"]))
+        return _FakeResp({"tokens": [ord(c) for c in json["content"]]})
+
+
+def test_llama_tokenize_cached_hits_upstream_once():
+    session = _FakeSession()
+    cache = TokenizeCache()
+
+    async def run():
+        a = await llama_tokenize_cached(session, "http://llama", cache, "abc")
+        b = await llama_tokenize_cached(session, "http://llama", cache, "abc")
+        return a, b
+
+    a, b = asyncio.run(run())
+    assert a == b == [97, 98, 99]
+    assert session.calls == [("http://llama/tokenize", "abc")]
+
+
+def test_sniffer_reads_openai_stream_split_across_chunks():
+    body = (
+        sse({"choices": [{"delta": {"content": "清潔さは"}, "finish_reason": None}]})
+        + sse({"choices": [{"delta": {"content": "？"}, "finish_reason": None}]})
+        + sse({"choices": [{"delta": {}, "finish_reason": "stop"}],
+               "usage": {"prompt_tokens": 42, "completion_tokens": 7}})
+        + b"data: [DONE]\n\n"
+    )
+    sniffer = OpenAISSESniffer()
+    # 行や UTF-8 の途中で切れた chunk でも同じ結果になる
+    for i in range(0, len(body), 5):
+        sniffer.feed(body[i:i + 5])
+    assert sniffer.text == "清潔さは？"
+    assert sniffer.finish_reason == "stop"
+    assert sniffer.prompt_tokens() == 42
+    assert sniffer.completion_tokens() == 7
+
+
+def test_sniffer_reads_native_completion_stream():
+    sniffer = OpenAISSESniffer()
+    sniffer.feed(sse({"content": "1:満足", "stop": False}))
+    sniffer.feed(sse({"content": "", "stop": True, "stop_type": "limit", "tokens_predicted": 16,
+                      "timings": {"prompt_n": 3, "cache_n": 20, "predicted_n": 16}}))
+    assert sniffer.text == "1:満足"
+    assert sniffer.finish_reason == "length"
+    assert sniffer.completion_tokens() == 16
+    # usage.prompt_tokens が無ければ timings の prompt_n + cache_n
+    assert sniffer.prompt_tokens() == 23
+
+
+def test_prompt_tokens_of_prefers_usage():
+    assert prompt_tokens_of({"prompt_tokens": 10}, {"prompt_n": 5}) == 10
+    assert prompt_tokens_of(None, {"prompt_n": 5}) == 5
+    assert prompt_tokens_of({}, {}) is None
+
+
+def test_stage_metrics_average_only_known_counts():
+    m = StageTokenMetrics()
+    m.record("stage0", "llama", 10, 4)
+    m.record("stage0", "llama", None, None)
+    m.record("stage0", "llama", 20, None)
+    st = m.snapshot()["stage0"]
+    assert st["requests"] == 3
+    assert st["prompt_tokens_avg"] == 15
+    assert st["completion_tokens_avg"] == 4
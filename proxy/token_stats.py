@@ -0,0 +1,250 @@
+# proxy/token_stats.py
+import json
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientSession
+
+
+# -----------------------------
+# Tokenize cache
+# -----------------------------
+class TokenizeCache:
+    """
+    llama.cpp /tokenize の結果をメッセージ断片ごとにメモ化する LRU。
+    SYSTEM_PROMPT やステージ定型文は毎回同じなので、2回目以降は upstream を叩かない。
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._items: "OrderedDict[tuple, List[int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model_key: str, text: str) -> Optional[List[int]]:
+        key = (model_key, text)
+        tokens = self._items.get(key)
+        if tokens is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return tokens
+
+    def put(self, model_key: str, text: str, tokens: List[int]) -> None:
+        key = (model_key, text)
+        self._items[key] = tokens
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"entries": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+async def llama_tokenize(session: ClientSession, llama_base: str, text: str) -> List[int]:
+    async with session.post(
+        f"{llama_base}/tokenize",
+        json={"content": text, "add_special": False},
+    ) as resp:
+        obj = await resp.json(content_type=None)
+        tokens = obj.get("tokens") or []
+        return [t if isinstance(t, int) else t.get("id", 0) for t in tokens]
+
+
+async def llama_tokenize_cached(
+    session: ClientSession,
+    llama_base: str,
+    cache: TokenizeCache,
+    text: str,
+) -> List[int]:
+    tokens = cache.get(llama_base, text)
+    if tokens is None:
+        tokens = await llama_tokenize(session, llama_base, text)
+        cache.put(llama_base, text, tokens)
+    return tokens
+
+
+async def count_prompt_tokens_llama(
+    session: ClientSession,
+    llama_base: str,
+    cache: TokenizeCache,
+    messages: List[Dict[str, Any]],
+) -> int:
+    """
+    メッセージ本文ごとに tokenize して合計する（チャットテンプレートの装飾分は含まない）。
+    upstream が usage / timings を返さなかったときの代わりにだけ使う。
+    """
+    total = 0
+    for m in messages or []:
+        content = m.get("content") or ""
+        if not isinstance(content, str) or not content:
+            continue
+        total += len(await llama_tokenize_cached(session, llama_base, cache, content))
+    return total
+
+
+# -----------------------------
+# SSE sniffer（中継しながら本文と usage を拾う）
+# -----------------------------
+class OpenAISSESniffer:
+    """
+    llama.cpp から来た SSE（OpenAI 互換 / ネイティブ /completion）をそのまま中継しつつ、
+    本文・finish_reason・usage/timings だけを横取りする。
+    """
+
+    def __init__(self):
+        self._buf = b""
+        self.text_parts: List[str] = []
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+        self.timings: Optional[Dict[str, Any]] = None
+
+    def feed(self, chunk: bytes) -> None:
+        self._buf += chunk
+        while b"\n" in self._buf:
+            raw_line, self._buf = self._buf.split(b"\n", 1)
+            line = raw_line.rstrip(b"\r").decode("utf-8", errors="ignore")
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if not payload or payload == "[DONE]":
+                continue
+            try:
+                obj = json.loads(payload)
+            except Exception:
+                continue
+            if isinstance(obj, dict):
+                self._on_event(obj)
+
+    def _on_event(self, obj: Dict[str, Any]) -> None:
+        if isinstance(obj.get("usage"), dict):
+            self.usage = obj["usage"]
+        if isinstance(obj.get("timings"), dict):
+            self.timings = obj["timings"]
+        # llama.cpp ネイティブ /completion 形式
+        if isinstance(obj.get("content"), str) and "choices" not in obj:
+            self.text_parts.append(obj["content"])
+            if obj.get("stop"):
+                self.finish_reason = "length" if obj.get("stop_type") == "limit" else "stop"
+                if isinstance(obj.get("tokens_predicted"), int):
+                    self.usage = dict(self.usage or {}, completion_tokens=obj["tokens_predicted"])
+            return
+        choices = obj.get("choices") or []
+        if not choices:
+            return
+        ch0 = choices[0] or {}
+        delta = ch0.get("delta") or {}
+        if isinstance(delta, dict) and isinstance(delta.get("content"), str):
+            self.text_parts.append(delta["content"])
+        if ch0.get("finish_reason"):
+            self.finish_reason = ch0["finish_reason"]
+
+    @property
+    def text(self) -> str:
+        return "".join(self.text_parts)
+
+    def prompt_tokens(self) -> Optional[int]:
+        return prompt_tokens_of(self.usage, self.timings)
+
+    def completion_tokens(self) -> Optional[int]:
+        if self.usage and isinstance(self.usage.get("completion_tokens"), int):
+            return self.usage["completion_tokens"]
+        if self.timings and isinstance(self.timings.get("predicted_n"), int):
+            return self.timings["predicted_n"]
+        return None
+
+
+def prompt_tokens_of(usage: Optional[Dict[str, Any]], timings: Optional[Dict[str, Any]]) -> Optional[int]:
+    """
+    llama.cpp が返すプロンプトのトークン数（テンプレート適用後）。
+    usage.prompt_tokens が無ければ timings の prompt_n（今回評価した分）+ cache_n（キャッシュから再利用した分）
+    """
+    if usage and isinstance(usage.get("prompt_tokens"), int):
+        return usage["prompt_tokens"]
+    if timings and isinstance(timings.get("prompt_n"), int):
+        cache_n = timings.get("cache_n")
+        return timings["prompt_n"] + (cache_n if isinstance(cache_n, int) else 0)
+    return None
+
+
+def usage_from_llama_response(obj: Dict[str, Any]) -> Dict[str, Optional[int]]:
+    usage = obj.get("usage") or {}
+    timings = obj.get("timings") or {}
+    return {
+        "prompt_tokens": prompt_tokens_of(usage, timings),
+        "completion_tokens": usage.get("completion_tokens", timings.get("predicted_n")),
+    }
+
+
+def usage_from_gemini(obj: Dict[str, Any]) -> Dict[str, Optional[int]]:
+    meta = obj.get("usageMetadata") or {}
+    completion = meta.get("candidatesTokenCount")
+    if isinstance(completion, int) and isinstance(meta.get("thoughtsTokenCount"), int):
+        completion += meta["thoughtsTokenCount"]
+    return {
+        "prompt_tokens": meta.get("promptTokenCount"),
+        "completion_tokens": completion,
+    }
+
+
+# -----------------------------
+# Per-stage metrics
+# -----------------------------
+class StageTokenMetrics:
+    """
+    ステージ（X-SLM-Stage ヘッダ）ごとのトークン数集計。/metrics で JSON として返す。
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, Any]] = {}
+
+    def record(
+        self,
+        stage: str,
+        backend: str,
+        prompt_tokens: Optional[int],
+        completion_tokens: Optional[int],
+    ) -> None:
+        st = self.stages.setdefault(
+            stage,
+            {
+                "requests": 0,
+                # 件数が分かったリクエスト数（平均の分母）
+                "prompt_tokens_n": 0,
+                "completion_tokens_n": 0,
+                "prompt_tokens_total": 0,
+                "completion_tokens_total": 0,
+                "prompt_tokens_last": None,
+                "completion_tokens_last": None,
+                "backend": backend,
+            },
+        )
+        st["requests"] += 1
+        st["backend"] = backend
+        if prompt_tokens is not None:
+            st["prompt_tokens_n"] += 1
+            st["prompt_tokens_total"] += prompt_tokens
+            st["prompt_tokens_last"] = prompt_tokens
+        if completion_tokens is not None:
+            st["completion_tokens_n"] += 1
+            st["completion_tokens_total"] += completion_tokens
+            st["completion_tokens_last"] = completion_tokens
+
+    def snapshot(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        for stage, st in self.stages.items():
+            np_, nc = st["prompt_tokens_n"], st["completion_tokens_n"]
+            out[stage] = dict(
+                st,
+                prompt_tokens_avg=st["prompt_tokens_total"] / np_ if np_ else None,
+                completion_tokens_avg=st["completion_tokens_total"] / nc if nc else None,
+            )
+        return out
+
+
+def print_token_usage(stage: str, backend: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    print(
+        f"[tokens] stage={stage} backend={backend} prompt={prompt_tokens} completion={completion_tokens}",
+        flush=True,
+    )
@@ -0,0 +1,92 @@
+# bench_cascade.py
+"""
+カスケード（いつもの小さいモデル → 検査に落ちたら CASCADE_TIERS の大きいモデル）を、
+同じ入力で「常に最後の tier を使う」場合と比べる。
+
+各試行で全 tier を1回ずつ呼び、cascade.validate_output の合否から
+「カスケードならどこで止まったか・何 ms かかったか」を組み立てるので、両者を同じ出力で比べられる。
+
+例:
+  python bench_cascade.py --n 10
+  python bench_cascade.py --n 20 --stages stage0 --tier large=http://127.0.0.1:8081/v1/chat/completions
+"""
+import argparse
+import time
+
+from bench_constrained import STAGE_CEILING, STAGE_VALUES
+from cascade import ModelCascade, validate_output
+from config import CASCADE_TIERS
+from llm_client import chat_completion_ex
+from max_tokens_predictor import quantile
+from prompts import build_stage_messages
+from state_machine import sampling_from_knobs
+
+FOCUS = STAGE_VALUES["stage0"]["focus"]
+
+
+def run_tier(client, stage: str, params: dict):
+    t0 = time.perf_counter()
+    res = chat_completion_ex(
+        build_stage_messages(stage, STAGE_VALUES[stage]),
+        temperature=params["temperature"],
+        top_p=params["top_p"],
+        top_k=params["top_k"],
+        repeat_penalty=params["repeat_penalty"],
+        max_tokens=STAGE_CEILING[stage],
+        print_stream=False,
+        stage=stage,
+        client=client,
+    )
+    ms = (time.perf_counter() - t0) * 1000.0
+    reason = validate_output(stage, res.text, FOCUS, STAGE_VALUES[stage].get("prev_question"))
+    return ms, reason
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--n", type=int, default=5, help="ステージごとの試行回数")
+    p.add_argument("--stages", default="stage0,stage1,stage2")
+    p.add_argument("--tier", action="append", default=[], help="名前=URL（複数可。省略時は config.CASCADE_TIERS）")
+    p.add_argument("--temp01", type=float, default=0.5)
+    p.add_argument("--topk01", type=float, default=0.5)
+    args = p.parse_args()
+
+    tiers = [tuple(t.split("=", 1)) for t in args.tier] or CASCADE_TIERS
+    if not tiers:
+        p.error("大きい tier がありません（--tier 名前=URL か config.CASCADE_TIERS）")
+    cascade = ModelCascade(tiers)
+    params = sampling_from_knobs(args.temp01, args.topk01)
+
+    rows = []
+    for stage in args.stages.split(","):
+        casc_ms, large_ms, escalated, stop_at, valid = [], [], 0, {}, 0
+        for _ in range(args.n):
+            spent = 0.0
+            stopped = None
+            for i, tier in enumerate(cascade.tiers):
+                ms, reason = run_tier(tier.client, stage, params)
+                if stopped is None:
+                    spent += ms
+                    if reason is None or i == len(cascade.tiers) - 1:
+                        stopped = tier.name
+                        valid += int(reason is None)
+                if i == len(cascade.tiers) - 1:
+                    large_ms.append(ms)
+            casc_ms.append(spent)
+            escalated += int(stopped != cascade.tiers[0].name)
+            stop_at[stopped] = stop_at.get(stopped, 0) + 1
+        rows.append((stage, casc_ms, large_ms, escalated, stop_at, valid))
+
+    print(f"\n{'stage':<7} {'n':>4} {'escalated':>10} {'valid':>6} {'casc_avg':>9} {'large_avg':>10} {'saved_avg':>10} {'casc_p95':>9}  stop_at")
+    for stage, casc_ms, large_ms, escalated, stop_at, valid in rows:
+        n = len(casc_ms)
+        ca = sum(casc_ms) / n
+        la = sum(large_ms) / n
+        print(
+            f"{stage:<7} {n:>4} {escalated * 100 // n:>9}% {valid * 100 // n:>5}% {ca:>9.1f} {la:>10.1f} {la - ca:>10.1f} "
+            f"{quantile(casc_ms, 0.95):>9.1f}  {stop_at}"
+        )
+
+
+if __name__ == "__main__":
+    main()
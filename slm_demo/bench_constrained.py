@@ -0,0 +1,77 @@
+# bench_constrained.py
+"""
+ステージごとに、制約なし / GBNF / JSON schema で同じプロンプトを N 回生成し、
+書式の妥当率（constrained.py のパーサで Question / Thanks に読めた割合）と平均出力トークン数を比べる。
+
+例:
+  python bench_constrained.py --n 20
+  python bench_constrained.py --n 20 --modes none,gbnf --early-stop
+"""
+import argparse
+import time
+
+import constrained
+from llm_client import chat_completion_ex
+from prompts import build_stage_messages
+from state_machine import sampling_from_knobs
+from config import MAX_TOKENS_STAGE1, MAX_TOKENS_STAGE2
+
+SAMPLE_Q1 = "トイレの清潔さはいかがでしたか？\n1:満足した 2:普通だった 3:気になった"
+
+STAGE_VALUES = {
+    "stage0": {"focus": "清潔さ", "temp01": 0.5},
+    "stage1": {"satisfaction": "3", "prev_question": SAMPLE_Q1, "temp01": 0.5},
+    "stage2": {"satisfaction": "3", "reason": "2", "temp01": 0.5},
+}
+STAGE_CEILING = {"stage0": MAX_TOKENS_STAGE1, "stage1": MAX_TOKENS_STAGE1, "stage2": MAX_TOKENS_STAGE2}
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--n", type=int, default=10, help="ステージ × モードごとの試行回数")
+    p.add_argument("--modes", default="none,gbnf,json")
+    p.add_argument("--stages", default="stage0,stage1,stage2")
+    p.add_argument("--temp01", type=float, default=0.5)
+    p.add_argument("--topk01", type=float, default=0.5)
+    p.add_argument("--early-stop", action="store_true", help="完結検出による早期終了も有効にする")
+    args = p.parse_args()
+
+    params = sampling_from_knobs(args.temp01, args.topk01)
+    stats = constrained.ConstraintStats()
+    elapsed = {}
+
+    for stage in args.stages.split(","):
+        for mode in args.modes.split(","):
+            m = None if mode == "none" else mode
+            t0 = time.perf_counter()
+            for _ in range(args.n):
+                try:
+                    res = chat_completion_ex(
+                        build_stage_messages(stage, STAGE_VALUES[stage]),
+                        temperature=params["temperature"],
+                        top_p=params["top_p"],
+                        top_k=params["top_k"],
+                        repeat_penalty=params["repeat_penalty"],
+                        max_tokens=STAGE_CEILING[stage],
+                        print_stream=False,
+                        stage=stage,
+                        early_stop=args.early_stop,
+                        constraint=constrained.constraint_for(stage, m),
+                    )
+                except Exception as e:
+                    print(f"[{stage}/{mode}] error: {e}", flush=True)
+                    stats.record(stage, m, False, None)
+                    continue
+                parsed = constrained.parse_output(stage, res.text, m)
+                stats.record(stage, m, parsed is not None, res.completion_tokens)
+            elapsed[f"{stage}/{mode}"] = (time.perf_counter() - t0) * 1000.0 / max(1, args.n)
+
+    print(f"\n{'stage/mode':<16} {'n':>4} {'valid':>7} {'avg_tok':>8} {'avg_ms':>8}")
+    for key, row in stats.snapshot().items():
+        valid = f"{row['valid_rate'] * 100:.0f}%" if row["valid_rate"] is not None else "-"
+        tok = f"{row['avg_tokens']:.1f}" if row["avg_tokens"] is not None else "-"
+        print(f"{key:<16} {row['n']:>4} {valid:>7} {tok:>8} {elapsed.get(key, 0.0):>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
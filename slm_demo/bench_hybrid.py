@@ -0,0 +1,85 @@
+# bench_hybrid.py
+"""
+full 生成（質問と3択をすべて LLM が書く）と stem 生成（LLM は1文だけ、選択肢は定型から組み立て）を
+同じ入力で N 回ずつ実行し、ステージごとの出力トークン数・TTFT・完了までの時間・表示形式の妥当率を比べる。
+
+例:
+  python bench_hybrid.py --n 10
+  python bench_hybrid.py --n 20 --stages stage1
+"""
+import argparse
+import time
+
+import constrained
+from bench_constrained import STAGE_CEILING, STAGE_VALUES
+from config import GENERATION_STEM_MAX_TOKENS
+from llm_client import chat_completion_ex
+from max_tokens_predictor import quantile
+from prompts import assemble_stage_text, build_stage_messages, build_stem_messages
+from state_machine import sampling_from_knobs
+
+FOCUS = STAGE_VALUES["stage0"]["focus"]
+
+
+def run_once(mode: str, stage: str, params: dict):
+    values = STAGE_VALUES[stage]
+    if mode == "full":
+        messages, llm_stage, max_tokens = build_stage_messages(stage, values), stage, STAGE_CEILING[stage]
+    else:
+        messages, llm_stage, max_tokens = build_stem_messages(stage, values), f"{stage}_stem", GENERATION_STEM_MAX_TOKENS
+    t0 = time.perf_counter()
+    res = chat_completion_ex(
+        messages,
+        temperature=params["temperature"],
+        top_p=params["top_p"],
+        top_k=params["top_k"],
+        repeat_penalty=params["repeat_penalty"],
+        max_tokens=max_tokens,
+        print_stream=False,
+        stage=llm_stage,
+    )
+    total_ms = (time.perf_counter() - t0) * 1000.0
+    text = res.text if mode == "full" else assemble_stage_text(stage, res.text, values, FOCUS)
+    valid = constrained.parse_output(stage, text) is not None
+    tokens = res.completion_tokens if res.completion_tokens is not None else len(res.text)
+    return tokens, res.ttft_ms, total_ms, valid, text
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--n", type=int, default=5, help="ステージ × モードごとの試行回数")
+    p.add_argument("--modes", default="full,stem")
+    p.add_argument("--stages", default="stage0,stage1,stage2")
+    p.add_argument("--temp01", type=float, default=0.5)
+    p.add_argument("--topk01", type=float, default=0.5)
+    p.add_argument("--show", action="store_true", help="最後の出力を表示する")
+    args = p.parse_args()
+
+    params = sampling_from_knobs(args.temp01, args.topk01)
+    rows = []
+    for stage in args.stages.split(","):
+        for mode in args.modes.split(","):
+            toks, ttfts, totals, valid = [], [], [], 0
+            text = ""
+            for _ in range(args.n):
+                n, ttft, total, ok, text = run_once(mode, stage, params)
+                toks.append(n)
+                if ttft is not None:
+                    ttfts.append(ttft)
+                totals.append(total)
+                valid += int(ok)
+            rows.append((stage, mode, toks, ttfts, totals, valid))
+            if args.show:
+                print(f"--- {stage}/{mode}\n{text}")
+
+    print(f"\n{'stage':<7} {'mode':<5} {'n':>4} {'avg_tok':>8} {'ttft_p50':>9} {'total_p50':>10} {'total_p95':>10} {'valid':>6}")
+    for stage, mode, toks, ttfts, totals, valid in rows:
+        print(
+            f"{stage:<7} {mode:<5} {len(totals):>4} {sum(toks) / max(1, len(toks)):>8.1f} "
+            f"{quantile(ttfts, 0.5) if ttfts else 0.0:>9.1f} {quantile(totals, 0.5):>10.1f} {quantile(totals, 0.95):>10.1f} "
+            f"{valid * 100 // max(1, len(totals)):>5}%"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# bench_inproc.py
+"""
+同じプロンプト・同じサンプリング設定で、HTTP 経路（llama-server → proxy → llm_client）と
+プロセス内の llama-cpp-python（llm_inproc.py）の TTFT と tokens/s を比べる。
+
+inproc 側は SLM_INPROC_MODEL に llama-server と同じ gguf を指定する。
+llama-server と同時に動かすと CPU を取り合うので、片方ずつ測るなら --backends で絞る。
+
+例:
+  SLM_INPROC_MODEL=~/models/qwen2.5-0.5b-instruct-q4_k_m.gguf python bench_inproc.py --n 10
+  python bench_inproc.py --backends http --n 10
+"""
+import argparse
+
+from llm_client import chat_completion_ex
+from prompts import build_stage_messages
+from state_machine import sampling_from_knobs
+from stream_sinks import MetricsSink
+from bench_constrained import STAGE_CEILING, STAGE_VALUES
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--n", type=int, default=5, help="ステージ × backend ごとの試行回数")
+    p.add_argument("--backends", default="http,inproc")
+    p.add_argument("--stages", default="stage0,stage1,stage2")
+    p.add_argument("--temp01", type=float, default=0.5)
+    p.add_argument("--topk01", type=float, default=0.5)
+    p.add_argument("--no-early-stop", action="store_true")
+    args = p.parse_args()
+
+    params = sampling_from_knobs(args.temp01, args.topk01)
+    results = {}
+    for backend in args.backends.split(","):
+        if backend == "inproc":
+            from llm_inproc import get_inproc
+
+            get_inproc().load()
+        metrics = MetricsSink()
+        for stage in args.stages.split(","):
+            # 1回目はキャッシュが温まっていないので捨てる
+            for i in range(args.n + 1):
+                chat_completion_ex(
+                    build_stage_messages(stage, STAGE_VALUES[stage]),
+                    temperature=params["temperature"],
+                    top_p=params["top_p"],
+                    top_k=params["top_k"],
+                    repeat_penalty=params["repeat_penalty"],
+                    max_tokens=STAGE_CEILING[stage],
+                    print_stream=False,
+                    stage=stage,
+                    sinks=[metrics] if i > 0 else (),
+                    early_stop=not args.no_early_stop,
+                    backend=backend,
+                )
+        results[backend] = metrics.snapshot()
+
+    print(f"\n{'backend':<8} {'stage':<7} {'n':>4} {'ttft_p50':>9} {'ttft_p95':>9} {'total_p50':>10} {'tok/s_p50':>10}")
+    for backend, snap in results.items():
+        for stage, row in snap.items():
+            print(
+                f"{backend:<8} {stage:<7} {row['n']:>4} {row['ttft_ms_p50'] or 0:>9.1f} {row['ttft_ms_p95'] or 0:>9.1f} "
+                f"{row['total_ms_p50'] or 0:>10.1f} {row['tokens_per_s_p50'] or 0:>10.1f}"
+            )
+    if "inproc" in results:
+        from llm_inproc import get_inproc
+
+        print(f"\ninproc model load: {get_inproc().load_ms:.0f} ms（起動時に1回だけ）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# bench_rollup.py
+"""
+合成セッションを大量に作り、集計（rollup）の作り直し・追記・期間集計の速さを生データの走査と比べる。
+
+例:
+  python bench_rollup.py --n 1000000
+  python bench_rollup.py --n 3000000 --days 365 --queries 50
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import feedback_rollup
+from feedback_rollup import RollupIndex
+from feedback_store import SCHEMA
+from state_machine import FOCUS_LIST
+
+
+def synth_rows(n: int, days: int, seed: int = 0):
+    rng = random.Random(seed)
+    t_end = time.time()
+    t_start = t_end - days * 86400.0
+    for _ in range(n):
+        sat = rng.choice((1, 1, 2, 2, 2, 3))
+        yield (
+            rng.uniform(t_start, t_end),
+            rng.choice(FOCUS_LIST),
+            sat,
+            rng.randint(1, 3),
+            rng.random(),
+            rng.random(),
+        )
+
+
+def _ms(t0: float) -> float:
+    return (time.perf_counter() - t0) * 1000.0
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--n", type=int, default=1_000_000, help="合成セッション数")
+    p.add_argument("--days", type=int, default=180)
+    p.add_argument("--queries", type=int, default=20, help="ランダムな期間集計の回数")
+    p.add_argument("--incremental", type=int, default=50_000, help="追記経路（50件バッチの upsert）で測る件数")
+    p.add_argument("--db", default=None, help="省略時は一時ファイル")
+    args = p.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="rollup_bench_"), "feedback.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    feedback_rollup.ensure_schema(conn)
+    print(f"db={path} n={args.n:,} days={args.days}")
+
+    t0 = time.perf_counter()
+    with conn:
+        conn.executemany(
+            "INSERT INTO sessions (ts, focus, satisfaction, reason, temp01, topk01) VALUES (?, ?, ?, ?, ?, ?)",
+            synth_rows(args.n, args.days),
+        )
+    print(f"insert raw            {_ms(t0):>10.0f} ms")
+
+    t0 = time.perf_counter()
+    n_rows = feedback_rollup.recompute(conn)
+    ms = _ms(t0)
+    print(f"recompute (backfill)  {ms:>10.0f} ms  rollup_rows={n_rows:,}  {args.n / (ms / 1000.0):,.0f} sessions/s")
+
+    t0 = time.perf_counter()
+    idx = RollupIndex.load(conn)
+    print(f"load index            {_ms(t0):>10.0f} ms  {idx.snapshot()}")
+
+    # 追記経路: FeedbackStore と同じく 50 件ずつ 1 トランザクションで upsert（別の DB に書いて本体は汚さない）
+    inc = sqlite3.connect(":memory:")
+    feedback_rollup.ensure_schema(inc)
+    batch = []
+    t0 = time.perf_counter()
+    for ts, focus, sat, reason, temp01, topk01 in synth_rows(args.incremental, args.days, seed=1):
+        batch.append(feedback_rollup.rollup_row(ts, focus, sat, reason, temp01, topk01))
+        if len(batch) >= 50:
+            with inc:
+                feedback_rollup.apply_batch(inc, batch)
+            batch = []
+    ms = _ms(t0)
+    print(f"incremental upsert    {ms:>10.0f} ms  {args.incremental / (ms / 1000.0):,.0f} sessions/s (batch=50)")
+
+    # 期間集計: 観点 × 満足度
+    rng = random.Random(2)
+    t_end = time.time()
+    ranges = []
+    for _ in range(args.queries):
+        a = t_end - rng.uniform(1, args.days) * 86400.0
+        b = a + rng.uniform(1, args.days / 2) * 86400.0
+        # バケット境界にそろえて生データ側と同じ範囲にする
+        ranges.append((a // 3600 * 3600, b // 3600 * 3600))
+
+    t0 = time.perf_counter()
+    raw = []
+    for a, b in ranges:
+        rows = conn.execute(
+            "SELECT focus, satisfaction, COUNT(*) FROM sessions WHERE ts >= ? AND ts < ? GROUP BY 1, 2", (a, b)
+        ).fetchall()
+        raw.append({(f, s): n for f, s, n in rows})
+    raw_ms = _ms(t0) / len(ranges)
+
+    t0 = time.perf_counter()
+    fast = [idx.count(a, b, group_by=("focus", "satisfaction")) for a, b in ranges]
+    idx_ms = _ms(t0) / len(ranges)
+
+    same = all(r == f for r, f in zip(raw, fast))
+    print(f"\n{'range query':<22} {'ms/query':>10}")
+    print(f"{'raw scan (SQL)':<22} {raw_ms:>10.2f}")
+    print(f"{'RollupIndex':<22} {idx_ms:>10.3f}   x{raw_ms / max(idx_ms, 1e-6):,.0f}  results_match={same}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
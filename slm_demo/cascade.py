@@ -0,0 +1,127 @@
+# cascade.py
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from config import CASCADE_BASE_NAME, CASCADE_TIERS
+from constrained import parse_question, parse_thanks
+from llm_client import LLMClient
+from max_tokens_predictor import quantile
+
+# 日本語の文面に出てよい文字（かな・漢字・全角記号・ASCII の数字と記号・空白）。英字や他の文字体系が出たら不合格
+_ALLOWED_RE = re.compile(r"[　-〿぀-ゟ゠-ヿ一-鿿＀-￯0-9\s!-/:-@\[-`{-~…・]+")
+# Q1 から拾う「名詞らしい」語（漢字・カタカナの2文字以上の連なり）
+_NOUN_RE = re.compile(r"[一-鿿゠-ヿ]{2,}")
+
+
+def validate_output(stage: str, text: str, focus: Optional[str] = None, prev_question: Optional[str] = None) -> Optional[str]:
+    """
+    表示してよい出力なら None、だめなら理由（"format" / "focus" / "language"）を返す。
+
+    - Q1/Q2: 「質問？ 1: 2: 3:」の3択がそろっている
+    - Q1 は質問文に観点の語をそのまま含む。Q2 は観点か、Q1 の漢字・カタカナ語のどれかを含む（プロンプトの「名詞を再利用」）
+    - THANKS: 選択肢も質問もない文
+    - どれも日本語だけ（英字などが混じっていない）
+    """
+    text = (text or "").strip()
+    if stage in ("stage0", "stage1"):
+        q = parse_question(text)
+        if q is None:
+            return "format"
+        words = [focus] if focus else []
+        if stage == "stage1" and prev_question:
+            prev = parse_question(prev_question)
+            words += _NOUN_RE.findall(prev.question if prev is not None else prev_question)
+        if words and not any(w in q.question for w in words):
+            return "focus"
+    elif parse_thanks(text) is None:
+        return "format"
+    if _ALLOWED_RE.fullmatch(text) is None:
+        return "language"
+    return None
+
+
+class _Tier:
+    __slots__ = ("name", "client", "ms")
+
+    def __init__(self, name: str, url: Optional[str]):
+        self.name = name
+        # 先頭はいつもの経路（client=None）。上位 tier は別の proxy（別の llama-server / --backend gemini）へつなぐ
+        self.client = LLMClient(url, uds_path=None) if url else None
+        self.ms: Dict[str, List[float]] = {}
+
+
+class ModelCascade:
+    """
+    速い（小さい）モデルから順に試し、出力が validate_output を通らなければ次の tier へ上げる。
+
+    - 先頭の tier はいつもの経路（LLAMA_URL の proxy / inproc / 事前トークナイズ）。CASCADE_TIERS はその上に積む
+      (名前, proxy の chat completions URL) の列で、後ろほど大きい（遅い）
+    - 「常に最後の tier を使った場合」との差は、最後の tier の実測時間（ステージ別 p50）から見積もる
+    """
+
+    def __init__(self, tiers: Sequence[Tuple[str, str]] = CASCADE_TIERS, base_name: str = CASCADE_BASE_NAME, window: int = 200):
+        self.tiers = [_Tier(base_name, None)] + [_Tier(name, url) for name, url in tiers]
+        self.window = window
+        self._lock = threading.Lock()
+        self.stats: Dict[str, dict] = {}
+
+    def _push(self, tier: _Tier, stage: str, ms: float) -> None:
+        xs = tier.ms.setdefault(stage, [])
+        xs.append(ms)
+        if len(xs) > self.window:
+            del xs[: len(xs) - self.window]
+
+    def run(self, stage: str, call: Callable, focus: Optional[str] = None, prev_question: Optional[str] = None):
+        """
+        call(client) -> CompletionResult（client=None はいつもの経路）。合格した最初の結果を返す（全 tier 不合格なら最後の結果）。
+        cancel された結果はそのまま返す。
+        """
+        res = None
+        spent = 0.0
+        for i, tier in enumerate(self.tiers):
+            t0 = time.perf_counter()
+            res = call(tier.client)
+            ms = (time.perf_counter() - t0) * 1000.0
+            spent += ms
+            if res is None or res.cancelled:
+                return res
+            reason = validate_output(stage, res.text, focus, prev_question)
+            last = i == len(self.tiers) - 1
+            with self._lock:
+                self._push(tier, stage, ms)
+                st = self.stats.setdefault(stage, {"calls": 0, "accepted": {}, "rejected": {}, "ms_total": 0.0})
+                if reason is not None:
+                    st["rejected"][f"{tier.name}:{reason}"] = st["rejected"].get(f"{tier.name}:{reason}", 0) + 1
+                if reason is None or last:
+                    st["calls"] += 1
+                    st["accepted"][tier.name] = st["accepted"].get(tier.name, 0) + 1
+                    st["ms_total"] += spent
+            if reason is None:
+                return res
+            if not last:
+                print(f"\n[cascade] {stage}: {tier.name} は不合格（{reason}）→ {self.tiers[i + 1].name}", flush=True)
+        return res
+
+    def snapshot(self) -> dict:
+        out = {}
+        with self._lock:
+            big = self.tiers[-1] if self.tiers else None
+            for stage, st in sorted(self.stats.items()):
+                n = st["calls"]
+                first = st["accepted"].get(self.tiers[0].name, 0) if self.tiers else 0
+                avg = st["ms_total"] / n if n else None
+                big_ms = big.ms.get(stage) if big is not None else None
+                big_p50 = quantile(big_ms, 0.5) if big_ms else None
+                out[stage] = {
+                    "calls": n,
+                    "escalation_rate": round(1.0 - first / n, 3) if n else None,
+                    "accepted": dict(st["accepted"]),
+                    "rejected": dict(st["rejected"]),
+                    "avg_ms": round(avg, 1) if avg is not None else None,
+                    "large_p50_ms": round(big_p50, 1) if big_p50 is not None else None,
+                    # 常に最後の tier を使った場合からの1回あたりの短縮（見積もり）
+                    "saved_ms_avg_est": round(big_p50 - avg, 1) if big_p50 is not None and avg is not None else None,
+                }
+        return out
@@ -1,5 +1,21 @@
 # config.py
+import os
+
 LLAMA_URL = "http://127.0.0.1:18080/v1/chat/completions"
+# proxy のベースURL（/completion, /tokenize 等の llama.cpp 直通 API 用）
+PROXY_BASE = LLAMA_URL.split("/v1/")[0]
+# proxy を --uds で起動している場合はそのパスを入れると TCP の代わりに Unix ドメインソケットで接続する
+# （URL のホスト/ポートは Host ヘッダにだけ使う）
+LLAMA_UDS = os.getenv("SLM_LLAMA_UDS") or None
+# 早期終了で stream を打ち切ったとき、残りをこの秒数だけ読んでみる。その間に終端（[DONE]）まで届けば接続を使い回す
+# （届かなければ接続を閉じて upstream の生成を止める。0 で読まずに閉じる）
+LLM_DRAIN_AFTER_STOP_S = 0.05
+
+# 生成の経路: "http"（proxy 経由。既定）| "inproc"（llama-cpp-python でこのプロセス内にモデルを常駐させる。llm_inproc.py）
+LLM_BACKEND = os.getenv("SLM_LLM_BACKEND", "http")
+INPROC_MODEL_PATH = os.getenv("SLM_INPROC_MODEL") or None   # inproc で読む gguf
+INPROC_N_CTX = 2048
+INPROC_N_THREADS = 4
 
 # 会話履歴（今回のフローは2ターンなので最小でOK）
 HISTORY_TURNS = 2
@@ -8,6 +24,100 @@ HISTORY_TURNS = 2
 MAX_TOKENS_STAGE1 = 512
 MAX_TOKENS_STAGE2 = 512
 
+# Q1/Q2 は「質問 + 1: 2: 3:」、THANKS は締めの一文まで届いたら stream を閉じて upstream の生成を止める（既定は無効）
+EARLY_STOP = False
+EARLY_STOP_THANKS_MAX_SENTENCES = 3   # 締めの一文が無くてもこの文数で打ち切る
+
+# 出力書式の制約付き生成: None（制約なし）| "gbnf"（llama.cpp grammar）| "json"（JSON schema）
+# 出力は constrained.py で Question / Thanks にパースされる
+CONSTRAINED_DECODING = None
+CONSTRAINED_QUESTION_MAX_CHARS = 60
+CONSTRAINED_OPTION_MAX_CHARS = 12
+CONSTRAINED_THANKS_MAX_CHARS = 60
+
+# 生成のしかた: "full"（質問と3択をすべて LLM が書く）| "stem"（LLM は質問文 / お礼の1文だけを書き、
+# 選択肢と締めの一文は prompts の定型から組み立てる。表示形式は full と同じ）
+GENERATION_MODE = "full"
+GENERATION_STEM_MAX_TOKENS = 48
+
+# 小さいモデルから順に試すカスケード。いつもの経路（LLAMA_URL）の出力が書式・観点・日本語のチェックを
+# 通らなければ、ここに並べた proxy へ順に上げる（後ろほど大きい）。空なら無効
+# 例: [("large", "http://127.0.0.1:8081/v1/chat/completions"),   # 大きいモデルの llama-server を前に置いた proxy
+#      ("gemini", "http://127.0.0.1:8082/v1/chat/completions")]  # proxy_server.py --backend gemini
+CASCADE_TIERS = []
+CASCADE_BASE_NAME = "small"
+
+# プロンプトの並べ方: "legacy"（従来の build_stage*_user_prompt をそのまま使う。既定）
+# | "prefix_first"（全ステージ共通の指示を先頭の system にまとめ、可変部分を末尾へ）
+PROMPT_LAYOUT = "legacy"
+
+# 実行時に書き出すファイル（学習済み統計など）の置き場
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "var")
+
+# 来訪者の待ち時間トレース（PIR/ボタン → ノブ読み → 送信 → 最初/最後のトークン → 表示）。集計は trace_summary.py（既定は無効）
+LATENCY_TRACE = False
+LATENCY_TRACE_PATH = os.path.join(STATE_DIR, "latency_trace.bin")
+LATENCY_TRACE_FLUSH_RECORDS = 256   # 表示・ボタン以外ではこの件数たまるまで書かない
+
+# LLM 呼び出しごとの request id を X-SLM-Trace ヘッダで proxy へ送り、クライアント側と proxy 側の span を
+# それぞれ JSON Lines に書く（proxy 側は proxy/var/spans.jsonl）。セッションの waterfall は trace_waterfall.py
+# 既定は無効（呼び出しごとにファイルへ追記する。proxy 側も --trace を付けたときだけ書く）
+SPAN_TRACE = False
+SPAN_TRACE_PATH = os.path.join(STATE_DIR, "spans.jsonl")
+SPAN_TRACE_MAX_BYTES = 32 * 1024 * 1024   # これを超えたら spans.jsonl.1 に回す（1世代だけ残す）
+
+# 終わったセッション（観点・回答・ノブ・生成文・生成時間）を SQLite(WAL) に保存する（feedback_store.py。既定は無効）
+FEEDBACK_STORE = False
+FEEDBACK_DB_PATH = os.path.join(STATE_DIR, "feedback.sqlite3")
+FEEDBACK_QUEUE_MAX = 1000           # 書き込み待ちの上限（超えたら捨てて数える）
+FEEDBACK_BATCH_SIZE = 50            # 1トランザクションでまとめて書く件数
+FEEDBACK_FLUSH_INTERVAL_S = 2.0     # これだけ待ったら件数が少なくても書く
+FEEDBACK_RETENTION_DAYS = 365       # これより古いセッションは削除（0 で無期限）
+# 書き込みと同時に 時間バケット × 観点 × 回答 × ノブバケット の件数を加算する（feedback_rollup.py）
+FEEDBACK_ROLLUP = True
+FEEDBACK_ROLLUP_BUCKET_S = 3600
+
+# 待ち時間の予算（秒）。最初のトークン / 生成完了が間に合わなければ定型文（prompts.template_*）を出す（fallback.py。既定は無効）
+SLO_FALLBACK = False
+SLO_TTFT_S = {"stage0": 5.0, "stage1": 5.0, "stage2": 5.0}
+SLO_TOTAL_S = {"stage0": 15.0, "stage1": 15.0, "stage2": 15.0}
+SLO_RETRY_AFTER_S = 30.0   # 一度外したらこの間は LLM を待たずに定型文。過ぎたら次のステージで LLM を再び試す
+
+# 熱・負荷で動作プロファイルを切り替える（thermal.py）。Pi は温度が上がると周波数を落とし tokens/s が落ちるので、
+# 先行生成を止める → max_tokens を絞る・スレッドを減らす → 小さいモデルへ、の順に軽くする
+THERMAL_CONTROL = False   # 既定は無効
+THERMAL_SENSOR_ROOT = os.getenv("SLM_SENSOR_ROOT", "/")   # シミュレーションでは合成センサファイルを置いたディレクトリ
+THERMAL_INTERVAL_S = 5.0
+THERMAL_TEMP_C = (70.0, 76.0, 81.0)   # CPU 温度がこれを超えるごとに1段重いプロファイルへ
+THERMAL_HYSTERESIS_C = 4.0            # 軽くするのは閾値をこれだけ下回ってから
+THERMAL_FREQ_RATIO = 0.85             # 現在周波数 / 最大周波数 がこれ未満（throttle 中）なら2段目以上
+THERMAL_LOAD_PER_CPU = 1.5            # 1分 loadavg / CPU 数 がこれを超えたら1段目以上
+SESSION_LATENCY_TARGET_S = 8.0        # Q1+Q2+THANKS の生成時間（直近の中央値の合計）の目標
+THERMAL_LATENCY_RELAX = 0.7           # 生成時間が目標のこの割合を下回るまでは、遅さを理由に軽くしたプロファイルを戻さない
+THERMAL_UP_SAMPLES = 2                # 重くする方向は、この回数続けて必要と判断したら切り替える
+THERMAL_DOWN_HOLD_S = 60.0            # 軽くする方向は、この秒数ずっと余裕があれば1段ずつ戻す
+THERMAL_RETRY_S = 600.0               # 生成時間が目標を超えて離れたプロファイルには、この秒数は戻らない（行き来を防ぐ）
+THERMAL_SMALL_MODEL_URL = os.getenv("SLM_SMALL_MODEL_URL")   # 小さいモデルの llama-server を前に置いた proxy
+THERMAL_PROFILES = [
+    {"name": "normal", "pregen": True, "max_tokens_scale": 1.0, "threads": None, "small_model": False},
+    {"name": "warm", "pregen": False, "max_tokens_scale": 1.0, "threads": None, "small_model": False},
+    {"name": "hot", "pregen": False, "max_tokens_scale": 0.75, "threads": 2, "small_model": False},
+    {"name": "critical", "pregen": False, "max_tokens_scale": 0.6, "threads": 2, "small_model": True},
+]
+
+# Q1/Q2 の生成中に押されたボタンを先取りし、残りの生成を打ち切ってそのまま次のステージへ進む
+TYPE_AHEAD = True
+
+# 出力長の予測で max_tokens を絞る（上の MAX_TOKENS_* は上限 & 打ち切り時の再試行値）
+ADAPTIVE_MAX_TOKENS = True
+MAX_TOKENS_PRED_QUANTILE = 0.99   # 観測した出力長のこの分位点を基準にする
+MAX_TOKENS_PRED_MARGIN = 16       # 分位点に足す余裕（トークン）
+MAX_TOKENS_PRED_MIN_SAMPLES = 8   # これ未満の観測数では MAX_TOKENS_* をそのまま使う
+MAX_TOKENS_PRED_FLOOR = 32
+MAX_TOKENS_PRED_WINDOW = 200      # テンプレート×backend ごとに保持する直近の観測数
+MAX_TOKENS_PRED_PATH = os.path.join(STATE_DIR, "max_tokens_stats.json")
+MAX_TOKENS_PRED_SAVE_S = 30.0     # 学習結果を書き出す間隔（生成のたびには書かない。終了時にも書く）
+
 
 # 推論の安定（必要なら固定）
 TOP_P = 0.9
@@ -20,3 +130,38 @@ TEMP_MAX = 1.0
 # “LCDっぽく”短くするための最大文字数（コンソール代替用）
 LCD_LINE_LEN = 20
 LCD_LINES = 4
+
+# 定型プロンプト（SYSTEM_PROMPT / ステージテンプレート）をモデルごとに1回だけトークナイズし、
+# 可変部分だけ毎回トークナイズして llama.cpp /completion にトークン配列で送る（local backend のみ）
+PRETOKENIZED_PROMPTS = False
+
+# 人感センサが反応した時点で Q1 のプロンプトを prefill だけしておく（n_predict=0・cache_prompt。presence_prefill.py）。
+# prefill と本番の Q1 は同じ llama.cpp の slot に固定する（llama-server の --parallel より小さい番号。
+# proxy の --reserved-slot と合わせる）。既定は無効
+PRESENCE_PREFILL = False
+PRESENCE_PREFILL_SLOT = 0
+PRESENCE_PREFILL_WAIT_S = 2.0   # 本番の Q1 を送る前に prefill の完了をこれだけ待つ（追い越すと prefill が無駄になる）
+
+# ボタン待ちの間に次ステージ（Q2 / THANKS）を回答 1/2/3 の全パターンで先行生成する（既定は無効）
+# llama-server を --parallel 3 以上で起動してから有効にすること（そうでないと分岐が直列に処理され、本番の生成を待たせる）
+SPECULATIVE_PREGEN = False
+# 先行生成時のノブ値(0..1)からこれ以上動いていたら先行生成結果を捨てる
+SPECULATION_KNOB_TOLERANCE = 0.02
+
+# 待機中に Q1 を作り置きする（focus × 量子化ノブのバケットごと。既定は無効）
+QUESTION_BANK = False
+QUESTION_BANK_PER_KEY = 2           # キーごとの保持数
+QUESTION_BANK_TTL_S = 6 * 3600      # これより古い作り置きは使わない
+QUESTION_BANK_KNOB_STEPS = 5        # ノブ 0..1 を何段階に量子化するか
+QUESTION_BANK_PATH = os.path.join(STATE_DIR, "question_bank.json")
+
+# asyncio 版 (run_gpio_async.py) のタイムアウト
+ABSENCE_TIMEOUT_S = 20.0    # PIR がこの秒数反応しなければ「立ち去った」とみなして中断
+SESSION_TIMEOUT_S = 180.0   # 1セッションの上限
+
+# 複数キオスク用セッションサーバ (session_server.py)
+SESSION_SERVER_HOST = "127.0.0.1"
+SESSION_SERVER_PORT = 18090
+SESSION_SERVER_MAX_SESSIONS = 5000      # これを超えたら最も古い待機中セッションから捨てる
+SESSION_SERVER_IDLE_TTL_S = 1800.0      # これだけ操作がないセッションは捨てる
+SESSION_SERVER_MAX_INFLIGHT = 3         # 同時に upstream へ投げる生成数（llama-server の --parallel に合わせる）
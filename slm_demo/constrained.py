@@ -0,0 +1,191 @@
+# constrained.py
+import json
+import re
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+from config import (
+    CONSTRAINED_OPTION_MAX_CHARS,
+    CONSTRAINED_QUESTION_MAX_CHARS,
+    CONSTRAINED_THANKS_MAX_CHARS,
+)
+from prompts import THANKS_CLOSING
+
+
+@dataclass
+class Question:
+    question: str
+    options: List[str]      # 必ず3つ（1/2/3 の順）
+
+    def render(self) -> str:
+        return f"{self.question}\n" + " ".join(f"{i}:{o}" for i, o in enumerate(self.options, 1))
+
+
+@dataclass
+class Thanks:
+    text: str
+
+    def render(self) -> str:
+        return self.text
+
+
+Parsed = Union[Question, Thanks]
+
+
+# -----------------------------
+# 制約（llama.cpp の grammar / json_schema にそのまま渡す）
+# -----------------------------
+def question_gbnf(q_max: int = CONSTRAINED_QUESTION_MAX_CHARS, o_max: int = CONSTRAINED_OPTION_MAX_CHARS) -> str:
+    # 質問1行（？で終わる）+ 改行 + 「1:」「2:」「3:」の短い選択肢
+    return f"""\
+root ::= question "\\n" "1:" opt " " "2:" opt " " "3:" opt
+question ::= qchar{{4,{q_max}}} ("？" | "?")
+qchar ::= [^\\n？?:：0-9０-９]
+opt ::= ochar{{1,{o_max}}}
+ochar ::= [^\\n 　:：0-9０-９]
+"""
+
+
+def thanks_gbnf(t_max: int = CONSTRAINED_THANKS_MAX_CHARS) -> str:
+    # 短いお礼1文（任意）+ 締めの一文
+    return f"""\
+root ::= (tchar{{2,{t_max}}} ("。" | "！"))? "{THANKS_CLOSING}"
+tchar ::= [^\\n。！:：0-9０-９]
+"""
+
+
+def question_schema(q_max: int = CONSTRAINED_QUESTION_MAX_CHARS, o_max: int = CONSTRAINED_OPTION_MAX_CHARS) -> dict:
+    return {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string", "minLength": 4, "maxLength": q_max},
+            "options": {
+                "type": "array",
+                "items": {"type": "string", "minLength": 1, "maxLength": o_max},
+                "minItems": 3,
+                "maxItems": 3,
+            },
+        },
+        "required": ["question", "options"],
+    }
+
+
+def thanks_schema(t_max: int = CONSTRAINED_THANKS_MAX_CHARS) -> dict:
+    return {
+        "type": "object",
+        "properties": {"text": {"type": "string", "minLength": 2, "maxLength": t_max + len(THANKS_CLOSING)}},
+        "required": ["text"],
+    }
+
+
+_QUESTION_STAGES = ("stage0", "stage1")
+
+
+def constraint_for(stage: str, mode: Optional[str]) -> Optional[dict]:
+    """
+    リクエストに足すフィールド（{"grammar": ...} / {"json_schema": ...}）。mode=None なら制約なし。
+    """
+    if not mode or stage not in ("stage0", "stage1", "stage2"):
+        return None
+    is_q = stage in _QUESTION_STAGES
+    if mode == "gbnf":
+        return {"grammar": question_gbnf() if is_q else thanks_gbnf()}
+    if mode == "json":
+        return {"json_schema": question_schema() if is_q else thanks_schema()}
+    raise ValueError(f"unknown constraint mode: {mode}")
+
+
+# -----------------------------
+# パース（制約なしの出力にも使い、書式の妥当性を測る）
+# -----------------------------
+_OPT_SPLIT_RE = re.compile(r"([1-3１-３])\s*[:：]\s*")
+
+
+def parse_question(text: str) -> Optional[Question]:
+    """
+    「質問？ 1:a 2:b 3:c」形式（改行・空白の有無は問わない）。3択がそろわなければ None。
+    """
+    text = (text or "").strip()
+    parts = _OPT_SPLIT_RE.split(text)
+    # parts = [質問, "1", a, "2", b, "3", c, ...]
+    if len(parts) < 7:
+        return None
+    labels = [p.translate(str.maketrans("１２３", "123")) for p in parts[1:7:2]]
+    if labels != ["1", "2", "3"] or len(parts) > 7:
+        return None
+    question = parts[0].strip()
+    options = [p.strip() for p in parts[2:7:2]]
+    if not question or not all(options) or "\n" in options[2]:
+        return None
+    if not question.endswith(("？", "?")):
+        return None
+    return Question(question=question, options=options)
+
+
+def parse_thanks(text: str) -> Optional[Thanks]:
+    text = (text or "").strip()
+    if not text or _OPT_SPLIT_RE.search(text) or text.endswith(("？", "?")):
+        return None
+    return Thanks(text=text)
+
+
+def parse_json(stage: str, text: str) -> Optional[Parsed]:
+    try:
+        obj = json.loads(text)
+    except Exception:
+        return None
+    if not isinstance(obj, dict):
+        return None
+    if stage in _QUESTION_STAGES:
+        opts = obj.get("options")
+        q = obj.get("question")
+        if not isinstance(q, str) or not isinstance(opts, list) or len(opts) != 3:
+            return None
+        if not all(isinstance(o, str) and o.strip() for o in opts):
+            return None
+        return Question(question=q.strip(), options=[o.strip() for o in opts])
+    t = obj.get("text")
+    return Thanks(text=t.strip()) if isinstance(t, str) and t.strip() else None
+
+
+def parse_output(stage: str, text: str, mode: Optional[str] = None) -> Optional[Parsed]:
+    if mode == "json":
+        return parse_json(stage, text)
+    if stage in _QUESTION_STAGES:
+        return parse_question(text)
+    return parse_thanks(text)
+
+
+class ConstraintStats:
+    """
+    (stage, mode) ごとの書式妥当率と平均出力トークン数。mode は "none" / "gbnf" / "json"。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows: Dict[tuple, dict] = {}
+
+    def record(self, stage: str, mode: Optional[str], valid: bool, tokens: Optional[int]) -> None:
+        key = (stage, mode or "none")
+        with self._lock:
+            r = self.rows.setdefault(key, {"n": 0, "valid": 0, "tokens": 0, "n_tokens": 0})
+            r["n"] += 1
+            r["valid"] += int(valid)
+            if tokens is not None:
+                r["tokens"] += int(tokens)
+                r["n_tokens"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                f"{stage}/{mode}": {
+                    "n": r["n"],
+                    "valid_rate": r["valid"] / r["n"] if r["n"] else None,
+                    "avg_tokens": (r["tokens"] / r["n_tokens"]) if r["n_tokens"] else None,
+                }
+                for (stage, mode), r in sorted(self.rows.items())
+            }
+
+
+STATS = ConstraintStats()
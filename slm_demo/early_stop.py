@@ -0,0 +1,206 @@
+# early_stop.py
+import re
+import threading
+import time
+from collections import deque
+from typing import Optional, Tuple
+
+from config import EARLY_STOP, EARLY_STOP_THANKS_MAX_SENTENCES
+
+_OPTION_RE = {n: re.compile(rf"[{n}{chr(0xFF10 + n)}]\s*[:：]") for n in (1, 2, 3)}
+_QUESTION_MARKS = ("？", "?")
+_SENTENCE_END_RE = re.compile(r"[。！!？?]")
+_THANKS_CLOSING = "お待ちしております"
+_STEM_END_RE = re.compile(r"[。！!？?]|\n")
+
+
+def question_complete(text: str) -> Optional[int]:
+    """
+    「質問文 + 1: 2: 3:」が揃い、3 の選択肢が改行か句点で閉じたらその位置を返す（未完なら None）。
+    選択肢の中に空白が入ることがある（「少し 気になった」）ので、空白では閉じたとみなさない。
+    """
+    m1 = _OPTION_RE[1].search(text)
+    if m1 is None or not any(q in text[: m1.start()] for q in _QUESTION_MARKS):
+        return None
+    m2 = _OPTION_RE[2].search(text, m1.end())
+    if m2 is None:
+        return None
+    m3 = _OPTION_RE[3].search(text, m2.end())
+    if m3 is None:
+        return None
+
+    i = m3.end()
+    while i < len(text) and text[i] in " 　":
+        i += 1
+    start = i
+    while i < len(text) and text[i] not in "\n。":
+        i += 1
+    if i >= len(text) or i == start:
+        # まだ 3 の選択肢を書いている途中
+        return None
+    return i + 1 if text[i] == "。" else i
+
+
+def thanks_complete(text: str, max_sentences: int = EARLY_STOP_THANKS_MAX_SENTENCES) -> Optional[int]:
+    """
+    締めの一文（…お待ちしております。）か、max_sentences 文目の句点まで来たらその位置を返す。
+    """
+    n = 0
+    prev = 0
+    for m in _SENTENCE_END_RE.finditer(text):
+        n += 1
+        if _THANKS_CLOSING in text[prev: m.end()] or n >= max_sentences:
+            return m.end()
+        prev = m.end()
+    return None
+
+
+def stem_complete(text: str) -> Optional[int]:
+    """
+    1文だけ書かせる stem 生成用。最初の文末記号（か改行）まで来たらその位置を返す。
+    """
+    start = len(text) - len(text.lstrip())
+    m = _STEM_END_RE.search(text, start)
+    if m is None:
+        return None
+    return m.start() if m.group() == "\n" else m.end()
+
+
+_DETECTORS = {
+    "stage0": question_complete,
+    "stage1": question_complete,
+    "stage2": thanks_complete,
+    # GENERATION_MODE = "stem" では stage 名に _stem を付けて呼ぶ
+    "stage0_stem": stem_complete,
+    "stage1_stem": stem_complete,
+    "stage2_stem": stem_complete,
+}
+
+
+class EarlyStopStats:
+    """
+    ステージ別の早期終了回数と、節約できたトークン数・時間の推定値。
+
+    打ち切った後に何トークン出たかは分からないので、同じステージで打ち切らずに終わった stream の長さ
+    （直近 NATURAL_WINDOW 件の中央値）と比べて見積もる。自然に終わった stream が NATURAL_MIN_SAMPLES 件
+    たまるまでは見積もらず、使ったトークン数だけ数える（送った max_tokens との差は上限まで書く前提なので過大になる）。
+    時間はその stream の実測 tokens/s で換算する。
+    """
+
+    NATURAL_WINDOW = 50
+    NATURAL_MIN_SAMPLES = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self._natural = {}
+
+    def natural_length(self, stage: str) -> Optional[float]:
+        with self._lock:
+            xs = sorted(self._natural.get(stage) or ())
+        if len(xs) < self.NATURAL_MIN_SAMPLES:
+            return None
+        return float(xs[len(xs) // 2])
+
+    def record(
+        self,
+        stage: str,
+        early: bool,
+        used: int = 0,
+        saved_tokens: Optional[int] = None,
+        saved_ms: Optional[float] = None,
+    ) -> None:
+        with self._lock:
+            st = self.stages.setdefault(
+                stage,
+                {"calls": 0, "early": 0, "tokens_used": 0, "estimated": 0, "tokens_saved_est": 0, "ms_saved_est": 0.0},
+            )
+            st["calls"] += 1
+            if not early:
+                self._natural.setdefault(stage, deque(maxlen=self.NATURAL_WINDOW)).append(used)
+                return
+            st["early"] += 1
+            st["tokens_used"] += used
+            if saved_tokens is not None:
+                st["estimated"] += 1
+                st["tokens_saved_est"] += saved_tokens
+                st["ms_saved_est"] += saved_ms or 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            out = {}
+            for stage, st in sorted(self.stages.items()):
+                d = dict(st)
+                d["ms_saved_est"] = round(d["ms_saved_est"], 1)
+                d["early_rate"] = (d["early"] / d["calls"]) if d["calls"] else None
+                out[stage] = d
+            return out
+
+
+STATS = EarlyStopStats()
+
+
+class EarlyStop:
+    """
+    1回の stream 用。delta ごとに check() し、完結したら残りを捨てて打ち切るよう返す。
+    """
+
+    def __init__(self, stage: Optional[str], max_tokens: int, verbose: bool = True):
+        self.stage = stage
+        self.max_tokens = int(max_tokens)
+        self.verbose = verbose
+        self.detect = _DETECTORS.get(stage or "")
+        self.stopped = False
+        self._text = ""
+        self._t_first: Optional[float] = None
+        self._n = 0
+
+    def check(self, delta: str) -> Tuple[str, bool]:
+        """
+        (表示してよい delta, 打ち切るか) を返す
+        """
+        if self._t_first is None:
+            self._t_first = time.perf_counter()
+        self._n += 1
+        if self.detect is None:
+            return delta, False
+        before = len(self._text)
+        self._text += delta
+        cut = self.detect(self._text)
+        if cut is None:
+            return delta, False
+        self.stopped = True
+        self._text = self._text[:cut]
+        return delta[: max(0, cut - before)], True
+
+    def finish(self) -> int:
+        """
+        統計を記録して、打ち切り時点のトークン数（chunk 数で近似）を返す。
+        """
+        stage = self.stage or "unknown"
+        if not self.stopped:
+            STATS.record(stage, False, self._n)
+            return self._n
+        natural = STATS.natural_length(stage)
+        if natural is None:
+            STATS.record(stage, True, self._n)
+            if self.verbose:
+                print(f"\n[early-stop] {stage}: {self._n} tok で完結", flush=True)
+            return self._n
+        saved = int(max(0.0, natural - self._n))
+        elapsed = time.perf_counter() - (self._t_first or time.perf_counter())
+        ms_per_tok = (elapsed * 1000.0 / self._n) if self._n else 0.0
+        saved_ms = saved * ms_per_tok
+        STATS.record(stage, True, self._n, saved, saved_ms)
+        if self.verbose:
+            print(
+                f"\n[early-stop] {stage}: {self._n} tok で完結 → 自然終了の中央値 {natural:.0f} tok 比で推定 {saved} tok / {saved_ms:.0f} ms 節約",
+                flush=True,
+            )
+        return self._n
+
+
+def early_stop_for(stage: Optional[str], max_tokens: int, verbose: bool = True) -> Optional[EarlyStop]:
+    if not EARLY_STOP or stage not in _DETECTORS:
+        return None
+    return EarlyStop(stage, max_tokens, verbose)
@@ -0,0 +1,134 @@
+# fallback.py
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from config import SLO_RETRY_AFTER_S, SLO_TOTAL_S, SLO_TTFT_S
+from llm_stream import FirstToken, StreamSink
+
+
+class _FirstTokenSink(StreamSink):
+    def __init__(self, ev: threading.Event):
+        self.ev = ev
+
+    def on_first_token(self, ev: FirstToken) -> None:
+        self.ev.set()
+
+
+class LatencyGuard:
+    """
+    ステージごとの待ち時間の予算（最初のトークンまで / 生成完了まで）を守る。
+
+    - run() は生成を別スレッドで始め、予算内に最初のトークンが来なければ、または完了しなければ cancel して None を返す
+      （呼び出し側は定型文を出す）。例外も同じ扱い
+    - 一度外したら degraded になり、retry_after_s の間は LLM を待たずに即 None を返す（来訪者を毎回待たせない）
+    - retry_after_s を過ぎたら次のステージで LLM をもう一度試し、予算内に返れば degraded を解いて LLM に戻る
+    - preempt（type_ahead.TypeAhead）を渡すと、生成中にボタンが押された時点で cancel して "preempted" を返す（degraded にはしない）
+    """
+
+    def __init__(
+        self,
+        ttft_s: Dict[str, float] = SLO_TTFT_S,
+        total_s: Dict[str, float] = SLO_TOTAL_S,
+        retry_after_s: float = SLO_RETRY_AFTER_S,
+    ):
+        self.ttft_s = ttft_s
+        self.total_s = total_s
+        self.retry_after_s = retry_after_s
+        self._lock = threading.Lock()
+        self._degraded_until = 0.0
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def degraded(self) -> bool:
+        return time.monotonic() < self._degraded_until
+
+    def _record(self, stage: str, key: str) -> None:
+        with self._lock:
+            st = self.stats.setdefault(
+                stage, {"llm": 0, "ttft": 0, "total": 0, "error": 0, "degraded": 0, "recovered": 0, "preempted": 0}
+            )
+            st[key] += 1
+
+    def _trip(self) -> None:
+        with self._lock:
+            self._degraded_until = time.monotonic() + self.retry_after_s
+
+    def _recover(self, stage: str) -> None:
+        with self._lock:
+            was = self._degraded_until > 0.0
+            self._degraded_until = 0.0
+        if was:
+            self._record(stage, "recovered")
+
+    def run(
+        self,
+        stage: str,
+        call: Callable,
+        started: Optional[float] = None,
+        preempt=None,
+    ) -> Tuple[Optional[object], Optional[str]]:
+        """
+        call(cancel, sinks) -> CompletionResult を予算付きで実行する。
+        started（time.monotonic()）を渡すと、そこからの経過時間も予算に含める（先行生成を待った分など）。
+        (結果, None) か (None, 外した理由 "ttft" / "total" / "error" / "degraded") を返す。
+        ボタンで打ち切ったときは (途中までの結果 or None, "preempted")。
+        """
+        if self.degraded:
+            self._record(stage, "degraded")
+            return None, "degraded"
+
+        t0 = started if started is not None else time.monotonic()
+        first = threading.Event()
+        done = threading.Event()
+        cancel = threading.Event()
+        # done は preempt からも起こされるので、本当に終わったかは finished で見る
+        finished = threading.Event()
+        box = {}
+
+        def _worker():
+            try:
+                box["res"] = call(cancel, [_FirstTokenSink(first)])
+            except Exception as e:
+                box["err"] = e
+            finally:
+                finished.set()
+                done.set()
+                first.set()
+
+        threading.Thread(target=_worker, daemon=True).start()
+        if preempt is not None:
+            # 押されたら待ちを起こして生成も止める
+            preempt.arm(first, done, cancel)
+
+        reason = None
+        if not first.wait(max(0.0, t0 + self.ttft_s.get(stage, 10.0) - time.monotonic())):
+            reason = "ttft"
+        elif not done.wait(max(0.0, t0 + self.total_s.get(stage, 30.0) - time.monotonic())):
+            reason = "total"
+        elif "err" in box:
+            reason = "error"
+            print(f"\n[slo] {stage}: {box['err']}", flush=True)
+
+        if preempt is not None and preempt.pressed is not None:
+            cancel.set()
+            # 止めた生成が途中までの結果を返すのを少しだけ待つ（次の chunk で抜ける）
+            finished.wait(0.2)
+            self._record(stage, "preempted")
+            return box.get("res"), "preempted"
+
+        if reason is None:
+            self._recover(stage)
+            self._record(stage, "llm")
+            return box["res"], None
+
+        cancel.set()
+        self._trip()
+        self._record(stage, reason)
+        return None, reason
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            out = {stage: dict(st) for stage, st in sorted(self.stats.items())}
+        out["degraded"] = self.degraded
+        return out
@@ -0,0 +1,204 @@
+# feedback_rollup.py
+import bisect
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import FEEDBACK_ROLLUP_BUCKET_S
+from question_bank import knob_bucket
+
+# 時間バケット × 観点 × 回答 × ノブバケット ごとのセッション数
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup (
+    bucket       INTEGER NOT NULL,   -- ts // FEEDBACK_ROLLUP_BUCKET_S
+    focus        TEXT    NOT NULL,
+    satisfaction INTEGER NOT NULL,   -- 0 = 未回答
+    reason       INTEGER NOT NULL,
+    temp_b       INTEGER NOT NULL,   -- question_bank.knob_bucket と同じ量子化
+    topk_b       INTEGER NOT NULL,
+    n            INTEGER NOT NULL,
+    PRIMARY KEY (bucket, focus, satisfaction, reason, temp_b, topk_b)
+) WITHOUT ROWID;
+"""
+
+_UPSERT = """
+INSERT INTO rollup (bucket, focus, satisfaction, reason, temp_b, topk_b, n) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (bucket, focus, satisfaction, reason, temp_b, topk_b) DO UPDATE SET n = n + excluded.n
+"""
+
+Key = Tuple[str, int, int, int, int]   # (focus, satisfaction, reason, temp_b, topk_b)
+
+
+def rollup_row(ts: float, focus: Optional[str], satisfaction, reason, temp01: float, topk01: float,
+               bucket_s: int = FEEDBACK_ROLLUP_BUCKET_S) -> Tuple[int, Key]:
+    tb, kb = knob_bucket(temp01, topk01)
+    return int(ts // bucket_s), (focus or "", int(satisfaction or 0), int(reason or 0), tb, kb)
+
+
+def ensure_schema(conn: sqlite3.Connection) -> None:
+    conn.executescript(SCHEMA)
+
+
+def apply_batch(conn: sqlite3.Connection, rows: Iterable[Tuple[int, Key]]) -> Dict[Tuple[int, Key], int]:
+    """
+    rollup_row() の列をまとめて加算する（呼び出し側のトランザクション内で。生データと同時に commit される）。
+    同じバッチ内の重複は先に数えてから1回だけ upsert する。加算した内訳を返す。
+    """
+    counts: Dict[Tuple[int, Key], int] = {}
+    for r in rows:
+        counts[r] = counts.get(r, 0) + 1
+    conn.executemany(_UPSERT, [(b,) + key + (n,) for (b, key), n in counts.items()])
+    return counts
+
+
+def recompute(conn: sqlite3.Connection, t0: Optional[float] = None, t1: Optional[float] = None,
+              bucket_s: int = FEEDBACK_ROLLUP_BUCKET_S) -> int:
+    """
+    生データ（sessions）から [t0, t1) の時間バケットを作り直す（取り込み直し・集計ルール変更時のバックフィル用）。
+    1本の INSERT … SELECT … GROUP BY で SQLite 内でまとめて集計する。t0/t1 はバケット境界に丸める。
+    保持期間を過ぎて sessions から消えた期間を指定すると、その期間の集計も消える点に注意。
+    """
+    lo = int(t0 // bucket_s) if t0 is not None else -(1 << 62)
+    hi = int(-(-t1 // bucket_s)) if t1 is not None else (1 << 62)
+    # Python の round() と同じ量子化にするため knob_bucket をそのまま SQL 関数として登録する
+    conn.create_function("tb", 2, lambda t, k: knob_bucket(t or 0.0, k or 0.0)[0], deterministic=True)
+    conn.create_function("kb", 2, lambda t, k: knob_bucket(t or 0.0, k or 0.0)[1], deterministic=True)
+    with conn:
+        conn.execute("DELETE FROM rollup WHERE bucket >= ? AND bucket < ?", (lo, hi))
+        cur = conn.execute(
+            """
+            INSERT INTO rollup (bucket, focus, satisfaction, reason, temp_b, topk_b, n)
+            SELECT CAST(ts / ? AS INTEGER) AS b, COALESCE(focus, ''), COALESCE(satisfaction, 0), COALESCE(reason, 0),
+                   tb(temp01, topk01), kb(temp01, topk01), COUNT(*)
+            FROM sessions
+            WHERE ts >= ? * ? AND ts < ? * ?
+            GROUP BY 1, 2, 3, 4, 5, 6
+            """,
+            (bucket_s, lo, bucket_s, hi, bucket_s),
+        )
+    return cur.rowcount
+
+
+class _Series:
+    """
+    1つのキーの時間バケット列と累積和。範囲の合計は二分探索2回（O(log n)）。
+    バケットは通常単調に増えるので追加は O(1)（過去バケットへの加算だけ O(n)）。
+    """
+
+    __slots__ = ("buckets", "cum")
+
+    def __init__(self):
+        self.buckets: List[int] = []
+        self.cum: List[int] = []       # cum[i] = buckets[0..i] の合計
+
+    def add(self, bucket: int, n: int) -> None:
+        if not self.buckets or bucket > self.buckets[-1]:
+            self.buckets.append(bucket)
+            self.cum.append((self.cum[-1] if self.cum else 0) + n)
+            return
+        i = bisect.bisect_left(self.buckets, bucket)
+        if self.buckets[i] != bucket:
+            self.buckets.insert(i, bucket)
+            self.cum.insert(i, self.cum[i - 1] if i else 0)
+        for j in range(i, len(self.cum)):
+            self.cum[j] += n
+
+    def total(self, lo: int, hi: int) -> int:
+        """
+        bucket in [lo, hi) の合計
+        """
+        a = bisect.bisect_left(self.buckets, lo)
+        b = bisect.bisect_left(self.buckets, hi)
+        if b <= a:
+            return 0
+        return self.cum[b - 1] - (self.cum[a - 1] if a else 0)
+
+
+class RollupIndex:
+    """
+    rollup テーブルのメモリ上の索引。キー（観点 × 回答 × ノブバケット）ごとの累積和を持ち、
+    期間の集計はキー数 × O(log バケット数) で返す（生データの行数には依存しない）。
+
+    - FeedbackStore が commit した分を add_counts() で追従する（ダッシュボード等の別プロセスは load() で読み直す）
+    - キー数は 観点5 × 回答(3+1)^2 × ノブ25 程度で頭打ち
+    """
+
+    def __init__(self, bucket_s: int = FEEDBACK_ROLLUP_BUCKET_S):
+        self.bucket_s = bucket_s
+        self._lock = threading.Lock()
+        self._series: Dict[Key, _Series] = {}
+
+    @classmethod
+    def load(cls, conn: sqlite3.Connection, bucket_s: int = FEEDBACK_ROLLUP_BUCKET_S) -> "RollupIndex":
+        idx = cls(bucket_s)
+        rows = conn.execute(
+            "SELECT bucket, focus, satisfaction, reason, temp_b, topk_b, n FROM rollup ORDER BY bucket"
+        )
+        with idx._lock:
+            for b, focus, sat, reason, tb, kb, n in rows:
+                idx._series.setdefault((focus, sat, reason, tb, kb), _Series()).add(b, n)
+        return idx
+
+    def add_counts(self, counts: Dict[Tuple[int, Key], int]) -> None:
+        with self._lock:
+            for (b, key), n in sorted(counts.items()):
+                self._series.setdefault(key, _Series()).add(b, n)
+
+    def _range(self, t0: Optional[float], t1: Optional[float]) -> Tuple[int, int]:
+        lo = int(t0 // self.bucket_s) if t0 is not None else -(1 << 62)
+        hi = int(-(-t1 // self.bucket_s)) if t1 is not None else (1 << 62)
+        return lo, hi
+
+    def count(self, t0: Optional[float] = None, t1: Optional[float] = None, *, group_by: Tuple[str, ...] = ("satisfaction",),
+              focus: Optional[str] = None, satisfaction: Optional[int] = None,
+              knob: Optional[Tuple[int, int]] = None) -> Dict[tuple, int]:
+        """
+        [t0, t1)（UNIX 秒。バケット境界に丸める）のセッション数を group_by の列ごとに返す。
+        group_by は "focus" / "satisfaction" / "reason" / "knob" の組み合わせ。
+        """
+        lo, hi = self._range(t0, t1)
+        out: Dict[tuple, int] = {}
+        with self._lock:
+            for key, series in self._series.items():
+                f, sat, reason, tb, kb = key
+                if focus is not None and f != focus:
+                    continue
+                if satisfaction is not None and sat != satisfaction:
+                    continue
+                if knob is not None and (tb, kb) != tuple(knob):
+                    continue
+                n = series.total(lo, hi)
+                if not n:
+                    continue
+                dims = {"focus": f, "satisfaction": sat, "reason": reason, "knob": (tb, kb)}
+                g = tuple(dims[c] for c in group_by)
+                out[g] = out.get(g, 0) + n
+        return out
+
+    def satisfaction_by_focus(self, t0: Optional[float] = None, t1: Optional[float] = None) -> Dict[str, Dict[int, int]]:
+        out: Dict[str, Dict[int, int]] = {}
+        for (focus, sat), n in self.count(t0, t1, group_by=("focus", "satisfaction")).items():
+            out.setdefault(focus, {})[sat] = n
+        return out
+
+    def satisfaction_by_knob(self, t0: Optional[float] = None, t1: Optional[float] = None) -> Dict[tuple, Dict[int, int]]:
+        out: Dict[tuple, Dict[int, int]] = {}
+        for (knob, sat), n in self.count(t0, t1, group_by=("knob", "satisfaction")).items():
+            out.setdefault(knob, {})[sat] = n
+        return out
+
+    def hourly(self, t0: float, t1: float, focus: Optional[str] = None) -> List[Tuple[float, Dict[int, int]]]:
+        """
+        [t0, t1) をバケットごとに区切った満足度分布（バケット開始の UNIX 秒, {satisfaction: n}）
+        """
+        lo, hi = self._range(t0, t1)
+        out = []
+        for b in range(lo, hi):
+            dist = {k[0]: n for k, n in self.count(b * self.bucket_s, (b + 1) * self.bucket_s, focus=focus).items()}
+            out.append((b * self.bucket_s, dist))
+        return out
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = sum(s.cum[-1] for s in self._series.values() if s.cum)
+            return {"keys": len(self._series), "sessions": total}
@@ -0,0 +1,265 @@
+# feedback_store.py
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+from config import (
+    FEEDBACK_BATCH_SIZE,
+    FEEDBACK_DB_PATH,
+    FEEDBACK_FLUSH_INTERVAL_S,
+    FEEDBACK_QUEUE_MAX,
+    FEEDBACK_RETENTION_DAYS,
+    FEEDBACK_ROLLUP,
+)
+import feedback_rollup
+from feedback_rollup import RollupIndex
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id           INTEGER PRIMARY KEY,
+    ts           REAL    NOT NULL,   -- セッション開始（UNIX 秒）
+    focus        TEXT,
+    satisfaction INTEGER,
+    reason       INTEGER,
+    temp01       REAL,
+    topk01       REAL,
+    q1           TEXT,
+    q2           TEXT,
+    thanks       TEXT,
+    backend      TEXT,
+    timings      TEXT                -- JSON: ステージごとの生成時間(ms)
+);
+CREATE INDEX IF NOT EXISTS sessions_ts ON sessions(ts);
+"""
+
+_COLUMNS = ("ts", "focus", "satisfaction", "reason", "temp01", "topk01", "q1", "q2", "thanks", "backend", "timings")
+
+
+@dataclass
+class FeedbackRecord:
+    ts: float
+    focus: Optional[str]
+    satisfaction: Optional[str]
+    reason: Optional[str]
+    temp01: float
+    topk01: float
+    q1: Optional[str] = None
+    q2: Optional[str] = None
+    thanks: Optional[str] = None
+    backend: Optional[str] = None
+    timings: dict = field(default_factory=dict)
+
+    def row(self) -> tuple:
+        d = asdict(self)
+        d["satisfaction"] = int(self.satisfaction) if self.satisfaction else None
+        d["reason"] = int(self.reason) if self.reason else None
+        d["timings"] = json.dumps(self.timings, ensure_ascii=False)
+        return tuple(d[c] for c in _COLUMNS)
+
+
+class FeedbackStore:
+    """
+    終わったセッションを SQLite（WAL）に保存する。
+
+    - submit() は上限付きキューに積むだけで戻る（満杯なら捨てて数える。次の来訪者を待たせない）
+    - 書き込みスレッドが batch_size 件か flush_interval_s ごとに1トランザクションでまとめて commit
+    - WAL + synchronous=NORMAL: 電源断でも DB は壊れない（失うのは最後の checkpoint 前の数バッチまで）
+    - commit が失敗したら（SQLITE_BUSY など）間隔を空けて COMMIT_RETRY_S の回数だけやり直し、それでも駄目なら
+      バッチを捨てずに次のバッチの先頭へ戻す（持ち越しは queue_max 件まで。溢れた古い分は dropped に数える）
+    - 書き込みスレッドは start() で起動する（作っただけでは DB を開かない）
+    - close()（atexit でも呼ぶ）はキューを書き切ってから checkpoint する
+    - retention_days より古い行は1時間ごとに削除（0 で無期限）。集計（rollup）は消さない
+    - rollup=True なら同じトランザクションで時間バケット集計も加算し、メモリ上の索引 self.rollup も追従させる
+    """
+
+    COMMIT_RETRY_S = (0.1, 0.5, 2.0)
+
+    def __init__(
+        self,
+        path: str = FEEDBACK_DB_PATH,
+        queue_max: int = FEEDBACK_QUEUE_MAX,
+        batch_size: int = FEEDBACK_BATCH_SIZE,
+        flush_interval_s: float = FEEDBACK_FLUSH_INTERVAL_S,
+        retention_days: float = FEEDBACK_RETENTION_DAYS,
+        rollup: bool = FEEDBACK_ROLLUP,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.queue_max = queue_max
+        self.flush_interval_s = flush_interval_s
+        self.retention_days = retention_days
+        self.use_rollup = rollup
+        self.rollup: Optional[RollupIndex] = None   # 書き込みスレッドが起動時に読み込む
+        self._q: "queue.Queue[Optional[FeedbackRecord]]" = queue.Queue(maxsize=queue_max)
+        self._lock = threading.Lock()
+        self.stats = {"submitted": 0, "dropped": 0, "written": 0, "batches": 0, "errors": 0, "purged": 0, "last_commit_ms": None}
+        self._last_purge = 0.0
+        self._carry: List[FeedbackRecord] = []   # 書けなかったバッチ（次のバッチの先頭に戻す）
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None or self._closed:
+            return
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # -------- 呼び出し側 --------
+    def submit(self, rec: FeedbackRecord) -> bool:
+        if self._closed:
+            return False
+        try:
+            self._q.put_nowait(rec)
+        except queue.Full:
+            with self._lock:
+                self.stats["dropped"] += 1
+            return False
+        with self._lock:
+            self.stats["submitted"] += 1
+        return True
+
+    def close(self, timeout: float = 5.0) -> None:
+        if self._closed:
+            return
+        if self._thread is None:
+            if self._q.empty():
+                self._closed = True
+                return
+            # start() 前に積まれた分も書き切る
+            self.start()
+        self._closed = True
+        try:
+            self._q.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            d = dict(self.stats)
+        d["queued"] = self._q.qsize()
+        return d
+
+    # -------- 書き込みスレッド --------
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        if self.use_rollup:
+            feedback_rollup.ensure_schema(conn)
+        return conn
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[FeedbackRecord]) -> Optional[dict]:
+        conn.executemany(
+            f"INSERT INTO sessions ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+            [r.row() for r in batch],
+        )
+        if not self.use_rollup:
+            return None
+        return feedback_rollup.apply_batch(
+            conn,
+            (feedback_rollup.rollup_row(r.ts, r.focus, r.satisfaction, r.reason, r.temp01, r.topk01) for r in batch),
+        )
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[FeedbackRecord]) -> bool:
+        t0 = time.perf_counter()
+        for attempt in range(len(self.COMMIT_RETRY_S) + 1):
+            try:
+                with conn:
+                    counts = self._write_batch(conn, batch)
+                break
+            except sqlite3.Error as e:
+                # with conn: がロールバック済みなので同じバッチをそのまま書き直せる
+                with self._lock:
+                    self.stats["errors"] += 1
+                if attempt == len(self.COMMIT_RETRY_S):
+                    self._requeue(batch)
+                    print(f"[store] write failed ({len(batch)} rows), kept for the next batch: {e}", flush=True)
+                    return False
+                time.sleep(self.COMMIT_RETRY_S[attempt])
+        if counts and self.rollup is not None:
+            self.rollup.add_counts(counts)
+        with self._lock:
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["last_commit_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+        return True
+
+    def _requeue(self, batch: List[FeedbackRecord]) -> None:
+        self._carry = list(batch) + self._carry
+        over = len(self._carry) - self.queue_max
+        if over > 0:
+            # 持ち越しが上限を超えたら、新しい来訪者の分を残して古い分から捨てる
+            del self._carry[:over]
+            with self._lock:
+                self.stats["dropped"] += over
+
+    def _purge(self, conn: sqlite3.Connection) -> None:
+        if self.retention_days <= 0:
+            return
+        cutoff = time.time() - self.retention_days * 86400.0
+        try:
+            with conn:
+                n = conn.execute("DELETE FROM sessions WHERE ts < ?", (cutoff,)).rowcount
+        except sqlite3.Error as e:
+            print(f"[store] purge failed: {e}", flush=True)
+            return
+        with self._lock:
+            self.stats["purged"] += max(0, n)
+
+    def _writer_loop(self) -> None:
+        try:
+            conn = self.connect()
+        except sqlite3.Error as e:
+            print(f"[store] disabled: {e}", flush=True)
+            self._closed = True
+            return
+        if self.use_rollup:
+            self.rollup = RollupIndex.load(conn)
+
+        done = False
+        while not done:
+            batch, self._carry = self._carry, []
+            deadline = time.monotonic() + self.flush_interval_s
+            while len(batch) < self.batch_size:
+                try:
+                    rec = self._q.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if rec is None:
+                    done = True
+                    break
+                batch.append(rec)
+            if batch:
+                self._commit(conn, batch)
+            if time.time() - self._last_purge > 3600.0:
+                self._last_purge = time.time()
+                self._purge(conn)
+
+        # close(): 残り（持ち越し分も）を書き切り、WAL を本体に反映してから閉じる
+        rest, self._carry = self._carry, []
+        while True:
+            try:
+                rec = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if rec is not None:
+                rest.append(rec)
+        if rest and not self._commit(conn, rest):
+            with self._lock:
+                self.stats["dropped"] += len(self._carry)
+            self._carry = []
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error:
+            pass
+        conn.close()
@@ -1,5 +1,8 @@
 # input_gpio.py
 import time
+from functools import partial
+from typing import Callable, Optional
+
 import spidev
 from gpiozero import Button, MotionSensor
 
@@ -92,5 +95,36 @@ class GPIOInput:
                 return "3"
             time.sleep(0.01)
 
+    def capture_presses(self, fn: Optional[Callable[[str], None]]) -> None:
+        """
+        生成中のボタン押下を fn('1'/'2'/'3') で受け取る（gpiozero のスレッドから呼ばれる）。None で解除。
+        """
+        for ch, btn in (("1", self.btn1), ("2", self.btn2), ("3", self.btn3)):
+            btn.when_pressed = partial(fn, ch) if fn is not None else None
+
+    def wait_for_release(self) -> None:
+        """
+        先取りしたボタンが離されるまで待つ（押しっぱなしを次の質問の回答にしない）
+        """
+        while self.btn1.is_pressed or self.btn2.is_pressed or self.btn3.is_pressed:
+            time.sleep(0.01)
+
+    def motion_detected(self) -> bool:
+        # ノンブロッキング版（asyncio ループからポーリングする用）
+        return bool(self.pir.motion_detected)
+
+    def poll_button_123(self) -> Optional[str]:
+        """
+        ノンブロッキング版。押されているボタンがあれば '1'/'2'/'3'、無ければ None。
+        （離されるまで同じ番号を返し続けるので、呼び出し側で押下エッジを取ること）
+        """
+        if self.btn1.is_pressed:
+            return "1"
+        if self.btn2.is_pressed:
+            return "2"
+        if self.btn3.is_pressed:
+            return "3"
+        return None
+
     def close(self):
         self.adc.close()
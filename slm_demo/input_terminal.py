@@ -1,5 +1,8 @@
 # input_terminal.py
-from typing import Optional
+import queue
+import sys
+import threading
+from typing import Callable, Optional
 
 def read_trigger() -> None:
     input("\n[人感センサ模擬] Enterで開始 > ")
@@ -27,3 +30,42 @@ def read_temp_cmd() -> Optional[float]:
             except:
                 return None
     return None
+
+
+class LineReader:
+    """
+    標準入力を別スレッドで1行ずつ読む（生成中に打たれた 1/2/3 も取りこぼさない）。
+
+    - capture_presses(fn) の間は 1/2/3（/1 /2 /3）の行を fn へ渡す。fn が受け取らなかった行（False）と
+      それ以外の行は readline() 用に残す（打った行は捨てない）
+    - 入力が終わったら readline() は EOFError を投げる（input() と同じ）
+    """
+
+    def __init__(self):
+        self._q: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._fn: Optional[Callable[[str], None]] = None
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        for line in sys.stdin:
+            s = line.strip()
+            with self._lock:
+                fn = self._fn
+            ch = s[1:] if s in ("/1", "/2", "/3") else s
+            if fn is not None and ch in ("1", "2", "3") and fn(ch):
+                continue
+            self._q.put(s)
+        self._q.put(None)
+
+    def capture_presses(self, fn: Optional[Callable[[str], None]]) -> None:
+        with self._lock:
+            self._fn = fn
+
+    def readline(self, prompt: str = "> ") -> str:
+        print(prompt, end="", flush=True)
+        s = self._q.get()
+        if s is None:
+            self._q.put(None)
+            raise EOFError
+        return s
@@ -0,0 +1,143 @@
+# latency_trace.py
+import atexit
+import os
+import struct
+import threading
+import time
+from typing import Iterator, Optional, Tuple
+
+from config import LATENCY_TRACE, LATENCY_TRACE_FLUSH_RECORDS, LATENCY_TRACE_PATH
+from llm_stream import Finish, FirstToken, StreamSink, StreamStart
+
+# イベント種別（コードはファイルに書くので並びを変えないこと。追加は末尾へ）
+EVENTS = ("open", "pir", "knob", "send", "first_token", "last_token", "display", "button")
+STAGES = ("", "stage0", "stage1", "stage2")
+_EVENT_CODE = {name: i for i, name in enumerate(EVENTS)}
+_STAGE_CODE = {name: i for i, name in enumerate(STAGES)}
+
+# 1レコード 16 byte 固定長: session(u32) stage(u8) event(u8) reserved(u16) t_ns(i64)
+# t_ns は time.perf_counter_ns()（単調時計）。"open" レコードだけ t_ns に time.time_ns() を入れ、
+# 同じプロセスの次のレコードの単調時計と並べて壁時計に換算できるようにする。
+RECORD = struct.Struct("<IBBHq")
+
+Record = Tuple[int, str, str, int]   # (session, stage, event, t_ns)
+
+
+def _last_session(path: str) -> int:
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    n = size // RECORD.size
+    if n == 0:
+        return 0
+    with open(path, "rb") as f:
+        f.seek((n - 1) * RECORD.size)
+        return RECORD.unpack(f.read(RECORD.size))[0]
+
+
+def read_records(path: str = LATENCY_TRACE_PATH) -> Iterator[Record]:
+    """
+    トレースファイルを先頭から読む（書きかけの末尾レコードは捨てる）
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    usable = len(data) - len(data) % RECORD.size
+    for sid, st, ev, _, t_ns in RECORD.iter_unpack(memoryview(data)[:usable]):
+        stage = STAGES[st] if st < len(STAGES) else f"stage?{st}"
+        event = EVENTS[ev] if ev < len(EVENTS) else f"event?{ev}"
+        yield sid, stage, event, t_ns
+
+
+class LatencyTracer:
+    """
+    来訪者が待つ各区間（PIR → ノブ読み → 送信 → 最初のトークン → 最後のトークン → 表示 → ボタン）の
+    単調時計タイムスタンプを、セッション番号付きの固定長バイナリで追記する。
+
+    - mark() はメモリに積むだけ。表示・ボタン押下の後か LATENCY_TRACE_FLUSH_RECORDS 件ごとにまとめて書く
+    - ボタンは「それが始めるステージ」で記録する（Q1 への回答 → stage1）。各ステージは pir/button から始まる
+    - 集計は trace_summary.py
+    """
+
+    def __init__(self, path: str = LATENCY_TRACE_PATH, enabled: bool = LATENCY_TRACE,
+                 flush_records: int = LATENCY_TRACE_FLUSH_RECORDS):
+        self.path = path
+        self.enabled = enabled
+        self.flush_records = flush_records
+        self._lock = threading.Lock()
+        self._buf = bytearray()
+        self._n = 0
+        self._session = 0
+        self._opened = False
+        atexit.register(self.flush)
+
+    def _open(self) -> None:
+        # 初回の記録時に既存ファイルの続きからセッション番号を振る
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._session = _last_session(self.path)
+        self._buf += RECORD.pack(self._session, 0, _EVENT_CODE["open"], 0, time.time_ns())
+        self._n += 1
+        self._opened = True
+
+    def new_session(self) -> int:
+        if not self.enabled:
+            return 0
+        with self._lock:
+            if not self._opened:
+                self._open()
+            self._session = (self._session + 1) & 0xFFFFFFFF
+            return self._session
+
+    def mark(self, event: str, stage: Optional[str] = None, t: Optional[float] = None) -> None:
+        """
+        t は time.perf_counter() の値（省略時は今）。ストリームイベントの t をそのまま渡せる。
+        """
+        if not self.enabled:
+            return
+        t_ns = time.perf_counter_ns() if t is None else int(t * 1e9)
+        with self._lock:
+            if not self._opened:
+                self._open()
+            self._buf += RECORD.pack(self._session, _STAGE_CODE.get(stage or "", 0), _EVENT_CODE[event], 0, t_ns)
+            self._n += 1
+            if event not in ("display", "button") and self._n < self.flush_records:
+                return
+            buf, self._buf, self._n = bytes(self._buf), bytearray(), 0
+        self._write(buf)
+
+    def flush(self) -> None:
+        with self._lock:
+            buf, self._buf, self._n = bytes(self._buf), bytearray(), 0
+        if buf:
+            self._write(buf)
+
+    def _write(self, buf: bytes) -> None:
+        try:
+            with open(self.path, "ab") as f:
+                f.write(buf)
+        except OSError as e:
+            print(f"[trace] write failed: {e}", flush=True)
+
+
+class TraceSink(StreamSink):
+    """
+    表示中の生成の 送信 / 最初のトークン / 最後のトークン をトレーサへ記録する
+    （先行生成・作り置きのヒットは再生時刻で3つとも同じ時刻になる）
+    """
+
+    def __init__(self, tracer: LatencyTracer):
+        self.tracer = tracer
+        self._stage: Optional[str] = None
+
+    def on_start(self, ev: StreamStart) -> None:
+        self._stage = ev.stage
+        self.tracer.mark("send", ev.stage, ev.t_sent if ev.t_sent is not None else ev.t)
+
+    def on_first_token(self, ev: FirstToken) -> None:
+        self.tracer.mark("first_token", self._stage, ev.t)
+
+    def on_finish(self, ev: Finish) -> None:
+        self.tracer.mark("last_token", self._stage, ev.t)
+
+
+TRACER = LatencyTracer()
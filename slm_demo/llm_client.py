@@ -1,9 +1,43 @@
 # slm_demo/llm_client.py
+import http.client
 import json
-import urllib.request
-import urllib.error
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
 
-from config import LLAMA_URL
+from config import LLAMA_UDS, LLAMA_URL, LLM_BACKEND, LLM_DRAIN_AFTER_STOP_S
+from early_stop import EarlyStop, early_stop_for
+from llm_stream import Delta, Finish, FirstToken, StreamEvent, StreamSink, StreamStart, collect_stream
+from stream_sinks import ConsoleSink
+
+# proxy がステージ別にトークン数を集計するためのヘッダ
+STAGE_HEADER = "X-SLM-Stage"
+# proxy が実際に使った backend を返すヘッダ
+BACKEND_HEADER = "X-SLM-Backend"
+# 呼び出しごとの request id（span_trace.py）。proxy は同じ id で自分の span を書く
+TRACE_HEADER = "X-SLM-Trace"
+
+
+@dataclass
+class CompletionResult:
+    text: str
+    finish_reason: Optional[str] = None       # "stop" | "length" | "cancelled" | None(不明)
+    completion_tokens: Optional[int] = None   # upstream が usage/timings を返した場合のみ
+    backend: Optional[str] = None
+    connect_ms: Optional[float] = None        # 新規接続にかかった時間（keep-alive 再利用なら 0）
+    ttft_ms: Optional[float] = None           # リクエスト送信から最初の delta まで
+    early_stopped: bool = False               # 完結を検出して途中で打ち切った（finish_reason は "stop"）
+
+    @property
+    def truncated(self) -> bool:
+        return self.finish_reason == "length"
+
+    @property
+    def cancelled(self) -> bool:
+        return self.finish_reason == "cancelled"
 
 
 def _extract_stream_delta(obj: dict) -> str:
@@ -22,22 +56,384 @@ def _extract_stream_delta(obj: dict) -> str:
     return ""
 
 
-def chat_completion(
-    messages,
-    *,
-    temperature: float,
-    max_tokens: int,
-    top_p: float = 0.9,
-    top_k: int = 40,
-    repeat_penalty: float = 1.1,
-    stream: bool = True,
-    print_stream: bool = True,
-) -> str:
+def _extract_finish_reason(obj: dict) -> Optional[str]:
+    try:
+        ch0 = (obj.get("choices") or [])[0]
+        fr = ch0.get("finish_reason")
+        return fr if isinstance(fr, str) else None
+    except Exception:
+        return None
+
+
+def _extract_completion_tokens(obj: dict) -> Optional[int]:
+    usage = obj.get("usage") or {}
+    if isinstance(usage.get("completion_tokens"), int):
+        return usage["completion_tokens"]
+    timings = obj.get("timings") or {}
+    if isinstance(timings.get("predicted_n"), int):
+        return timings["predicted_n"]
+    return None
+
+
+class SSEDecoder:
     """
-    OpenAI互換 /v1/chat/completions へPOST。
-    stream=True の場合は SSE(data: ...) を chunk読みしてイベント単位で処理する。
+    SSE を raw bytes から復元して、イベントごとの payload(data: の結合結果) を返す（同期/非同期共用）
+    """
+
+    def __init__(self):
+        self._buf = b""
+        self._data_lines = []
+
+    def feed(self, chunk: bytes) -> list:
+        out = []
+        self._buf += chunk
+        while b"\n" in self._buf:
+            raw_line, self._buf = self._buf.split(b"\n", 1)
+            if raw_line.endswith(b"\r"):
+                raw_line = raw_line[:-1]
+            line = raw_line.decode("utf-8", errors="replace")
+
+            # 空行 = event 終端
+            if line == "":
+                if self._data_lines:
+                    out.append("\n".join(self._data_lines).strip())
+                    self._data_lines = []
+                continue
+
+            if line.startswith(":"):
+                continue
+            if line.startswith("data:"):
+                self._data_lines.append(line[len("data:"):].lstrip())
+                continue
+            # event: / id: は無視
+        return out
+
+    def flush(self) -> list:
+        # EOFで残っていたらflush
+        if self._data_lines:
+            out = ["\n".join(self._data_lines).strip()]
+            self._data_lines = []
+            return out
+        return []
+
+
+def iter_sse_payload_strings(resp):
+    """
+    SSEを raw bytes から復元して、イベントごとの payload(data: の結合結果) をyieldする
+    """
+    dec = SSEDecoder()
+    # read() は 8192 バイト溜まるまで返らないので、届いた分だけ返す read1() を使う
+    read = getattr(resp, "read1", resp.read)
+    while True:
+        chunk = read(8192)
+        if not chunk:
+            break
+        yield from dec.feed(chunk)
+    yield from dec.flush()
+
+
+class LLMHTTPError(RuntimeError):
+    def __init__(self, code: int, body: str):
+        super().__init__(f"HTTPError {code}: {body}")
+        self.code = code
+        self.body = body
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, uds_path: str, host: str, timeout: float):
+        super().__init__(host, timeout=timeout)
+        self.uds_path = uds_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.uds_path)
+        self.sock = sock
+
+
+# keep-alive 中に相手側が接続を閉じていたときに出るもの（張り直して1回だけ再送する）
+_STALE_CONN_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
+
+
+# 読み込み中にソケットを shutdown されたときに出るもの（chunked の途中で切れると IncompleteRead / ValueError）
+STREAM_CUT_ERRORS = (OSError, http.client.HTTPException, ValueError)
+
+
+class LLMCall:
+    """
+    1回分のレスポンス。with を抜けると接続をプールへ返す。
+    abort() してから抜けると接続を閉じる（upstream の生成も止まる）。abort(drain=True) は閉じる前に残りを
+    少しだけ読み、終端まで届けば接続をプールへ返す。
+    watch(cancel) すると、cancel がセットされた時点で別スレッドからソケットを shutdown する。
+    """
+
+    def __init__(self, client: "LLMClient", conn: http.client.HTTPConnection, resp: http.client.HTTPResponse, connect_ms: float):
+        self.client = client
+        self.conn = conn
+        self.resp = resp
+        self.connect_ms = connect_ms
+        self.aborted = False
+        self.drain = False
+        self.cancelled = False   # watch() が cancel を見てソケットを閉じた
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def abort(self, drain: bool = False) -> None:
+        self.aborted = True
+        self.drain = drain
+
+    def watch(self, cancel: Optional[threading.Event], poll_s: float = 0.05) -> None:
+        """
+        SSE の payload の間で cancel を見るだけだと、prefill 中や生成が詰まっている間は次の chunk が来るまで気付けない。
+        cancel がセットされたら読んでいる側を待たずにソケットを shutdown し、ブロック中の read をすぐ返させる
+        （接続が切れるので upstream の生成も止まる）。読む側は STREAM_CUT_ERRORS を cancelled として扱う
+        """
+        if cancel is None:
+            return
+        threading.Thread(target=self._watch, args=(cancel, poll_s), daemon=True).start()
+
+    def _watch(self, cancel: threading.Event, poll_s: float) -> None:
+        while not self._done.is_set():
+            if not cancel.wait(poll_s):
+                continue
+            with self._lock:
+                if self._done.is_set():
+                    return
+                self.cancelled = True
+                self.aborted = True
+                sock = self.conn.sock
+                if sock is not None:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            return
+
+    def __enter__(self) -> "LLMCall":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        with self._lock:
+            # ここから先は watch() がソケットに触らない（プールへ返した接続を閉じない）
+            self._done.set()
+        self.client._release(
+            self.conn,
+            self.resp,
+            ok=exc_type is None and not self.aborted,
+            drain=exc_type is None and self.drain and not self.cancelled,
+        )
+        return False
+
+
+class LLMClient:
+    """
+    proxy への HTTP/1.1 keep-alive 接続を使い回すクライアント。
+
+    - 接続はプールして使い回す（先行生成・作り置きのスレッドから同時に呼んでもよい）
+    - keep-alive 中に切れていたら張り直して1回だけ再送する
+    - uds_path を渡すと Unix ドメインソケットで proxy に接続する（proxy 側は --uds）
+    - 呼び出しごとの接続時間を CompletionResult.connect_ms と snapshot() に出す
+    - stream を途中で切った（早期終了・cancel）接続は閉じるしかないので、その分 reused は減る。
+      閉じた数は aborted、早期終了の後に残りを読み切って使い回せた数は drained に数える
+    """
+
+    def __init__(
+        self,
+        url: str = LLAMA_URL,
+        uds_path: Optional[str] = LLAMA_UDS,
+        timeout: float = 600.0,
+        max_idle: int = 4,
+        drain_s: float = LLM_DRAIN_AFTER_STOP_S,
+    ):
+        u = urlparse(url)
+        self.scheme = u.scheme or "http"
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or (443 if self.scheme == "https" else 80)
+        self.path = u.path or "/"
+        self.uds_path = uds_path
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.drain_s = drain_s
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "connects": 0, "reused": 0, "reconnects": 0, "aborted": 0, "drained": 0, "connect_ms_total": 0.0}
+
+    def _new_conn(self) -> http.client.HTTPConnection:
+        if self.uds_path:
+            return _UnixHTTPConnection(self.uds_path, f"{self.host}:{self.port}", self.timeout)
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self) -> http.client.HTTPConnection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._new_conn()
+
+    def _release(self, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse, ok: bool, drain: bool = False) -> None:
+        if ok:
+            try:
+                # SSE の [DONE] 以降（終端 chunk）まで読み切ってから次のリクエストに使う
+                resp.read()
+            except Exception:
+                ok = False
+        elif drain and self.drain_s > 0 and self._drain(conn, resp):
+            ok = True
+            self.stats["drained"] += 1
+        else:
+            self.stats["aborted"] += 1
+        if ok and not resp.will_close:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    def _drain(self, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse) -> bool:
+        """
+        早期終了した stream の残りを drain_s だけ読む。[DONE] の直前で止めていればその間に終端まで届くので、
+        接続を閉じずに使い回せる。届かなければ False（呼び出し側が閉じて upstream の生成を止める）
+        """
+        sock = conn.sock
+        if sock is None:
+            return False
+        deadline = time.monotonic() + self.drain_s
+        read = getattr(resp, "read1", resp.read)
+        try:
+            while not resp.isclosed():
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                sock.settimeout(left)
+                if not read(8192):
+                    break
+        except STREAM_CUT_ERRORS:
+            return False
+        finally:
+            try:
+                sock.settimeout(self.timeout)
+            except OSError:
+                pass
+        return True
+
+    def _send(
+        self,
+        conn: http.client.HTTPConnection,
+        method: str,
+        path: str,
+        body: Optional[bytes],
+        headers: Dict[str, str],
+    ) -> Tuple[http.client.HTTPResponse, float]:
+        connect_ms = 0.0
+        if conn.sock is None:
+            t0 = time.perf_counter()
+            conn.connect()
+            connect_ms = (time.perf_counter() - t0) * 1000.0
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse(), connect_ms
+
+    def request(
+        self,
+        method: str,
+        path: Optional[str] = None,
+        payload: Optional[dict] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> LLMCall:
+        """
+        path 省略時は url のパス（/v1/chat/completions）。4xx/5xx は LLMHTTPError。
+        """
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        hdrs = {"Content-Type": "application/json"} if body is not None else {}
+        hdrs.update(headers or {})
+        path = path or self.path
+
+        conn = self._acquire()
+        reused = conn.sock is not None
+        try:
+            resp, connect_ms = self._send(conn, method, path, body, hdrs)
+        except _STALE_CONN_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            self.stats["reconnects"] += 1
+            conn = self._new_conn()
+            reused = False
+            try:
+                resp, connect_ms = self._send(conn, method, path, body, hdrs)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        self.stats["calls"] += 1
+        if reused:
+            self.stats["reused"] += 1
+        else:
+            self.stats["connects"] += 1
+            self.stats["connect_ms_total"] += connect_ms
+
+        if resp.status >= 400:
+            err = resp.read().decode("utf-8", errors="replace")
+            conn.close()
+            raise LLMHTTPError(resp.status, err)
+        return LLMCall(self, conn, resp, connect_ms)
+
+    def get_json(self, path: str) -> dict:
+        with self.request("GET", path) as call:
+            return json.loads(call.resp.read().decode("utf-8", errors="replace"))
+
+    def post_json(self, path: str, payload: dict, headers: Optional[Dict[str, str]] = None) -> dict:
+        with self.request("POST", path, payload, headers) as call:
+            return json.loads(call.resp.read().decode("utf-8", errors="replace"))
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def snapshot(self) -> dict:
+        st = dict(self.stats)
+        st["transport"] = "uds" if self.uds_path else "tcp"
+        st["connect_ms_avg"] = (st["connect_ms_total"] / st["connects"]) if st["connects"] else None
+        st["reuse_rate"] = (st["reused"] / st["calls"]) if st["calls"] else None
+        return st
+
+
+_default_client: Optional[LLMClient] = None
+_default_lock = threading.Lock()
+
+
+def get_client() -> LLMClient:
+    """
+    プロセス共通のクライアント（LLAMA_URL / LLAMA_UDS）
     """
-    payload = {
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = LLMClient()
+        return _default_client
+
+
+def chat_completion(*args, **kwargs) -> str:
+    """
+    chat_completion_ex の本文だけを返す版（従来インターフェース）。
+    """
+    return chat_completion_ex(*args, **kwargs).text
+
+
+def _chat_payload(messages, temperature, max_tokens, top_p, top_k, repeat_penalty, stream) -> dict:
+    return {
         "model": "local",
         "messages": messages,
         "temperature": float(temperature),
@@ -48,84 +444,250 @@ def chat_completion(
         "stream": bool(stream),
     }
 
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        LLAMA_URL,
-        data=data,
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "text/event-stream",
-        },
-        method="POST",
-    )
 
-    def _iter_sse_payload_strings(resp):
-        """
-        SSEを raw bytes から復元して、イベントごとの payload(data: の結合結果) をyieldする
-        """
-        buf = b""
-        data_lines = []
+# 1 chunk(JSON) → (本文の差分, finish_reason, completion_tokens, この chunk で終わりか)
+ChunkParser = Callable[[dict], Tuple[Optional[str], Optional[str], Optional[int], bool]]
 
-        while True:
-            chunk = resp.read(8192)
-            if not chunk:
-                break
-            buf += chunk
-
-            while b"\n" in buf:
-                raw_line, buf = buf.split(b"\n", 1)
-                if raw_line.endswith(b"\r"):
-                    raw_line = raw_line[:-1]
-                line = raw_line.decode("utf-8", errors="replace")
-
-                # 空行 = event 終端
-                if line == "":
-                    if data_lines:
-                        yield "\n".join(data_lines).strip()
-                        data_lines = []
-                    continue
-
-                if line.startswith(":"):
-                    continue
-                if line.startswith("data:"):
-                    data_lines.append(line[len("data:"):].lstrip())
-                    continue
-                # event: / id: は無視
 
-        # EOFで残っていたらflush
-        if data_lines:
-            yield "\n".join(data_lines).strip()
+def parse_chat_chunk(obj: dict) -> Tuple[Optional[str], Optional[str], Optional[int], bool]:
+    """
+    /v1/chat/completions の chunk。終わりは [DONE] で分かるので、ここでは終わりにしない
+    """
+    return _extract_stream_delta(obj), _extract_finish_reason(obj), _extract_completion_tokens(obj), False
+
+
+def stream_call_events(
+    call: "LLMCall",
+    parse: ChunkParser,
+    *,
+    stage: Optional[str],
+    t0: float,
+    cancel: Optional[threading.Event] = None,
+    early_stop: Optional[EarlyStop] = None,
+) -> Iterator[StreamEvent]:
+    """
+    応答ヘッダまで来た stream（call）を読み、StreamStart → FirstToken → Delta... → Finish を yield する。
+    chat 経路と事前トークナイズ経路（/completion）で共通。違いは chunk の読み方（parse）だけ。
+    cancel・早期終了（接続は drain を試みてから返す）・途中切断の扱いもここで揃える。
+    """
+    resp = call.resp
+    call.watch(cancel)
+    backend = resp.headers.get(BACKEND_HEADER)
+    yield StreamStart(t=time.perf_counter(), stage=stage, backend=backend, connect_ms=call.connect_ms, t_sent=t0)
 
+    full = []
+    finish_reason = None
+    completion_tokens = None
+    ttft_ms = None
+    completed = False
     try:
-        with urllib.request.urlopen(req, timeout=600) as resp:
-            if not stream:
-                body = resp.read().decode("utf-8", errors="replace")
-                obj = json.loads(body)
-                return obj["choices"][0]["message"]["content"].strip()
-
-            full = []
-            for payload_str in _iter_sse_payload_strings(resp):
-                if not payload_str:
-                    continue
-                if payload_str == "[DONE]":
-                    break
+        for payload_str in iter_sse_payload_strings(resp):
+            if cancel is not None and cancel.is_set():
+                call.abort()
+                break
+            if not payload_str:
+                continue
+            if payload_str == "[DONE]":
+                completed = True
+                break
+
+            try:
+                obj = json.loads(payload_str)
+            except Exception:
+                # proxy がエラーメッセージを文字列で流した等に備える
+                continue
+            if not isinstance(obj, dict):
+                continue
 
-                try:
-                    obj = json.loads(payload_str)
-                except Exception:
-                    # proxy がエラーメッセージを文字列で流した等に備える
-                    continue
+            delta, reason, tokens, done = parse(obj)
+            stop = False
+            if delta and early_stop is not None:
+                delta, stop = early_stop.check(delta)
+            if delta:
+                now = time.perf_counter()
+                if ttft_ms is None:
+                    ttft_ms = (now - t0) * 1000.0
+                    yield FirstToken(t=now, ttft_ms=ttft_ms)
+                full.append(delta)
+                yield Delta(t=now, text=delta)
+            if stop:
+                finish_reason = "stop"
+                completed = True
+                call.abort(drain=True)
+                break
 
-                delta = _extract_stream_delta(obj)
-                if delta:
-                    full.append(delta)
-                    if print_stream:
-                        print(delta, end="", flush=True)
+            finish_reason = reason or finish_reason
+            if tokens is not None:
+                completion_tokens = tokens
+            if done:
+                completed = True
+                break
+    except STREAM_CUT_ERRORS:
+        if not call.cancelled:
+            raise
+    if not completed and (call.cancelled or (cancel is not None and cancel.is_set())):
+        finish_reason = "cancelled"
+        completion_tokens = len(full)
 
-            return "".join(full).strip()
+    early = False
+    if early_stop is not None and finish_reason != "cancelled":
+        n = early_stop.finish()
+        if early_stop.stopped:
+            early = True
+            completion_tokens = n
 
-    except urllib.error.HTTPError as e:
-        err = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"HTTPError {e.code}: {err}") from e
+    now = time.perf_counter()
+    result = CompletionResult(
+        text="".join(full).strip(),
+        finish_reason=finish_reason,
+        completion_tokens=completion_tokens,
+        backend=backend,
+        connect_ms=call.connect_ms,
+        ttft_ms=ttft_ms,
+        early_stopped=early,
+    )
+    yield Finish(
+        t=now,
+        result=result,
+        stage=stage,
+        elapsed_ms=(now - t0) * 1000.0,
+        usage={"completion_tokens": completion_tokens},
+    )
+
+
+def stream_chat_completion(
+    messages,
+    *,
+    temperature: float,
+    max_tokens: int,
+    top_p: float = 0.9,
+    top_k: int = 40,
+    repeat_penalty: float = 1.1,
+    stage: Optional[str] = None,
+    cancel: Optional[threading.Event] = None,
+    client: Optional[LLMClient] = None,
+    early_stop: Optional[EarlyStop] = None,
+    constraint: Optional[dict] = None,
+    backend: Optional[str] = None,
+    trace: Optional[str] = None,
+    id_slot: Optional[int] = None,
+) -> Iterator[StreamEvent]:
+    """
+    /v1/chat/completions を stream で呼び、StreamStart → FirstToken → Delta... → Finish を yield する。
+    途中で generator を閉じる（break / close()）と接続を切り、upstream の生成も止まる。
+    cancel がセットされたら finish_reason="cancelled"（completion_tokens は受信済み chunk 数で近似）の Finish で終わる。
+    early_stop を渡すと、出力が完結した時点で接続を切って finish_reason="stop" で終わる。
+    constraint（{"grammar": GBNF} / {"json_schema": ...}）はそのまま payload に足す。
+    backend="inproc"（省略時は LLM_BACKEND）で client を渡していなければ、プロセス内のモデルで同じイベントを返す。
+    trace（request id）は X-SLM-Trace ヘッダで proxy へ送る。
+    id_slot を渡すと llama.cpp の slot を固定する（prefill 済みの slot に乗せる。presence_prefill.py）。
+    """
+    if (backend or LLM_BACKEND) == "inproc" and client is None:
+        from llm_inproc import get_inproc
+
+        yield from get_inproc().stream_chat(
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            top_k=top_k,
+            repeat_penalty=repeat_penalty,
+            stage=stage,
+            cancel=cancel,
+            early_stop=early_stop,
+            constraint=constraint,
+        )
+        return
+
+    payload = _chat_payload(messages, temperature, max_tokens, top_p, top_k, repeat_penalty, True)
+    payload.update(constraint or {})
+    if id_slot is not None:
+        payload["id_slot"] = int(id_slot)
+    headers = {"Accept": "text/event-stream"}
+    if stage:
+        headers[STAGE_HEADER] = stage
+    if trace:
+        headers[TRACE_HEADER] = trace
+
+    t0 = time.perf_counter()
+    try:
+        with (client or get_client()).request("POST", payload=payload, headers=headers) as call:
+            yield from stream_call_events(call, parse_chat_chunk, stage=stage, t0=t0, cancel=cancel, early_stop=early_stop)
+    except LLMHTTPError:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Request failed: {e}") from e
+
+
+def chat_completion_ex(
+    messages,
+    *,
+    temperature: float,
+    max_tokens: int,
+    top_p: float = 0.9,
+    top_k: int = 40,
+    repeat_penalty: float = 1.1,
+    stream: bool = True,
+    print_stream: bool = True,
+    stage: Optional[str] = None,
+    cancel: Optional[threading.Event] = None,
+    sinks: Sequence[StreamSink] = (),
+    early_stop: bool = True,
+    constraint: Optional[dict] = None,
+    backend: Optional[str] = None,
+    client: Optional[LLMClient] = None,
+    trace: Optional[str] = None,
+    id_slot: Optional[int] = None,
+) -> CompletionResult:
+    """
+    OpenAI互換 /v1/chat/completions へPOST。
+    stream=True の場合は stream_chat_completion のイベントを sinks に配りながら最後まで読む
+    （print_stream=True なら ConsoleSink を先頭に足す）。
+    stage を渡すと proxy 側でステージ別のトークン数として集計される。
+    cancel がセットされたら接続を閉じて打ち切る（upstream の生成も止まる）。
+    early_stop=True なら stage ごとの完結判定（early_stop.py）で余分な生成を止める。
+    backend="inproc" は常に stream 経路（プロセス内なので stream の手間はかからない）。
+    client を渡すと既定の proxy 以外（cascade の上位 tier など）へ送る。
+    """
+    if (backend or LLM_BACKEND) == "inproc" and client is None:
+        stream = True
+    if stream:
+        events = stream_chat_completion(
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            top_k=top_k,
+            repeat_penalty=repeat_penalty,
+            stage=stage,
+            cancel=cancel,
+            early_stop=early_stop_for(stage, max_tokens, verbose=print_stream) if early_stop else None,
+            constraint=constraint,
+            backend=backend,
+            client=client,
+            trace=trace,
+            id_slot=id_slot,
+        )
+        return collect_stream(events, ([ConsoleSink()] if print_stream else []) + list(sinks))
+
+    payload = _chat_payload(messages, temperature, max_tokens, top_p, top_k, repeat_penalty, False)
+    payload.update(constraint or {})
+    if id_slot is not None:
+        payload["id_slot"] = int(id_slot)
+    headers = {STAGE_HEADER: stage} if stage else {}
+    if trace:
+        headers[TRACE_HEADER] = trace
+    try:
+        with (client or get_client()).request("POST", payload=payload, headers=headers) as call:
+            obj = json.loads(call.resp.read().decode("utf-8", errors="replace"))
+            return CompletionResult(
+                text=obj["choices"][0]["message"]["content"].strip(),
+                finish_reason=_extract_finish_reason(obj),
+                completion_tokens=_extract_completion_tokens(obj),
+                backend=call.resp.headers.get(BACKEND_HEADER),
+                connect_ms=call.connect_ms,
+            )
+    except LLMHTTPError:
+        raise
     except Exception as e:
         raise RuntimeError(f"Request failed: {e}") from e
@@ -0,0 +1,239 @@
+# slm_demo/llm_client_async.py
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from config import LLAMA_URL
+from llm_client import (
+    BACKEND_HEADER,
+    STAGE_HEADER,
+    CompletionResult,
+    SSEDecoder,
+    _extract_completion_tokens,
+    _extract_finish_reason,
+    _extract_stream_delta,
+)
+from early_stop import EarlyStop, early_stop_for
+from llm_stream import Delta, Finish, FirstToken, StreamEvent, StreamStart
+
+
+async def _read_headers(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str]]:
+    status_line = await reader.readline()
+    if not status_line:
+        raise RuntimeError("connection closed before response")
+    parts = status_line.decode("latin-1").split(" ", 2)
+    status = int(parts[1])
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    return status, headers
+
+
+async def _iter_body(reader: asyncio.StreamReader, headers: Dict[str, str]):
+    """
+    HTTP/1.1 のボディを届いた順に返す（chunked / Content-Length / close 区切り）
+    """
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                return
+            size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+            if size == 0:
+                await reader.readline()
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            chunk = await reader.read(min(8192, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await reader.read(8192)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def stream_chat_completion_async(
+    messages,
+    *,
+    temperature: float,
+    max_tokens: int,
+    top_p: float = 0.9,
+    top_k: int = 40,
+    repeat_penalty: float = 1.1,
+    stage: Optional[str] = None,
+    url: str = LLAMA_URL,
+    early_stop: Optional[EarlyStop] = None,
+    constraint: Optional[dict] = None,
+) -> AsyncIterator[StreamEvent]:
+    """
+    stream_chat_completion の asyncio 版（同じイベントを async for で返す）。
+    タスクを cancel すると CancelledError でソケットを閉じるので、upstream の生成も止まる。
+    """
+    payload = {
+        "model": "local",
+        "messages": messages,
+        "temperature": float(temperature),
+        "max_tokens": int(max_tokens),
+        "top_p": float(top_p),
+        "top_k": int(top_k),
+        "repeat_penalty": float(repeat_penalty),
+        "stream": True,
+    }
+    payload.update(constraint or {})
+    body = json.dumps(payload).encode("utf-8")
+
+    u = urlparse(url)
+    host = u.hostname or "127.0.0.1"
+    port = u.port or (443 if u.scheme == "https" else 80)
+    path = u.path or "/"
+
+    head = [
+        f"POST {path} HTTP/1.1",
+        f"Host: {host}:{port}",
+        "Content-Type: application/json",
+        "Accept: text/event-stream",
+        f"Content-Length: {len(body)}",
+        "Connection: close",
+    ]
+    if stage:
+        head.append(f"{STAGE_HEADER}: {stage}")
+
+    t0 = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port, ssl=(u.scheme == "https") or None)
+    connect_ms = (time.perf_counter() - t0) * 1000.0
+    try:
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        status, headers = await _read_headers(reader)
+        if status >= 400:
+            err = b"".join([c async for c in _iter_body(reader, headers)]).decode("utf-8", errors="replace")
+            raise RuntimeError(f"HTTPError {status}: {err}")
+        backend = headers.get(BACKEND_HEADER.lower())
+        yield StreamStart(t=time.perf_counter(), stage=stage, backend=backend, connect_ms=connect_ms, t_sent=t0)
+
+        dec = SSEDecoder()
+        full = []
+        finish_reason = None
+        completion_tokens = None
+        ttft_ms = None
+        done = False
+        async for chunk in _iter_body(reader, headers):
+            for payload_str in dec.feed(chunk):
+                if not payload_str:
+                    continue
+                if payload_str == "[DONE]":
+                    done = True
+                    break
+                try:
+                    obj = json.loads(payload_str)
+                except Exception:
+                    continue
+                if not isinstance(obj, dict):
+                    continue
+
+                delta = _extract_stream_delta(obj)
+                stop = False
+                if delta and early_stop is not None:
+                    delta, stop = early_stop.check(delta)
+                if delta:
+                    now = time.perf_counter()
+                    if ttft_ms is None:
+                        ttft_ms = (now - t0) * 1000.0
+                        yield FirstToken(t=now, ttft_ms=ttft_ms)
+                    full.append(delta)
+                    yield Delta(t=now, text=delta)
+                if stop:
+                    # 接続は finally で閉じる → upstream の生成も止まる
+                    finish_reason = "stop"
+                    done = True
+                    break
+
+                finish_reason = _extract_finish_reason(obj) or finish_reason
+                completion_tokens = _extract_completion_tokens(obj) or completion_tokens
+            if done:
+                break
+
+        early = False
+        if early_stop is not None:
+            n = early_stop.finish()
+            if early_stop.stopped:
+                early = True
+                completion_tokens = n
+
+        now = time.perf_counter()
+        yield Finish(
+            t=now,
+            result=CompletionResult(
+                text="".join(full).strip(),
+                finish_reason=finish_reason,
+                completion_tokens=completion_tokens,
+                backend=backend,
+                connect_ms=connect_ms,
+                ttft_ms=ttft_ms,
+                early_stopped=early,
+            ),
+            stage=stage,
+            elapsed_ms=(now - t0) * 1000.0,
+            usage={"completion_tokens": completion_tokens},
+        )
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def chat_completion_async(
+    messages,
+    *,
+    temperature: float,
+    max_tokens: int,
+    top_p: float = 0.9,
+    top_k: int = 40,
+    repeat_penalty: float = 1.1,
+    stage: Optional[str] = None,
+    on_delta: Optional[Callable[[str], None]] = None,
+    url: str = LLAMA_URL,
+    constraint: Optional[dict] = None,
+) -> CompletionResult:
+    """
+    chat_completion_ex の asyncio 版（stream 固定）。on_delta は delta ごとに呼ばれる。
+    """
+    result = None
+    events = stream_chat_completion_async(
+        messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=top_p,
+        top_k=top_k,
+        repeat_penalty=repeat_penalty,
+        stage=stage,
+        url=url,
+        early_stop=early_stop_for(stage, max_tokens, verbose=False),
+        constraint=constraint,
+    )
+    try:
+        async for ev in events:
+            if isinstance(ev, Delta) and on_delta is not None:
+                on_delta(ev.text)
+            elif isinstance(ev, Finish):
+                result = ev.result
+    finally:
+        await events.aclose()
+    return result
@@ -0,0 +1,172 @@
+# llm_inproc.py
+# llama-cpp-python でモデルをこのプロセス内に常駐させる backend（LLM_BACKEND = "inproc" のときだけ import される）
+import threading
+import time
+from typing import Iterator, Optional
+
+from llama_cpp import Llama, LlamaGrammar, llama_set_n_threads
+
+from config import INPROC_MODEL_PATH, INPROC_N_CTX, INPROC_N_THREADS
+from early_stop import EarlyStop
+from llm_stream import Delta, Finish, FirstToken, StreamEvent, StreamStart
+
+BACKEND_NAME = "inproc"
+
+
+class InProcessLLM:
+    """
+    llama_cpp.Llama を1つだけロードして使い回す。
+
+    - Llama は同時に1つの生成しかできないので lock で直列化する（先行生成は並列にならない）
+    - 直前のプロンプトと先頭が一致する分の KV はそのまま使われる（prompts の prefix_first レイアウトが効く）
+    - cancel / 早期終了 / generator の close で生成ループを抜ければ、その時点で計算も止まる
+    """
+
+    def __init__(self, model_path: str = INPROC_MODEL_PATH, n_ctx: int = INPROC_N_CTX, n_threads: int = INPROC_N_THREADS):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.lock = threading.Lock()
+        self._llm: Optional[Llama] = None
+        self.load_ms: Optional[float] = None
+
+    def load(self) -> Llama:
+        if self._llm is None:
+            if not self.model_path:
+                raise RuntimeError("INPROC_MODEL_PATH (SLM_INPROC_MODEL) が未設定です")
+            t0 = time.perf_counter()
+            self._llm = Llama(
+                model_path=self.model_path,
+                n_ctx=self.n_ctx,
+                n_threads=self.n_threads,
+                n_gpu_layers=0,   # Raspberry Pi / CPU前提
+                verbose=False,
+            )
+            self.load_ms = (time.perf_counter() - t0) * 1000.0
+            print(f"[inproc] loaded {self.model_path} in {self.load_ms:.0f} ms", flush=True)
+        return self._llm
+
+    def set_threads(self, n_threads: Optional[int]) -> None:
+        """
+        生成スレッド数を変える（熱・負荷で絞る。None でロード時の値へ戻す）。次の生成から効く
+        """
+        n = n_threads or self.n_threads
+        with self.lock:
+            if self._llm is not None:
+                llama_set_n_threads(self._llm.ctx, n, n)
+
+    def warmup(self, messages) -> None:
+        """
+        共通 prefix（system 等）を1回評価しておき、最初の来訪者の prefill を短くする
+        """
+        with self.lock:
+            llm = self.load()
+            for _ in llm.create_chat_completion(messages, max_tokens=1, stream=True):
+                pass
+
+    def stream_chat(
+        self,
+        messages,
+        *,
+        temperature: float,
+        max_tokens: int,
+        top_p: float = 0.9,
+        top_k: int = 40,
+        repeat_penalty: float = 1.1,
+        stage: Optional[str] = None,
+        cancel: Optional[threading.Event] = None,
+        early_stop: Optional[EarlyStop] = None,
+        constraint: Optional[dict] = None,
+    ) -> Iterator[StreamEvent]:
+        """
+        llm_client.stream_chat_completion と同じイベント列を返す（connect_ms は常に 0）
+        """
+        kwargs = {}
+        if constraint and constraint.get("grammar"):
+            kwargs["grammar"] = LlamaGrammar.from_string(constraint["grammar"], verbose=False)
+        elif constraint and constraint.get("json_schema"):
+            kwargs["response_format"] = {"type": "json_object", "schema": constraint["json_schema"]}
+
+        t0 = time.perf_counter()
+        with self.lock:
+            llm = self.load()
+            yield StreamStart(t=time.perf_counter(), stage=stage, backend=BACKEND_NAME, connect_ms=0.0, t_sent=t0)
+
+            full = []
+            finish_reason = None
+            ttft_ms = None
+            n_chunks = 0
+            chunks = llm.create_chat_completion(
+                messages,
+                temperature=float(temperature),
+                top_p=float(top_p),
+                top_k=int(top_k),
+                repeat_penalty=float(repeat_penalty),
+                max_tokens=int(max_tokens),
+                stream=True,
+                **kwargs,
+            )
+            try:
+                for obj in chunks:
+                    if cancel is not None and cancel.is_set():
+                        finish_reason = "cancelled"
+                        break
+                    ch0 = (obj.get("choices") or [{}])[0]
+                    delta = (ch0.get("delta") or {}).get("content") or ""
+                    stop = False
+                    if delta and early_stop is not None:
+                        delta, stop = early_stop.check(delta)
+                    if delta:
+                        now = time.perf_counter()
+                        if ttft_ms is None:
+                            ttft_ms = (now - t0) * 1000.0
+                            yield FirstToken(t=now, ttft_ms=ttft_ms)
+                        n_chunks += 1
+                        full.append(delta)
+                        yield Delta(t=now, text=delta)
+                    if stop:
+                        finish_reason = "stop"
+                        break
+                    finish_reason = ch0.get("finish_reason") or finish_reason
+            finally:
+                # 途中で抜けたら生成ループを閉じて計算を止める
+                chunks.close()
+
+            early = False
+            if early_stop is not None and finish_reason != "cancelled":
+                early_stop.finish()
+                early = early_stop.stopped
+
+        # CompletionResult は llm_client 側の定義を使う（循環 import を避けてここで読む）
+        from llm_client import CompletionResult
+
+        now = time.perf_counter()
+        result = CompletionResult(
+            text="".join(full).strip(),
+            finish_reason=finish_reason,
+            # stream の chunk はほぼ1トークンずつ
+            completion_tokens=n_chunks,
+            backend=BACKEND_NAME,
+            connect_ms=0.0,
+            ttft_ms=ttft_ms,
+            early_stopped=early,
+        )
+        yield Finish(
+            t=now,
+            result=result,
+            stage=stage,
+            elapsed_ms=(now - t0) * 1000.0,
+            usage={"completion_tokens": n_chunks},
+        )
+
+
+_inproc: Optional[InProcessLLM] = None
+_inproc_lock = threading.Lock()
+
+
+def get_inproc() -> InProcessLLM:
+    global _inproc
+    with _inproc_lock:
+        if _inproc is None:
+            _inproc = InProcessLLM()
+        return _inproc
@@ -0,0 +1,103 @@
+# llm_stream.py
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Optional, Union
+
+
+# ストリーム生成のイベント。t は time.perf_counter() の値
+@dataclass
+class StreamStart:
+    t: float
+    stage: Optional[str] = None
+    backend: Optional[str] = None
+    connect_ms: Optional[float] = None
+    t_sent: Optional[float] = None  # リクエストを送り始めた時刻（t は応答ヘッダ受信時）
+    replayed: bool = False          # 生成済みの結果の再生（events_from_result）。実測ではない
+
+
+@dataclass
+class FirstToken:
+    t: float
+    ttft_ms: float          # リクエスト送信から最初の delta まで
+
+
+@dataclass
+class Delta:
+    t: float
+    text: str
+
+
+@dataclass
+class Finish:
+    t: float
+    result: "object"        # llm_client.CompletionResult（finish_reason / completion_tokens / text）
+    stage: Optional[str] = None
+    elapsed_ms: float = 0.0
+    usage: dict = field(default_factory=dict)
+
+
+StreamEvent = Union[StreamStart, FirstToken, Delta, Finish]
+
+
+class StreamSink:
+    """
+    ストリームイベントの購読者。必要なメソッドだけ上書きする。
+    """
+
+    def on_event(self, ev: StreamEvent) -> None:
+        if isinstance(ev, Delta):
+            self.on_delta(ev)
+        elif isinstance(ev, FirstToken):
+            self.on_first_token(ev)
+        elif isinstance(ev, StreamStart):
+            self.on_start(ev)
+        elif isinstance(ev, Finish):
+            self.on_finish(ev)
+
+    def on_start(self, ev: StreamStart) -> None:
+        pass
+
+    def on_first_token(self, ev: FirstToken) -> None:
+        pass
+
+    def on_delta(self, ev: Delta) -> None:
+        pass
+
+    def on_finish(self, ev: Finish) -> None:
+        pass
+
+
+def collect_stream(events: Iterable[StreamEvent], sinks: Iterable[StreamSink] = ()):
+    """
+    イベント列を sinks に配りながら最後まで読み、Finish の CompletionResult を返す。
+    途中で例外が出たら（キャンセル含む）generator は閉じられ、接続も切れる。
+    """
+    sinks = list(sinks)
+    result = None
+    for ev in events:
+        for sink in sinks:
+            try:
+                sink.on_event(ev)
+            except Exception as e:
+                print(f"\n[sink] {type(sink).__name__}: {e}", flush=True)
+        if isinstance(ev, Finish):
+            result = ev.result
+    return result
+
+
+def events_from_result(result, stage: Optional[str] = None):
+    """
+    生成済みの結果（先行生成・作り置き）を、その場で届いたストリームとして再生する。
+    """
+    t = time.perf_counter()
+    yield StreamStart(t=t, stage=stage, backend=getattr(result, "backend", None), connect_ms=None, t_sent=t, replayed=True)
+    if result.text:
+        yield FirstToken(t=t, ttft_ms=0.0)
+        yield Delta(t=t, text=result.text)
+    yield Finish(
+        t=t,
+        result=result,
+        stage=stage,
+        elapsed_ms=0.0,
+        usage={"completion_tokens": result.completion_tokens},
+    )
@@ -1,9 +1,11 @@
 import json
 import sys
-import urllib.request
-import urllib.error
+
+from llm_client import LLMClient, LLMHTTPError
 
 LLAMA_URL = "http://127.0.0.1:8080/v1/chat/completions"
+# keep-alive で接続を使い回す（毎ターン TCP を張り直さない）
+_client = LLMClient(LLAMA_URL, uds_path=None)
 
 # ---- ここを必要に応じて調整 ----
 SYSTEM_PROMPT = (
@@ -128,17 +130,10 @@ def call_llama_stream(messages, params) -> str:
         **params,
     }
 
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        LLAMA_URL,
-        data=data,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
-
     full = []
     try:
-        with urllib.request.urlopen(req, timeout=600) as resp:
+        with _client.request("POST", payload=payload) as call:
+            resp = call.resp
             # サーバはSSE形式で「data: {...}\n\n」を返す
             while True:
                 line = resp.readline()
@@ -166,9 +161,8 @@ def call_llama_stream(messages, params) -> str:
                     # 逐次表示
                     print(delta, end="", flush=True)
 
-    except urllib.error.HTTPError as e:
-        err = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"HTTPError {e.code}: {err}") from e
+    except LLMHTTPError:
+        raise
     except Exception as e:
         raise RuntimeError(f"Request failed: {e}") from e
 
@@ -181,21 +175,13 @@ def call_llama_nonstream(messages, params) -> str:
         "messages": messages,
         **params,
     }
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        LLAMA_URL,
-        data=data,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
     try:
-        with urllib.request.urlopen(req, timeout=600) as resp:
-            body = resp.read().decode("utf-8", errors="replace")
+        with _client.request("POST", payload=payload) as call:
+            body = call.resp.read().decode("utf-8", errors="replace")
             obj = json.loads(body)
             return obj["choices"][0]["message"]["content"].strip()
-    except urllib.error.HTTPError as e:
-        err = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"HTTPError {e.code}: {err}") from e
+    except LLMHTTPError:
+        raise
     except Exception as e:
         raise RuntimeError(f"Request failed: {e}") from e
 
@@ -224,6 +210,7 @@ def print_status(level01, params):
     print(f"         temp={params['temperature']:.2f} top_p={params['top_p']:.3f} top_k={params['top_k']}")
     print(f"         max_tokens={params['max_tokens']} presence={params['presence_penalty']:.2f} freq={params['frequency_penalty']:.2f}")
     print(f"         repeat_penalty={params['repeat_penalty']:.2f} stream={STREAM}")
+    print(f"[conn] {_client.snapshot()}")
 
 
 def main():
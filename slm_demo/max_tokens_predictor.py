@@ -0,0 +1,173 @@
+# max_tokens_predictor.py
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from config import (
+    MAX_TOKENS_PRED_FLOOR,
+    MAX_TOKENS_PRED_MARGIN,
+    MAX_TOKENS_PRED_MIN_SAMPLES,
+    MAX_TOKENS_PRED_PATH,
+    MAX_TOKENS_PRED_QUANTILE,
+    MAX_TOKENS_PRED_SAVE_S,
+    MAX_TOKENS_PRED_WINDOW,
+)
+
+
+def quantile(values, q: float) -> float:
+    """
+    最近傍順位法の分位点（numpy なしで使う）
+    """
+    xs = sorted(values)
+    if not xs:
+        return 0.0
+    idx = min(len(xs) - 1, max(0, int(math.ceil(q * len(xs))) - 1))
+    return float(xs[idx])
+
+
+class MaxTokensPredictor:
+    """
+    プロンプトテンプレート × backend ごとに出力トークン数の分布をオンライン学習し、
+    「p99 + 余裕」で max_tokens を決める。
+
+    - 観測が少ないうちは呼び出し側の上限(MAX_TOKENS_*)をそのまま使う
+    - 打ち切り(finish_reason=length)は observe_truncated で記録し、呼び出し側が上限で再試行する
+    - observe は印を付けるだけで書き出さない（表示経路・イベントループで同期 I/O をしない）。
+      最初の観測で書き出しスレッドを起こし、save_s ごとと終了時（atexit）に変更があれば保存する
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = MAX_TOKENS_PRED_PATH,
+        q: float = MAX_TOKENS_PRED_QUANTILE,
+        margin: int = MAX_TOKENS_PRED_MARGIN,
+        min_samples: int = MAX_TOKENS_PRED_MIN_SAMPLES,
+        floor: int = MAX_TOKENS_PRED_FLOOR,
+        window: int = MAX_TOKENS_PRED_WINDOW,
+        save_s: float = MAX_TOKENS_PRED_SAVE_S,
+    ):
+        self.path = path
+        self.q = q
+        self.margin = margin
+        self.min_samples = min_samples
+        self.floor = floor
+        self.window = window
+        self.save_s = save_s
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._save_lock = threading.Lock()   # 書き出しスレッドと atexit が同じ tmp に書かないように
+        self._saver: Optional[threading.Thread] = None
+        self._samples: Dict[Tuple[str, str], deque] = {}
+        self._stats: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self.load()
+
+    def _key(self, template: str, backend: Optional[str]) -> Tuple[str, str]:
+        return (template, backend or "default")
+
+    def predict(self, template: str, backend: Optional[str], ceiling: int) -> int:
+        key = self._key(template, backend)
+        with self._lock:
+            xs = self._samples.get(key)
+            if not xs or len(xs) < self.min_samples:
+                return ceiling
+            cap = int(math.ceil(quantile(xs, self.q))) + self.margin
+        return max(self.floor, min(ceiling, cap))
+
+    def observe(self, template: str, backend: Optional[str], completion_tokens: int, cap: int, ceiling: int) -> None:
+        key = self._key(template, backend)
+        with self._lock:
+            xs = self._samples.setdefault(key, deque(maxlen=self.window))
+            xs.append(int(completion_tokens))
+            st = self._stat(key)
+            st["requests"] += 1
+            # 上限に比べて絞った max_tokens（予約の縮小分）。生成は自然に止まるので、これは生成トークンの節約ではない。
+            # 実際のコストは打ち切り → 再試行（truncated / retry_wasted_tokens）の側で見る
+            st["budget_reduced"] += max(0, ceiling - cap)
+            self._mark_dirty()
+
+    def observe_truncated(self, template: str, backend: Optional[str], wasted_tokens: int) -> None:
+        key = self._key(template, backend)
+        with self._lock:
+            st = self._stat(key)
+            st["truncated"] += 1
+            st["retry_wasted_tokens"] += int(wasted_tokens)
+            self._mark_dirty()
+
+    def _stat(self, key: Tuple[str, str]) -> Dict[str, int]:
+        return self._stats.setdefault(
+            key, {"requests": 0, "truncated": 0, "retry_wasted_tokens": 0, "budget_reduced": 0}
+        )
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        out = {}
+        with self._lock:
+            for key, xs in self._samples.items():
+                st = self._stat(key)
+                out[f"{key[0]}@{key[1]}"] = dict(
+                    st,
+                    samples=len(xs),
+                    p50=quantile(xs, 0.5),
+                    p99=quantile(xs, self.q),
+                )
+        return out
+
+    # -------- 永続化（再起動で学習をやり直さない） --------
+    def _mark_dirty(self) -> None:
+        # _lock を持った状態で呼ぶ
+        self._dirty = True
+        if self._saver is None and self.path:
+            self._saver = threading.Thread(target=self._save_loop, daemon=True)
+            self._saver.start()
+            atexit.register(self.flush)
+
+    def _save_loop(self) -> None:
+        while True:
+            time.sleep(self.save_s)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        変更があれば書き出す
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, False
+        if dirty:
+            self.save()
+
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                obj = json.load(f)
+        except Exception:
+            return
+        for k, xs in (obj.get("samples") or {}).items():
+            template, _, backend = k.partition("@")
+            self._samples[(template, backend)] = deque((int(x) for x in xs), maxlen=self.window)
+        for k, st in (obj.get("stats") or {}).items():
+            template, _, backend = k.partition("@")
+            self._stat((template, backend)).update({n: int(v) for n, v in st.items() if isinstance(v, int)})
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            obj = {
+                "samples": {f"{k[0]}@{k[1]}": list(xs) for k, xs in self._samples.items()},
+                "stats": {f"{k[0]}@{k[1]}": dict(st) for k, st in self._stats.items()},
+            }
+        try:
+            with self._save_lock:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = self.path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(obj, f)
+                os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"[max_tokens] save failed: {e}", flush=True)
@@ -0,0 +1,127 @@
+# prefix_report.py
+"""
+プロンプトの並べ方（prompts.STAGE_LAYOUTS）ごとに、ステージ遷移で共有できる先頭トークン数を測る。
+
+llama.cpp は直前に同じ slot で評価したプロンプトと先頭が一致する分だけ prefill を省略する（cache_prompt）。
+ここでは /apply-template → /tokenize した実際のトークン列で「前のリクエストと何トークン一致するか」を数える。
+--measure を付けると、同じ順番で /completion（n_predict=0）を投げて prefill 時間（timings.prompt_ms）も測る。
+
+例:
+  python prefix_report.py
+  python prefix_report.py --layouts legacy,prefix_first --measure --rounds 3
+"""
+import argparse
+from typing import Dict, List, Tuple
+
+from llm_client import get_client
+from prompts import STAGE_LAYOUTS, build_stage_messages
+
+SAMPLE_Q1 = "トイレの清潔さはいかがでしたか？\n1:満足した 2:普通だった 3:気になった"
+
+# 1セッション分の遷移 + 次のセッション（観点違い）の stage0。先行生成で同じ stage1 を3分岐投げる場合も含める
+SEQUENCE: List[Tuple[str, str, dict]] = [
+    ("stage0", "Q1", {"focus": "清潔さ", "temp01": 0.5}),
+    ("stage1", "Q2 (回答1)", {"satisfaction": "1", "prev_question": SAMPLE_Q1, "temp01": 0.5}),
+    ("stage1", "Q2 (回答3)", {"satisfaction": "3", "prev_question": SAMPLE_Q1, "temp01": 0.5}),
+    ("stage2", "THANKS", {"satisfaction": "3", "reason": "2", "temp01": 0.5}),
+    ("stage0", "次の Q1", {"focus": "におい", "temp01": 0.5}),
+]
+
+
+def common_prefix_len(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def prompt_tokens(client, layout: str, stage: str, values: dict) -> List[int]:
+    messages = build_stage_messages(stage, values, layout=layout)
+    prompt = client.post_json("/apply-template", {"messages": messages}).get("prompt") or ""
+    obj = client.post_json("/tokenize", {"content": prompt, "add_special": True})
+    return [t if isinstance(t, int) else t.get("id", 0) for t in obj.get("tokens") or []]
+
+
+def measure_prefill(client, tokens: List[int], slot: int) -> Dict[str, float]:
+    """
+    n_predict=0 で prefill だけさせ、実際に評価したトークン数と時間を返す
+    """
+    obj = client.post_json(
+        "/completion",
+        {"prompt": tokens, "n_predict": 0, "cache_prompt": True, "id_slot": slot, "stream": False},
+    )
+    tm = obj.get("timings") or {}
+    return {"prompt_n": tm.get("prompt_n"), "prompt_ms": tm.get("prompt_ms")}
+
+
+def report(client, layout: str, measure: bool, rounds: int, slot: int) -> dict:
+    rows = []
+    prev: List[int] = []
+    for stage, label, values in SEQUENCE:
+        toks = prompt_tokens(client, layout, stage, values)
+        shared = common_prefix_len(prev, toks)
+        rows.append({"label": label, "stage": stage, "tokens": len(toks), "shared": shared, "_toks": toks})
+        prev = toks
+
+    if measure:
+        for r in rows:
+            r["prompt_n"] = []
+            r["prompt_ms"] = []
+        for _ in range(rounds):
+            for r in rows:
+                m = measure_prefill(client, r["_toks"], slot)
+                if m["prompt_n"] is not None:
+                    r["prompt_n"].append(m["prompt_n"])
+                if m["prompt_ms"] is not None:
+                    r["prompt_ms"].append(m["prompt_ms"])
+
+    total = sum(r["tokens"] for r in rows)
+    shared = sum(r["shared"] for r in rows)
+    print(f"\n== layout: {layout}")
+    head = f"{'transition':<14} {'stage':<7} {'tokens':>7} {'shared':>7} {'new':>6} {'share%':>7}"
+    if measure:
+        head += f" {'eval_n':>7} {'prefill_ms':>11}"
+    print(head)
+    for r in rows:
+        line = (
+            f"{r['label']:<14} {r['stage']:<7} {r['tokens']:>7} {r['shared']:>7} "
+            f"{r['tokens'] - r['shared']:>6} {r['shared'] * 100.0 / max(1, r['tokens']):>6.0f}%"
+        )
+        if measure:
+            n = r["prompt_n"]
+            ms = r["prompt_ms"]
+            line += f" {(sum(n) / len(n)) if n else float('nan'):>7.0f} {(sum(ms) / len(ms)) if ms else float('nan'):>11.1f}"
+        print(line)
+    print(f"{'total':<22} {total:>7} {shared:>7} {total - shared:>6} {shared * 100.0 / max(1, total):>6.0f}%")
+
+    out = {"tokens": total, "shared": shared}
+    if measure:
+        out["prefill_ms"] = sum(sum(r["prompt_ms"]) / len(r["prompt_ms"]) for r in rows if r["prompt_ms"])
+    return out
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--layouts", default=",".join(STAGE_LAYOUTS))
+    p.add_argument("--measure", action="store_true", help="/completion n_predict=0 で prefill 時間も測る（llama.cpp のみ）")
+    p.add_argument("--rounds", type=int, default=3, help="--measure の繰り返し回数（平均を出す）")
+    p.add_argument("--slot", type=int, default=0, help="--measure で使う slot（連続したリクエストを同じ slot に乗せる）")
+    args = p.parse_args()
+
+    client = get_client()
+    summary = {}
+    for layout in args.layouts.split(","):
+        summary[layout] = report(client, layout, args.measure, args.rounds, args.slot)
+
+    if len(summary) > 1:
+        print(f"\n{'layout':<14} {'tokens':>7} {'new':>7}" + (f" {'prefill_ms':>11}" if args.measure else ""))
+        for layout, s in summary.items():
+            line = f"{layout:<14} {s['tokens']:>7} {s['tokens'] - s['shared']:>7}"
+            if args.measure:
+                line += f" {s['prefill_ms']:>11.1f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
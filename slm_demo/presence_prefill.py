@@ -0,0 +1,131 @@
+# presence_prefill.py
+import threading
+import time
+from typing import List, Optional
+
+from config import LLM_BACKEND, PRESENCE_PREFILL_SLOT, PRESENCE_PREFILL_WAIT_S
+from llm_client import STAGE_HEADER, TRACE_HEADER, LLMClient, LLMHTTPError, get_client
+from span_trace import SPANS
+
+
+class PresencePrefill:
+    """
+    人感センサが反応した時点（ノブを読んで Q1 を頼む前）に、Q1 のプロンプトを prefill だけしておく。
+
+    - pretokenized が使えれば、本番と同じトークン列を /completion に n_predict=0 で
+    - それ以外は proxy の /v1/prefill（チャットテンプレートを適用して同じく n_predict=0・cache_prompt）
+    - inproc はプロセス内のモデルで同じプロンプトを評価しておく（モデルは1つなので slot は無い）
+    - prefill と本番の Q1 は同じ slot（PRESENCE_PREFILL_SLOT）に固定する。prefill が終わる前に本番が来ても
+      llama.cpp は slot の空きを待つので、本番で評価されるのは一致しなかった末尾だけになる
+    - ただし本番が prefill より先に llama.cpp へ着くと prefill が後回しになって無駄になるので、
+      本番を送る前に prefill の完了を PRESENCE_PREFILL_WAIT_S まで待つ（どのみち同じ slot の空きを待つ時間）
+    - proxy が対応していない（gemini backend・古い proxy）と分かったら以後は投げない
+    """
+
+    def __init__(self, pretokenized=None, slot: int = PRESENCE_PREFILL_SLOT, wait_s: float = PRESENCE_PREFILL_WAIT_S):
+        self.pretokenized = pretokenized
+        self.slot = slot
+        self.wait_s = wait_s
+        self.available = True
+        self._done = threading.Event()
+        self._done.set()
+        self._t_done: Optional[float] = None
+        self._pending = False
+        self.stats = {"fired": 0, "done": 0, "failed": 0, "skipped": 0, "claimed": 0, "late": 0}
+        self._prompt_n: List[int] = []
+        self._prompt_ms: List[float] = []
+        self._wall_ms: List[float] = []
+        self._lead_ms: List[float] = []
+        self._wait_ms: List[float] = []
+
+    def fire(self, stage: str, messages, values: dict, tokens: bool = True, client: Optional[LLMClient] = None) -> None:
+        """
+        バックグラウンドで prefill を投げる（待たない）。tokens=False なら pretokenized を使わない（stem など）
+        """
+        if not self.available:
+            self.skip()
+            return
+        self.stats["fired"] += 1
+        self._pending = True
+        self._done.clear()
+        self._t_done = None
+        threading.Thread(target=self._run, args=(stage, messages, values, tokens, client), daemon=True).start()
+
+    def _run(self, stage: str, messages, values: dict, tokens: bool, client: Optional[LLMClient]) -> None:
+        trace = SPANS.request_id(f"{stage}_prefill")
+        started = time.time()
+        t0 = time.perf_counter()
+        try:
+            obj = None
+            if LLM_BACKEND == "inproc" and client is None:
+                from llm_inproc import get_inproc
+
+                get_inproc().warmup(messages)
+                obj = {}
+            elif tokens and client is None and self.pretokenized is not None and self.pretokenized.available:
+                obj = self.pretokenized.prefill(stage, values, self.slot, trace)
+            if obj is None:
+                headers = {STAGE_HEADER: stage}
+                if trace:
+                    headers[TRACE_HEADER] = trace
+                obj = (client or get_client()).post_json("/v1/prefill", {"messages": messages, "id_slot": self.slot}, headers)
+        except LLMHTTPError as e:
+            self.stats["failed"] += 1
+            if e.code in (400, 404):
+                self.available = False
+            print(f"\n[prefill] disabled: {e}", flush=True)
+            return
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"\n[prefill] failed: {e}", flush=True)
+            return
+        finally:
+            self._t_done = time.perf_counter()
+            self._done.set()
+
+        wall_ms = (self._t_done - t0) * 1000.0
+        timings = obj.get("timings") or {}
+        self.stats["done"] += 1
+        self._wall_ms.append(wall_ms)
+        if isinstance(timings.get("prompt_n"), int):
+            self._prompt_n.append(timings["prompt_n"])
+        if isinstance(timings.get("prompt_ms"), (int, float)):
+            self._prompt_ms.append(float(timings["prompt_ms"]))
+        SPANS.record(trace, stage, "client.prefill", started, wall_ms, slot=self.slot, prompt_n=timings.get("prompt_n"))
+
+    def skip(self) -> None:
+        # 作り置きの Q1 を出すときなど、prefill しなかったセッション
+        self.stats["skipped"] += 1
+        self._pending = False
+
+    def claim(self) -> None:
+        """
+        本番の Q1 を頼む直前に呼ぶ。prefill がどれだけ先に終わっていたか（lead）を記録する。
+        まだ終わっていなければ wait_s まで待ち（late）、待った時間を記録する
+        """
+        if not self._pending:
+            return
+        self._pending = False
+        self.stats["claimed"] += 1
+        if self._done.is_set():
+            if self._t_done is not None:
+                self._lead_ms.append((time.perf_counter() - self._t_done) * 1000.0)
+            return
+        self.stats["late"] += 1
+        t0 = time.perf_counter()
+        self._done.wait(self.wait_s)
+        self._wait_ms.append((time.perf_counter() - t0) * 1000.0)
+
+    def snapshot(self) -> dict:
+        def avg(xs):
+            return round(sum(xs) / len(xs), 1) if xs else None
+
+        st = dict(self.stats)
+        st["slot"] = self.slot
+        st["available"] = self.available
+        st["prompt_n_avg"] = avg(self._prompt_n)
+        st["prompt_ms_avg"] = avg(self._prompt_ms)
+        st["wall_ms_avg"] = avg(self._wall_ms)
+        st["lead_ms_avg"] = avg(self._lead_ms)
+        st["wait_ms_avg"] = avg(self._wait_ms)
+        return st
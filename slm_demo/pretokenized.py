@@ -0,0 +1,228 @@
+# pretokenized.py
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from llm_client import (
+    STAGE_HEADER,
+    TRACE_HEADER,
+    CompletionResult,
+    LLMClient,
+    LLMHTTPError,
+    get_client,
+    stream_call_events,
+)
+from early_stop import EarlyStop, early_stop_for
+from llm_stream import StreamEvent, StreamSink, collect_stream
+from stream_sinks import ConsoleSink
+from prompts import STAGE_MESSAGES, STAGE_SLOTS, build_stage_messages
+
+# 可変スロットの目印（プロンプト本文に出てこない私用領域の文字）
+_SLOT_OPEN = "\ue000"
+_SLOT_CLOSE = "\ue001"
+_SLOT_RE = re.compile(_SLOT_OPEN + r"(\w+)" + _SLOT_CLOSE)
+
+Piece = Tuple[str, Union[List[int], str]]   # ("const", tokens) | ("var", slot名)
+
+
+def parse_completion_chunk(obj: dict) -> Tuple[Optional[str], Optional[str], Optional[int], bool]:
+    """
+    llama.cpp ネイティブ /completion の chunk。stop=true の chunk で終わる
+    """
+    delta = obj.get("content")
+    if not obj.get("stop"):
+        return (delta if isinstance(delta, str) else None), None, None, False
+    reason = "length" if obj.get("stop_type") == "limit" else "stop"
+    tokens = obj.get("tokens_predicted")
+    return (delta if isinstance(delta, str) else None), reason, (tokens if isinstance(tokens, int) else None), True
+
+
+def _slot_values(stage: str) -> Dict[str, str]:
+    return {name: f"{_SLOT_OPEN}{name}{_SLOT_CLOSE}" for name in STAGE_SLOTS[stage]}
+
+
+class PretokenizedPrompter:
+    """
+    チャットテンプレート適用済みのプロンプトを「定型部分のトークン列 + 可変スロット」に分解してキャッシュし、
+    リクエスト時は可変スロットだけをトークナイズして /completion にトークン配列で送る。
+
+    - 分解はスロットに目印文字を入れて /apply-template し、目印で split する（モデルごとに1回）
+    - 連結位置でトークン境界が変わり得るので、スロットは改行や記号で区切られた位置にある前提
+    - 失敗したら available=False にして chat 経路へ戻る
+    """
+
+    def __init__(self, client: Optional[LLMClient] = None):
+        # chat 経路と同じ keep-alive 接続（LLAMA_URL / LLAMA_UDS の proxy）を使う
+        self.client = client or get_client()
+        self.available = True
+        self._model: Optional[str] = None
+        self._templates: Dict[Tuple[str, str], List[Piece]] = {}
+
+    def _tokenize(self, text: str, add_special: bool = False) -> List[int]:
+        obj = self.client.post_json("/tokenize", {"content": text, "add_special": add_special})
+        return [t if isinstance(t, int) else t.get("id", 0) for t in obj.get("tokens") or []]
+
+    def _model_id(self) -> str:
+        if self._model is None:
+            obj = self.client.get_json("/v1/models")
+            self._model = ((obj.get("data") or [{}])[0]).get("id") or "unknown"
+        return self._model
+
+    def _template(self, stage: str) -> List[Piece]:
+        key = (self._model_id(), stage)
+        pieces = self._templates.get(key)
+        if pieces is not None:
+            return pieces
+
+        messages = build_stage_messages(stage, _slot_values(stage))
+        prompt = self.client.post_json("/apply-template", {"messages": messages}).get("prompt") or ""
+
+        pieces = []
+        pos = 0
+        for m in _SLOT_RE.finditer(prompt):
+            if m.start() > pos:
+                # 先頭の定型部分だけ BOS 等の特殊トークンを付ける
+                pieces.append(("const", self._tokenize(prompt[pos:m.start()], add_special=not pieces)))
+            pieces.append(("var", m.group(1)))
+            pos = m.end()
+        if pos < len(prompt):
+            pieces.append(("const", self._tokenize(prompt[pos:], add_special=not pieces)))
+
+        self._templates[key] = pieces
+        return pieces
+
+    def _check_parity(self, stage: str, values: dict) -> bool:
+        """
+        スロットにそのまま値を差し込んだ本文が chat 経路の本文と一致するか（builder 内で加工される値は不可）
+        """
+        slot_msgs = build_stage_messages(stage, _slot_values(stage))
+        real_msgs = build_stage_messages(stage, values)
+        for sm, rm in zip(slot_msgs, real_msgs):
+            filled = _SLOT_RE.sub(lambda m: str(values[m.group(1)]), sm["content"])
+            if filled != rm["content"]:
+                return False
+        return True
+
+    def build_prompt_tokens(self, stage: str, values: dict) -> List[int]:
+        tokens: List[int] = []
+        for kind, v in self._template(stage):
+            if kind == "const":
+                tokens.extend(v)
+            else:
+                tokens.extend(self._tokenize(str(values[v])))
+        return tokens
+
+    def prepare(self, stage: str, values: dict) -> Optional[List[int]]:
+        """
+        プロンプトのトークン配列を作る。使えない場合は None（呼び出し側が chat 経路へ）。
+        """
+        if stage not in STAGE_MESSAGES or not self._check_parity(stage, values):
+            return None
+        try:
+            return self.build_prompt_tokens(stage, values)
+        except Exception as e:
+            print(f"[pretokenized] disabled: {e}", flush=True)
+            self.available = False
+            return None
+
+    def prefill(self, stage: str, values: dict, id_slot: int, trace: Optional[str] = None) -> Optional[dict]:
+        """
+        本番と同じトークン列を n_predict=0 で評価して slot の KV を温める（生成しない）。
+        トークン列が作れなければ None（呼び出し側が /v1/prefill へ）
+        """
+        prompt_tokens = self.prepare(stage, values)
+        if prompt_tokens is None:
+            return None
+        headers = {STAGE_HEADER: stage}
+        if trace:
+            headers[TRACE_HEADER] = trace
+        payload = {"prompt": prompt_tokens, "n_predict": 0, "cache_prompt": True, "id_slot": int(id_slot), "stream": False}
+        return self.client.post_json("/completion", payload, headers)
+
+    def stream_completion(
+        self,
+        stage: str,
+        prompt_tokens: List[int],
+        *,
+        temperature: float,
+        max_tokens: int,
+        top_p: float = 0.9,
+        top_k: int = 40,
+        repeat_penalty: float = 1.1,
+        cancel: Optional[threading.Event] = None,
+        early_stop: Optional[EarlyStop] = None,
+        constraint: Optional[dict] = None,
+        trace: Optional[str] = None,
+        id_slot: Optional[int] = None,
+    ) -> Iterator[StreamEvent]:
+        """
+        /completion を stream で呼び、stream_chat_completion と同じイベントを yield する。
+        """
+        payload = {
+            "prompt": prompt_tokens,
+            "n_predict": int(max_tokens),
+            "temperature": float(temperature),
+            "top_p": float(top_p),
+            "top_k": int(top_k),
+            "repeat_penalty": float(repeat_penalty),
+            "cache_prompt": True,
+            "stream": True,
+        }
+        payload.update(constraint or {})
+        if id_slot is not None:
+            payload["id_slot"] = int(id_slot)
+        headers = {"Accept": "text/event-stream", STAGE_HEADER: stage}
+        if trace:
+            headers[TRACE_HEADER] = trace
+
+        t0 = time.perf_counter()
+        try:
+            with self.client.request("POST", "/completion", payload, headers) as call:
+                yield from stream_call_events(
+                    call, parse_completion_chunk, stage=stage, t0=t0, cancel=cancel, early_stop=early_stop
+                )
+        except LLMHTTPError:
+            raise
+        except Exception as e:
+            raise RuntimeError(f"Request failed: {e}") from e
+
+    def completion_ex(
+        self,
+        stage: str,
+        values: dict,
+        *,
+        temperature: float,
+        max_tokens: int,
+        top_p: float = 0.9,
+        top_k: int = 40,
+        repeat_penalty: float = 1.1,
+        print_stream: bool = True,
+        cancel: Optional[threading.Event] = None,
+        sinks: Sequence[StreamSink] = (),
+        early_stop: bool = True,
+        constraint: Optional[dict] = None,
+        trace: Optional[str] = None,
+        id_slot: Optional[int] = None,
+    ) -> Optional[CompletionResult]:
+        """
+        chat_completion_ex と同じ結果型を返す。準備段階で失敗したら None（呼び出し側が chat 経路へ）。
+        """
+        prompt_tokens = self.prepare(stage, values)
+        if prompt_tokens is None:
+            return None
+        events = self.stream_completion(
+            stage,
+            prompt_tokens,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            top_k=top_k,
+            repeat_penalty=repeat_penalty,
+            cancel=cancel,
+            early_stop=early_stop_for(stage, max_tokens, verbose=print_stream) if early_stop else None,
+            constraint=constraint,
+            trace=trace,
+            id_slot=id_slot,
+        )
+        return collect_stream(events, ([ConsoleSink()] if print_stream else []) + list(sinks))
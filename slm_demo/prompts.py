@@ -1,4 +1,7 @@
 # prompts.py
+from typing import Optional
+
+from config import PROMPT_LAYOUT
 
 SYSTEM_PROMPT = """\
 あなたは「トイレ利用後のアンケート」を行う日本語システムです。
@@ -125,3 +128,309 @@ Q2番号の読み方:
 - 質問にしない
 - 日本語のみ
 """
+
+
+# -----------------------------
+# ステージごとのメッセージ構成
+# -----------------------------
+# (role, values -> content)。chat 経路と事前トークナイズ経路で同じ定義を使う。
+# ★ stage2 は build_stage2_user_prompt をそのまま効かせたいので SYSTEM_PROMPT(3択強制) を入れない
+LEGACY_STAGE_MESSAGES = {
+    "stage0": [
+        ("system", lambda v: SYSTEM_PROMPT),
+        ("user", lambda v: build_stage0_user_prompt(v["focus"], v["temp01"])),
+    ],
+    "stage1": [
+        ("system", lambda v: SYSTEM_PROMPT),
+        ("user", lambda v: build_stage1_user_prompt(v["satisfaction"], v["prev_question"], v["temp01"])),
+    ],
+    "stage2": [
+        ("user", lambda v: build_stage2_user_prompt(v["satisfaction"], v["reason"], v["temp01"])),
+    ],
+}
+
+
+# -----------------------------
+# prefix 共有レイアウト
+# -----------------------------
+# 3ステージ分の指示（定数）をすべて1つの system メッセージにまとめて先頭に置き、
+# 可変部分（観点・回答番号・直前の Q1）は最後の user メッセージにだけ入れる。
+# → 全ステージ・全セッションで system 部分のトークン列が一致し、llama.cpp の prompt cache が効く。
+# 指示文の中身は上の build_stage*_user_prompt と同じ（観点名などの差し込みを末尾に移しただけ）。
+STAGE0_RULES = """■ タスク Q1（最初の質問）
+役割: あなたは施設アンケートの質問設計者。トイレ利用体験の最初の質問(Q1)を作る。
+重要ルール:
+- 質問のテーマは必ず末尾で指定する「今回の観点」だけに絞る。
+- このQ1の回答番号は、次の質問でもそのまま解釈される。したがって番号の意味を固定すること。
+- Q1の選択肢は必ず次の意味にする:
+  1: 今回の観点に満足した / 良かった
+  2: 今回の観点は普通だった
+  3: 今回の観点が気になった / 不満があった
+- 施設全体の総合評価には広げない。
+- 他の観点へ話題を広げない。
+出力条件:
+- 1〜2文
+- 必ず3択
+- 「1:」「2:」「3:」を含む
+- 選択肢の文言は短く、上の意味が一目で伝わる表現にする
+"""
+
+STAGE1_RULES = """■ タスク Q2（深掘り質問）
+- Q1では番号を次の意味で使っている:
+  1: 良かった / 満足
+  2: 普通
+  3: 気になった / 不満
+- 末尾に示す「直前に出したQ1」と「ユーザーがQ1で選んだ番号」を受けて、次に表示する「深掘り質問(Q2)」を1つ作る。
+- 必ず Q1 と同じテーマの続きとして読める内容にする。
+- Q1の文面から名詞や表現を1つ以上そのまま再利用する。
+- Q1より一段だけ具体的に聞く。話を広げすぎない。
+- 必ず 1/2/3 の3択で、「1:」「2:」「3:」を含める。
+Q2の作り方:
+- もし回答が1なら、良かった点を具体化して聞く。
+- もし回答が2なら、印象が弱かった理由や改善の余地を軽く聞く。
+- もし回答が3なら、気になった点を丁寧に具体化して聞く。
+重要:
+- 最終お礼文では Q2の回答番号だけが渡される。したがって、Q2の番号の意味も分かりやすく保つこと。
+- Q2の選択肢は、回答1が比較的ポジティブ、回答2が中立、回答3が比較的ネガティブになるように並べる。
+- ただし Q1の回答が3だった場合は、1を「少し気になる」、2を「かなり気になる」、3を「特に困った / 強く不満」にしてよい。
+- 選択肢の意味が文面から自然に分かるようにする。番号だけ見ても温度感が想像できる表現にする。
+出力条件:
+- 1〜2文
+- 短く自然な日本語
+- 1つの質問と3つの選択肢だけを出す
+出力イメージ:
+ありがとうございます。清潔さで特に印象に残ったのはどれですか？ 1:とても良かった 2:ふつうだった 3:少し気になった
+"""
+
+STAGE2_RULES = """■ タスク THANKS（お礼メッセージ）
+- Q1の意味は 1:満足 2:普通 3:不満寄り。
+- Q2番号の読み方:
+  - Q1が1のとき: 1: 特に良かった / 2: ふつうに良かった・決め手は弱い / 3: 良かったが少し気になる点もあった
+  - Q1が2のとき: 1: やや良かった点がある / 2: 特に印象はない・中立 / 3: やや気になる点がある
+  - Q1が3のとき: 1: 少し気になった / 2: かなり気になった / 3: 特に困った・強く不満だった
+- 末尾に示す回答番号の組み合わせに自然に合う「お礼メッセージ」を1〜2文で作る。
+- 良かった寄りなら前向きに感謝する。
+- 中立なら率直な回答への感謝を伝える。
+- 気になる点や不満がある場合は、短く受け止めて今後の改善に活かす姿勢をにじませる。
+- 誇張しすぎず、短く自然にまとめる。
+- 最後は必ず「またのご利用をお待ちしております。」で締める。
+- 選択肢は出さない。質問にしない。日本語のみ。
+"""
+
+# 全ステージ共通の制約だけ。SYSTEM_PROMPT の「質問は必ず3択」は THANKS に効かせないよう入れず、
+# 選択肢を出すか出さないかは各タスクの規則（Q1/Q2 は3択、THANKS は選択肢なし）に書く
+SHARED_COMMON_RULES = """\
+あなたは「トイレ利用後のアンケート」を行う日本語システムです。
+制約:
+- 出力は必ず日本語のみ。
+- 余計な前置きや長い説明は不要。1〜2文で短く、丁寧で自然にする。
+- 直前までの質問文と回答番号の意味を保ち、勝手に話題や評価軸を変えない。
+"""
+
+SHARED_SYSTEM_PROMPT = (
+    SHARED_COMMON_RULES
+    + "\n以下の3種類のタスクのうち、最後のメッセージで指定されたものだけを行う。"
+    + "選択肢の有無を含め、そのタスクの規則だけに従い、他のタスクの規則は使わない。\n\n"
+    + STAGE0_RULES
+    + "\n"
+    + STAGE1_RULES
+    + "\n"
+    + STAGE2_RULES
+)
+
+
+def build_stage0_tail(focus: str) -> str:
+    return f"""タスク: Q1
+今回の観点: 「{focus}」
+出力例:
+トイレの{focus}はいかがでしたか？
+1:満足した 2:普通だった 3:気になった
+"""
+
+
+def build_stage1_tail(satisfaction_123: str, prev_question_text: str) -> str:
+    # 先行生成の3分岐で Q1 本文までは共通になるよう、回答番号を最後に置く
+    return f"""タスク: Q2
+直前に出したQ1:
+--- Q1ここから ---
+{prev_question_text.strip()}
+--- Q1ここまで ---
+ユーザーがQ1で選んだ番号: {satisfaction_123}
+"""
+
+
+def build_stage2_tail(satisfaction_123: str, reason_123: str) -> str:
+    return f"""タスク: THANKS
+Q1の回答番号: {satisfaction_123}
+Q2の回答番号: {reason_123}
+"""
+
+
+PREFIX_FIRST_STAGE_MESSAGES = {
+    "stage0": [
+        ("system", lambda v: SHARED_SYSTEM_PROMPT),
+        ("user", lambda v: build_stage0_tail(v["focus"])),
+    ],
+    "stage1": [
+        ("system", lambda v: SHARED_SYSTEM_PROMPT),
+        ("user", lambda v: build_stage1_tail(v["satisfaction"], v["prev_question"])),
+    ],
+    "stage2": [
+        ("system", lambda v: SHARED_SYSTEM_PROMPT),
+        ("user", lambda v: build_stage2_tail(v["satisfaction"], v["reason"])),
+    ],
+}
+
+STAGE_LAYOUTS = {
+    "legacy": LEGACY_STAGE_MESSAGES,
+    "prefix_first": PREFIX_FIRST_STAGE_MESSAGES,
+}
+
+STAGE_MESSAGES = STAGE_LAYOUTS[PROMPT_LAYOUT]
+
+# 各ステージの可変スロット名
+STAGE_SLOTS = {
+    "stage0": ("focus", "temp01"),
+    "stage1": ("satisfaction", "prev_question", "temp01"),
+    "stage2": ("satisfaction", "reason", "temp01"),
+}
+
+
+def build_stage_messages(stage: str, values: dict, layout: Optional[str] = None) -> list:
+    table = STAGE_LAYOUTS[layout] if layout else STAGE_MESSAGES
+    return [{"role": role, "content": fn(values)} for role, fn in table[stage]]
+
+
+# -----------------------------
+# 定型文（LLM を使わない/使えないとき用）
+# -----------------------------
+# 選択肢の意味は build_stage0_user_prompt / build_stage1_user_prompt / build_stage2_user_prompt で固定したものと同じ
+STAGE0_OPTIONS = ("満足した", "普通だった", "気になった")
+
+# Q1 の回答ごとの Q2 選択肢（stage2 の「Q2番号の読み方」と一致させる）
+STAGE1_OPTIONS = {
+    "1": ("とても良かった", "ふつうに良かった", "少し気になる点もあった"),
+    "2": ("やや良かった点がある", "特に印象はない", "やや気になる点がある"),
+    "3": ("少し気になった", "かなり気になった", "特に困った"),
+}
+
+THANKS_CLOSING = "またのご利用をお待ちしております。"
+
+
+def render_choices(stem: str, options) -> str:
+    return f"{stem.strip()}\n" + " ".join(f"{i}:{o}" for i, o in enumerate(options, 1))
+
+
+def template_stage0(focus: str) -> str:
+    return render_choices(f"トイレの{focus}はいかがでしたか？", STAGE0_OPTIONS)
+
+
+def template_stage1(satisfaction_123: str, focus: str) -> str:
+    stem = {
+        "1": f"ありがとうございます。{focus}はどのくらい良かったですか？",
+        "2": f"ありがとうございます。{focus}で印象に残った点はありましたか？",
+        "3": f"ご回答ありがとうございます。{focus}はどの程度気になりましたか？",
+    }.get(satisfaction_123, f"ありがとうございます。{focus}について、もう少し教えてください。")
+    return render_choices(stem, STAGE1_OPTIONS.get(satisfaction_123, STAGE1_OPTIONS["2"]))
+
+
+def template_stage2(satisfaction_123: str, reason_123: str) -> str:
+    if satisfaction_123 == "1":
+        body = "ご満足いただけたとのこと、大変うれしく思います。"
+    elif satisfaction_123 == "3" or reason_123 == "3":
+        body = "貴重なご意見をありがとうございます。いただいた声を今後の改善に活かしてまいります。"
+    else:
+        body = "率直なご回答をありがとうございます。"
+    return body + THANKS_CLOSING
+
+
+def template_stage_text(stage: str, values: dict, focus: str) -> str:
+    if stage == "stage0":
+        return template_stage0(focus)
+    if stage == "stage1":
+        return template_stage1(values.get("satisfaction", "2"), focus)
+    return template_stage2(values.get("satisfaction", "2"), values.get("reason", "2"))
+
+
+# -----------------------------
+# 文面の一部だけを LLM に書かせるモード（GENERATION_MODE = "stem"）
+# -----------------------------
+# LLM は質問文（THANKS はお礼の1文）だけを書き、選択肢と締めの一文は上の定型から組み立てる。
+# 選択肢の意味は固定なので、モデルが毎回 3択を書き直す分のトークンを省ける。
+STEM_SYSTEM_PROMPT = """\
+あなたはトイレ利用後アンケートの文面を書くアシスタントです。
+- 日本語で、丁寧に短く、1文だけ書く。
+- 選択肢や番号は書かない（選択肢はこちらで付ける）。
+- 前置き・説明・引用符は書かない。
+タスク Q1: 末尾の「観点」について、利用者の満足度をたずねる質問文を書く。30文字以内で「？」で終わる。
+タスク Q2: 末尾の「直前の質問」と「回答」を受けて、同じ観点を一段だけ具体的にたずねる質問文を書く。末尾の「選択肢」で自然に答えられる内容にする。40文字以内で「？」で終わる。
+タスク THANKS: 末尾の回答に合うお礼の1文を書く。良かった寄りなら前向きに、気になる点があれば受け止めて改善の姿勢を示す。40文字以内で「。」で終わる。締めのあいさつは書かない。
+"""
+
+SATISFACTION_MEANING = {"1": "満足", "2": "普通", "3": "不満寄り"}
+
+
+def build_stem_tail(stage: str, values: dict) -> str:
+    if stage == "stage0":
+        return f"タスク: Q1\n観点: {values['focus']}\n"
+    sat = values["satisfaction"]
+    options = STAGE1_OPTIONS.get(sat, STAGE1_OPTIONS["2"])
+    if stage == "stage1":
+        return (
+            "タスク: Q2\n"
+            f"直前の質問: {values['prev_question'].strip()}\n"
+            f"回答: {sat}（{SATISFACTION_MEANING.get(sat, '普通')}）\n"
+            f"選択肢: " + " ".join(f"{i}:{o}" for i, o in enumerate(options, 1)) + "\n"
+        )
+    reason = values["reason"]
+    meaning = options[int(reason) - 1] if reason in ("1", "2", "3") else options[1]
+    return (
+        "タスク: THANKS\n"
+        f"Q1の回答: {sat}（{SATISFACTION_MEANING.get(sat, '普通')}）\n"
+        f"Q2の回答: {reason}（{meaning}）\n"
+    )
+
+
+def build_stem_messages(stage: str, values: dict) -> list:
+    return [
+        {"role": "system", "content": STEM_SYSTEM_PROMPT},
+        {"role": "user", "content": build_stem_tail(stage, values)},
+    ]
+
+
+_STEM_ENDS = {"stage0": "？?", "stage1": "？?", "stage2": "。！!"}
+
+
+def clean_stem(stage: str, text: str) -> Optional[str]:
+    """
+    LLM の出力から1文目だけを取り出す。選択肢を書いてきたらその手前で切る。使えなければ None。
+    """
+    line = (text or "").strip().split("\n")[0].strip().strip("「」\"'")
+    for mark in ("1:", "1：", "１:", "１："):
+        if mark in line:
+            line = line[: line.index(mark)].strip()
+    line = line.replace(THANKS_CLOSING, "").strip()
+    if stage == "stage2" and ("？" in line or "?" in line):
+        # お礼が質問になっていたら使わない
+        return None
+    ends = _STEM_ENDS.get(stage, "。")
+    cut = [line.index(c) for c in ends if c in line]
+    if cut:
+        line = line[: min(cut) + 1]
+    elif line:
+        line += ends[0]
+    return line if len(line) >= 4 else None
+
+
+def assemble_stage_text(stage: str, stem_text: str, values: dict, focus: str) -> str:
+    """
+    LLM が書いた1文 + 定型の選択肢（THANKS は締めの一文）で、full 生成と同じ表示形式の文面を作る
+    """
+    stem = clean_stem(stage, stem_text)
+    if stem is None:
+        return template_stage_text(stage, values, focus)
+    if stage == "stage0":
+        return render_choices(stem, STAGE0_OPTIONS)
+    if stage == "stage1":
+        return render_choices(stem, STAGE1_OPTIONS.get(values.get("satisfaction", "2"), STAGE1_OPTIONS["2"]))
+    return stem + THANKS_CLOSING
@@ -0,0 +1,238 @@
+# question_bank.py
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import (
+    QUESTION_BANK_KNOB_STEPS,
+    QUESTION_BANK_PATH,
+    QUESTION_BANK_PER_KEY,
+    QUESTION_BANK_TTL_S,
+)
+
+Key = Tuple[str, int, int]   # (focus, temp バケット, top_k バケット)
+
+
+def knob_bucket(temp01: float, topk01: float, steps: int = QUESTION_BANK_KNOB_STEPS) -> Tuple[int, int]:
+    n = steps - 1
+    return (int(round(min(1.0, max(0.0, temp01)) * n)), int(round(min(1.0, max(0.0, topk01)) * n)))
+
+
+def bucket_center(bucket: Tuple[int, int], steps: int = QUESTION_BANK_KNOB_STEPS) -> Tuple[float, float]:
+    n = steps - 1
+    return (bucket[0] / n, bucket[1] / n)
+
+
+class QuestionBank:
+    """
+    Q1 は「観点(focus)」と「ノブ値」だけで決まるので、待機中に作り置きしておく。
+
+    - キーは (focus, 量子化したノブのバケット)。キーごとに per_key 件まで保持
+    - 補充は待機中(set_idle(True))だけ。セッションが始まったら生成中の補充も止める
+    - set_paused(True) の間は待機中でも補充しない（熱・負荷で絞っているとき。thermal.py）
+    - 補充するのは「今のノブ位置」のバケットだけ（全バケットを埋めると Pi では終わらない）
+    - ttl_s を過ぎたものは捨てる。プールは JSON で永続化し、再起動後も使う
+    - take() で使った分は印だけ付け、補充スレッドが次に動くとき（セッションが終わって待機に戻ったとき）に保存する
+      （表示経路でファイルを書かない。再起動しても使った質問は出さない）
+    """
+
+    HIT_AGES_WINDOW = 200
+
+    def __init__(
+        self,
+        focus_list: List[str],
+        generate_fn: Callable,
+        path: Optional[str] = QUESTION_BANK_PATH,
+        per_key: int = QUESTION_BANK_PER_KEY,
+        ttl_s: float = QUESTION_BANK_TTL_S,
+        steps: int = QUESTION_BANK_KNOB_STEPS,
+    ):
+        """
+        generate_fn(focus, temp01, topk01, cancel_event) -> CompletionResult
+        """
+        self.focus_list = list(focus_list)
+        self.generate_fn = generate_fn
+        self.path = path
+        self.per_key = per_key
+        self.ttl_s = ttl_s
+        self.steps = steps
+
+        self._lock = threading.Lock()
+        self._pool: Dict[Key, deque] = {}
+        self._bucket = knob_bucket(0.5, 0.5, steps)
+        self._idle = threading.Event()
+        self._cancel = threading.Event()
+        self._stopped = False
+        self._paused = False
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "filled": 0, "fill_errors": 0}
+        self._hit_ages: deque = deque(maxlen=self.HIT_AGES_WINDOW)
+        self._dirty = False
+        self.load()
+
+    # -------- 参照側（engine.start） --------
+    def take(self, focus: str, temp01: float, topk01: float) -> Optional[str]:
+        key = (focus,) + knob_bucket(temp01, topk01, self.steps)
+        now = time.time()
+        with self._lock:
+            q = self._pool.get(key)
+            while q:
+                ent = q.popleft()
+                self._dirty = True
+                if now - ent["created"] > self.ttl_s:
+                    self.stats["expired"] += 1
+                    continue
+                self.stats["hits"] += 1
+                self._hit_ages.append(now - ent["created"])
+                return ent["text"]
+            self.stats["misses"] += 1
+            return None
+
+    def ready(self, focus: str, temp01: float, topk01: float) -> bool:
+        """
+        take() が作り置きを返せるか（取り出さない・統計も数えない）
+        """
+        key = (focus,) + knob_bucket(temp01, topk01, self.steps)
+        now = time.time()
+        with self._lock:
+            return any(now - ent["created"] <= self.ttl_s for ent in self._pool.get(key) or ())
+
+    def set_knobs(self, temp01: float, topk01: float) -> None:
+        self._bucket = knob_bucket(temp01, topk01, self.steps)
+
+    def set_idle(self, idle: bool) -> None:
+        """
+        セッション中は False。補充中の生成は cancel して llama.cpp を本番に空ける。
+        """
+        if idle:
+            self._cancel.clear()
+            self._idle.set()
+        else:
+            self._idle.clear()
+            self._cancel.set()
+
+    def set_paused(self, paused: bool) -> None:
+        self._paused = paused
+        if paused:
+            self._cancel.set()
+        elif self._idle.is_set():
+            self._cancel.clear()
+
+    # -------- 補充スレッド --------
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._fill_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._cancel.set()
+        self._idle.set()
+        if self._dirty:
+            self.save()
+
+    def _next_key(self) -> Optional[Key]:
+        now = time.time()
+        with self._lock:
+            best = None
+            best_n = self.per_key
+            for focus in self.focus_list:
+                key = (focus,) + self._bucket
+                q = self._pool.setdefault(key, deque())
+                while q and now - q[0]["created"] > self.ttl_s:
+                    q.popleft()
+                    self._dirty = True
+                    self.stats["expired"] += 1
+                if len(q) < best_n:
+                    best, best_n = key, len(q)
+            return best
+
+    def _fill_loop(self) -> None:
+        while not self._stopped:
+            self._idle.wait()
+            if self._stopped:
+                return
+            if self._dirty:
+                self.save()
+            if self._paused:
+                time.sleep(1.0)
+                continue
+            key = self._next_key()
+            if key is None:
+                # 今のバケットは満杯。ノブが回るか期限切れが出るまで少し待つ
+                time.sleep(5.0)
+                continue
+
+            temp01, topk01 = bucket_center(key[1:], self.steps)
+            try:
+                res = self.generate_fn(key[0], temp01, topk01, self._cancel)
+            except Exception as e:
+                self.stats["fill_errors"] += 1
+                print(f"[bank] fill failed: {e}", flush=True)
+                time.sleep(10.0)
+                continue
+
+            if res is None or res.cancelled or res.truncated or not res.text:
+                continue
+            with self._lock:
+                q = self._pool.setdefault(key, deque())
+                if len(q) < self.per_key:
+                    q.append({"text": res.text, "created": time.time()})
+                    self.stats["filled"] += 1
+            self.save()
+
+    # -------- 永続化 --------
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                obj = json.load(f)
+        except Exception:
+            return
+        now = time.time()
+        for ent in obj.get("entries") or []:
+            if now - ent.get("created", 0) > self.ttl_s:
+                continue
+            key = (ent["focus"], int(ent["bucket"][0]), int(ent["bucket"][1]))
+            if ent["focus"] not in self.focus_list:
+                continue
+            q = self._pool.setdefault(key, deque())
+            if len(q) < self.per_key:
+                q.append({"text": ent["text"], "created": ent["created"]})
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            self._dirty = False
+            entries = [
+                {"focus": k[0], "bucket": [k[1], k[2]], "text": e["text"], "created": e["created"]}
+                for k, q in self._pool.items()
+                for e in q
+            ]
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"[bank] save failed: {e}", flush=True)
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            ages = [now - e["created"] for q in self._pool.values() for e in q]
+            size = len(ages)
+        st = dict(self.stats)
+        taken = st["hits"] + st["misses"]
+        st["hit_rate"] = (st["hits"] / taken) if taken else None
+        st["pool_size"] = size
+        st["pool_age_avg_s"] = (sum(ages) / size) if size else None
+        st["hit_age_avg_s"] = (sum(self._hit_ages) / len(self._hit_ages)) if self._hit_ages else None
+        st["bucket"] = list(self._bucket)
+        return st
@@ -2,6 +2,7 @@
 import time
 from state_machine import ToiletFeedbackEngine
 from input_gpio import GPIOInput
+from latency_trace import TRACER
 
 
 def show(msg: str):
@@ -10,12 +11,13 @@ def show(msg: str):
     print("=" * 50 + "\n", flush=True)
 
 
-def apply_knobs(inp: GPIOInput, eng: ToiletFeedbackEngine, tag: str = ""):
+def apply_knobs(inp: GPIOInput, eng: ToiletFeedbackEngine, tag: str = "", stage: str = ""):
     """
     可変抵抗2つ(CH0=temp, CH1=top_k)を読み、Engineへ反映。
-    tag はログ用（任意）。
+    tag はログ用（任意）。stage はトレース用（これから生成するステージ）。
     """
     knobs = inp.read_knobs01()
+    TRACER.mark("knob", stage)
     eng.set_knobs(knobs["temp01"], knobs["topk01"])
     print(
         f"[KNOBS]{' '+tag if tag else ''} temp01={knobs['temp01']:.3f} topk01={knobs['topk01']:.3f}",
@@ -23,6 +25,37 @@ def apply_knobs(inp: GPIOInput, eng: ToiletFeedbackEngine, tag: str = ""):
     )
 
 
+def generate(inp: GPIOInput, eng: ToiletFeedbackEngine, fn, *args):
+    """
+    生成の間だけボタンを先取りする。(表示する文面, 生成中に押された番号 or None) を返す。
+    押されたら残りの生成は打ち切られ、その番号が回答になる。
+    """
+    ta = eng.type_ahead
+    if ta is None:
+        return fn(*args), None
+    ta.open()
+    inp.capture_presses(ta.press)
+    try:
+        text = fn(*args)
+    finally:
+        inp.capture_presses(None)
+        early = ta.close()
+    return text, early
+
+
+def read_answer(inp: GPIOInput, eng: ToiletFeedbackEngine, early, stage: str) -> str:
+    """
+    先取りした番号があればそれを（押された時刻でトレース）、なければボタンを待つ
+    """
+    if early is None:
+        ans = inp.wait_for_button_123()
+        TRACER.mark("button", stage)
+        return ans
+    TRACER.mark("button", stage, eng.type_ahead.t_press)
+    inp.wait_for_release()
+    return early
+
+
 def main():
     inp = GPIOInput(
         pir_pin=23,
@@ -34,6 +67,7 @@ def main():
         spi_device=0,
     )
     eng = ToiletFeedbackEngine()
+    eng.start_background()
 
     print("=== LLM Toilet Feedback (GPIO版 / ターミナル出力) ===", flush=True)
     print("人感(PIR)で開始 → ボタン1/2/3 → ボタン1/2/3", flush=True)
@@ -44,38 +78,45 @@ def main():
         while True:
             print("[WAIT] 人感センサ待ち...", flush=True)
             inp.wait_for_presence()
+            TRACER.new_session()
+            TRACER.mark("pir", "stage0")
+            # ノブを読む前に Q1 のプロンプトの prefill を投げておく（待たない）
+            eng.on_presence()
 
             # セッション開始直前のノブ値を読む（開始時点）
-            apply_knobs(inp, eng, "start")
+            apply_knobs(inp, eng, "start", "stage0")
 
             # Q1（満足度質問）をLLM生成
             show("[Q1] 生成中（満足度質問）...")
-            q1 = eng.start()
+            q1, early = generate(inp, eng, eng.start)
             show(f"[Q1]\n{q1}\n\n入力: 1/2/3ボタン")
+            TRACER.mark("display", "stage0")
 
-            # 満足度入力
-            ans1 = inp.wait_for_button_123()
-            print(f"[IN] satisfaction={ans1}", flush=True)
+            # 満足度入力（生成中に押されていればそれを使う）
+            ans1 = read_answer(inp, eng, early, "stage1")
+            print(f"[IN] satisfaction={ans1}{'（先取り）' if early else ''}", flush=True)
 
             # Q2生成直前：ノブを回した効果を反映
-            apply_knobs(inp, eng, "before Q2")
+            apply_knobs(inp, eng, "before Q2", "stage1")
 
             # Q2（深掘り質問）をLLM生成
             show("[Q2] 生成中（深掘り質問）...")
-            q2 = eng.handle_choice(ans1)
+            q2, early = generate(inp, eng, eng.handle_choice, ans1)
             show(f"[Q2]\n{q2}\n\n入力: 1/2/3ボタン")
+            TRACER.mark("display", "stage1")
 
-            # 理由入力
-            ans2 = inp.wait_for_button_123()
-            print(f"[IN] reason={ans2}", flush=True)
+            # 理由入力（生成中に押されていればそれを使う）
+            ans2 = read_answer(inp, eng, early, "stage2")
+            print(f"[IN] reason={ans2}{'（先取り）' if early else ''}", flush=True)
 
             # お礼生成直前：ノブを回した効果を反映
-            apply_knobs(inp, eng, "before THANKS")
+            apply_knobs(inp, eng, "before THANKS", "stage2")
 
             # お礼生成
             show("[THANKS] 生成中（お礼）...")
             thanks = eng.handle_choice(ans2)
             show(f"[THANKS]\n{thanks}")
+            TRACER.mark("display", "stage2")
 
             print("---- セッション終了。次の人を待ちます ----\n", flush=True)
 
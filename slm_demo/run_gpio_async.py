@@ -0,0 +1,186 @@
+# run_gpio_async.py
+import asyncio
+import time
+
+from config import ABSENCE_TIMEOUT_S, SESSION_TIMEOUT_S
+from input_gpio import GPIOInput
+from state_machine_async import AsyncToiletFeedbackEngine
+
+
+POLL_SEC = 0.02
+
+
+def show(msg: str):
+    print("\n" + "=" * 50, flush=True)
+    print(msg, flush=True)
+    print("=" * 50 + "\n", flush=True)
+
+
+def print_delta(delta: str):
+    # LLM の出力をトークンが届いた順にそのまま表示
+    print(delta, end="", flush=True)
+
+
+class Presence:
+    """
+    PIR をポーリングして最後に反応した時刻を持つ（センサ監視は独立タスク）
+    """
+
+    def __init__(self, inp: GPIOInput):
+        self.inp = inp
+        self.last_motion = 0.0
+
+    async def run(self):
+        while True:
+            if self.inp.motion_detected():
+                self.last_motion = time.monotonic()
+            await asyncio.sleep(POLL_SEC)
+
+    def absent_for(self) -> float:
+        return time.monotonic() - self.last_motion
+
+
+class Buttons:
+    """
+    ボタンをポーリングして押下エッジだけをキューに積む
+    """
+
+    def __init__(self, inp: GPIOInput):
+        self.inp = inp
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue()
+
+    async def run(self):
+        prev = None
+        while True:
+            cur = self.inp.poll_button_123()
+            if cur is not None and cur != prev:
+                self.queue.put_nowait(cur)
+            prev = cur
+            await asyncio.sleep(POLL_SEC)
+
+    def clear(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    async def wait_123(self) -> str:
+        return await self.queue.get()
+
+
+def apply_knobs(inp: GPIOInput, eng: AsyncToiletFeedbackEngine, tag: str = ""):
+    knobs = inp.read_knobs01()
+    eng.set_knobs(knobs["temp01"], knobs["topk01"])
+    print(
+        f"[KNOBS]{' '+tag if tag else ''} temp01={knobs['temp01']:.3f} topk01={knobs['topk01']:.3f}",
+        flush=True,
+    )
+
+
+async def session_flow(inp: GPIOInput, eng: AsyncToiletFeedbackEngine, buttons: Buttons):
+    """
+    run_gpio.py と同じ順序のフロー。各 await がキャンセル点になる。
+    """
+    buttons.clear()
+    apply_knobs(inp, eng, "start")
+
+    show("[Q1] 生成中（満足度質問）...")
+    print("LLM: ", end="", flush=True)
+    q1 = await eng.start(on_delta=print_delta)
+    print("")
+    show(f"[Q1]\n{q1}\n\n入力: 1/2/3ボタン")
+
+    ans1 = await buttons.wait_123()
+    print(f"[IN] satisfaction={ans1}", flush=True)
+
+    apply_knobs(inp, eng, "before Q2")
+    show("[Q2] 生成中（深掘り質問）...")
+    print("LLM: ", end="", flush=True)
+    q2 = await eng.handle_choice(ans1, on_delta=print_delta)
+    print("")
+    show(f"[Q2]\n{q2}\n\n入力: 1/2/3ボタン")
+
+    ans2 = await buttons.wait_123()
+    print(f"[IN] reason={ans2}", flush=True)
+
+    apply_knobs(inp, eng, "before THANKS")
+    show("[THANKS] 生成中（お礼）...")
+    print("LLM: ", end="", flush=True)
+    thanks = await eng.handle_choice(ans2, on_delta=print_delta)
+    print("")
+    show(f"[THANKS]\n{thanks}")
+
+
+async def absence_watchdog(presence: Presence):
+    """
+    ABSENCE_TIMEOUT_S 以上 PIR が反応しなければ戻る（= 立ち去り）
+    """
+    while presence.absent_for() < ABSENCE_TIMEOUT_S:
+        await asyncio.sleep(0.2)
+
+
+async def kiosk(inp: GPIOInput):
+    eng = AsyncToiletFeedbackEngine()
+    presence = Presence(inp)
+    buttons = Buttons(inp)
+    sensors = [asyncio.create_task(presence.run()), asyncio.create_task(buttons.run())]
+
+    try:
+        while True:
+            print("[WAIT] 人感センサ待ち...", flush=True)
+            while presence.absent_for() > POLL_SEC * 5:
+                await asyncio.sleep(POLL_SEC)
+
+            flow = asyncio.create_task(session_flow(inp, eng, buttons))
+            watchdog = asyncio.create_task(absence_watchdog(presence))
+            done, _ = await asyncio.wait({flow, watchdog}, timeout=SESSION_TIMEOUT_S, return_when=asyncio.FIRST_COMPLETED)
+
+            if flow in done:
+                watchdog.cancel()
+                try:
+                    flow.result()
+                    print("---- セッション終了。次の人を待ちます ----\n", flush=True)
+                except Exception as e:
+                    print(f"\n[ERROR] {e}", flush=True)
+            else:
+                # 立ち去り or セッションタイムアウト: 生成中でも接続ごと打ち切って待機へ戻る
+                reason = "absent" if watchdog in done else "timeout"
+                flow.cancel()
+                watchdog.cancel()
+                try:
+                    await flow
+                except (asyncio.CancelledError, Exception):
+                    pass
+                print(f"\n[ABORT] {reason} → 待機に戻ります (phase={eng.session.phase})", flush=True)
+
+            eng.reset()
+            # PIRが連続ONだとすぐ次に進む場合があるので少し待つ
+            await asyncio.sleep(1.0)
+    finally:
+        for t in sensors:
+            t.cancel()
+
+
+def main():
+    inp = GPIOInput(
+        pir_pin=23,
+        btn1_pin=16,
+        btn2_pin=20,
+        btn3_pin=21,
+        spi_bus=0,
+        spi_device=0,
+    )
+
+    print("=== LLM Toilet Feedback (GPIO版 / asyncio) ===", flush=True)
+    print("人感(PIR)で開始 → ボタン1/2/3 → ボタン1/2/3", flush=True)
+    print(f"PIR が {ABSENCE_TIMEOUT_S:.0f}s 反応しなければ生成中でも中断", flush=True)
+    print("Ctrl+Cで終了\n", flush=True)
+
+    try:
+        asyncio.run(kiosk(inp))
+    except KeyboardInterrupt:
+        print("\nbye", flush=True)
+    finally:
+        inp.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
 # run_terminal.py
 import time
+import constrained
+import early_stop
+from input_terminal import LineReader
+from llm_client import get_client
+from latency_trace import TRACER
 from state_machine import ToiletFeedbackEngine
 
 HELP = """\
@@ -23,26 +28,55 @@ def show(msg: str):
 def clamp01(v: float) -> float:
     return max(0.0, min(1.0, v))
 
-def apply_knobs(eng: ToiletFeedbackEngine, temp01: float, topk01: float, tag: str = ""):
+def apply_knobs(eng: ToiletFeedbackEngine, temp01: float, topk01: float, tag: str = "", stage: str = ""):
     # GPIO版と同じ：2つのノブをEngineへ反映
     # state_machine側が set_knobs を持っている前提（run_gpioと同じ）
+    if stage:
+        TRACER.mark("knob", stage)
     eng.set_knobs(temp01, topk01)
     print(
         f"[KNOBS]{' '+tag if tag else ''} temp01={temp01:.3f} topk01={topk01:.3f}",
         flush=True,
     )
 
-def read_choice_blocking(prompt="> ") -> str:
+def read_choice_blocking(reader: LineReader, prompt="> ") -> str:
     while True:
-        s = input(prompt).strip()
+        s = reader.readline(prompt).strip()
         if s in ("1", "2", "3"):
             return s
         if s in ("/1", "/2", "/3"):
             return s[1:]  # "1" "2" "3"
         print("input 1/2/3", flush=True)
 
+def generate(reader: LineReader, eng: ToiletFeedbackEngine, fn, *args):
+    """
+    GPIO版と同じ：生成の間だけ 1/2/3 の入力を先取りする。(表示する文面, 生成中に打たれた番号 or None)
+    """
+    ta = eng.type_ahead
+    if ta is None:
+        return fn(*args), None
+    ta.open()
+    reader.capture_presses(ta.press)
+    try:
+        text = fn(*args)
+    finally:
+        reader.capture_presses(None)
+        early = ta.close()
+    return text, early
+
+def read_answer(reader: LineReader, eng: ToiletFeedbackEngine, early, stage: str) -> str:
+    if early is None:
+        ans = read_choice_blocking(reader, "> ")
+        TRACER.mark("button", stage)
+        return ans
+    TRACER.mark("button", stage, eng.type_ahead.t_press)
+    return early
+
 def main():
     eng = ToiletFeedbackEngine()
+    eng.start_background()
+    # 標準入力は別スレッドで読む（生成中の 1/2/3 を先取りするため）
+    reader = LineReader()
 
     # terminal側のノブ状態（GPIOの可変抵抗2chの代替。本当は物理側に存在するが、ないので）
     temp01 = 0.5
@@ -59,7 +93,7 @@ def main():
             # PIR待ち相当（/start を待つ）
             print("[WAIT] /start を入力（人感センサ相当）...", flush=True)
             while True:
-                s = input("> ").strip()
+                s = reader.readline("> ").strip()
                 if not s:
                     continue
                 if s.startswith("/quit"):
@@ -98,47 +132,73 @@ def main():
                     print(f"[status] phase={sess.phase} temp01={sess.temp01:.2f} sat={sess.satisfaction} reason={sess.reason}", flush=True)
                     if getattr(sess, "last_question", None):
                         print(f"[last_question] {sess.last_question}", flush=True)
+                    if eng.speculator is not None:
+                        print(f"[speculation] {eng.speculator.snapshot()}", flush=True)
+                    if eng.bank is not None:
+                        print(f"[bank] {eng.bank.snapshot()}", flush=True)
+                    print(f"[conn] {get_client().snapshot()}", flush=True)
+                    print(f"[stream] {eng.stream_metrics.snapshot()} replayed={eng.stream_metrics.replayed}", flush=True)
+                    print(f"[early-stop] {early_stop.STATS.snapshot()}", flush=True)
+                    print(f"[format] {constrained.STATS.snapshot()}", flush=True)
+                    if eng.slo is not None:
+                        print(f"[slo] {eng.slo.snapshot()}", flush=True)
+                    if eng.cascade is not None:
+                        print(f"[cascade] {eng.cascade.snapshot()}", flush=True)
+                    if eng.type_ahead is not None:
+                        print(f"[type-ahead] {eng.type_ahead.snapshot()}", flush=True)
+                    if eng.presence is not None:
+                        print(f"[prefill] {eng.presence.snapshot()}", flush=True)
+                    if eng.thermal is not None:
+                        print(f"[thermal] {eng.thermal.snapshot()}", flush=True)
+                    if eng.store is not None:
+                        print(f"[store] {eng.store.snapshot()}", flush=True)
                     continue
                 if s.startswith("/reset"):
                     eng.reset()
                     print("[ok] reset (knobs kept)", flush=True)
                     continue
                 if s.startswith("/start"):
+                    TRACER.new_session()
+                    TRACER.mark("pir", "stage0")
+                    eng.on_presence()
                     break
 
                 print("unknown command. type /help", flush=True)
 
             # セッション開始直前のノブ値を読む（開始時点）
-            apply_knobs(eng, temp01, topk01, "start")
+            apply_knobs(eng, temp01, topk01, "start", "stage0")
 
             # Q1生成
             show("[Q1] 生成中（満足度質問）...")
-            q1 = eng.start()
+            q1, early = generate(reader, eng, eng.start)
             show(f"[Q1]\n{q1}\n\n入力: 1/2/3")
+            TRACER.mark("display", "stage0")
 
-            # 満足度入力（ブロック）
-            ans1 = read_choice_blocking("> ")
-            print(f"[IN] satisfaction={ans1}", flush=True)
+            # 満足度入力（生成中に打たれていればそれを使う。なければブロック）
+            ans1 = read_answer(reader, eng, early, "stage1")
+            print(f"[IN] satisfaction={ans1}{'（先取り）' if early else ''}", flush=True)
 
             # Q2生成直前：ノブ反映
-            apply_knobs(eng, temp01, topk01, "before Q2")
+            apply_knobs(eng, temp01, topk01, "before Q2", "stage1")
 
             # Q2生成
             show("[Q2] 生成中（深掘り質問）...")
-            q2 = eng.handle_choice(ans1)
+            q2, early = generate(reader, eng, eng.handle_choice, ans1)
             show(f"[Q2]\n{q2}\n\n入力: 1/2/3")
+            TRACER.mark("display", "stage1")
 
-            # 理由入力（ブロック）
-            ans2 = read_choice_blocking("> ")
-            print(f"[IN] reason={ans2}", flush=True)
+            # 理由入力（生成中に打たれていればそれを使う。なければブロック）
+            ans2 = read_answer(reader, eng, early, "stage2")
+            print(f"[IN] reason={ans2}{'（先取り）' if early else ''}", flush=True)
 
             # THANKS生成直前：ノブ反映
-            apply_knobs(eng, temp01, topk01, "before THANKS")
+            apply_knobs(eng, temp01, topk01, "before THANKS", "stage2")
 
             # THANKS生成
             show("[THANKS] 生成中（お礼）...")
             thanks = eng.handle_choice(ans2)
             show(f"[THANKS]\n{thanks}")
+            TRACER.mark("display", "stage2")
 
             print("---- セッション終了。次の人を待ちます ----\n", flush=True)
             time.sleep(0.2)
@@ -0,0 +1,431 @@
+# session_server.py
+import argparse
+import asyncio
+import json
+import math
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from aiohttp import web
+
+from config import (
+    SESSION_SERVER_HOST,
+    SESSION_SERVER_IDLE_TTL_S,
+    SESSION_SERVER_MAX_INFLIGHT,
+    SESSION_SERVER_MAX_SESSIONS,
+    SESSION_SERVER_PORT,
+)
+from state_machine import clamp
+from state_machine_async import AsyncToiletFeedbackEngine
+
+
+class _Stream:
+    """
+    生成中の1ステージ分の出力。/stream の購読者は何人でも後から追いつける。
+    セッションが生成中のときだけ存在する（待機中のセッションは持たない）。
+    """
+
+    __slots__ = ("chunks", "done", "text", "error", "_waiters")
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.text: Optional[str] = None
+        self.error: Optional[str] = None
+        self._waiters: List[asyncio.Future] = []
+
+    def push(self, delta: str) -> None:
+        self.chunks.append(delta)
+        self._wake()
+
+    def finish(self, text: Optional[str] = None, error: Optional[str] = None) -> None:
+        self.done = True
+        self.text = text
+        self.error = error
+        self._wake()
+
+    def _wake(self) -> None:
+        waiters, self._waiters = self._waiters, []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+    async def follow(self):
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            await fut
+
+
+class KioskSession:
+    """
+    1キオスク分の状態。Session と同じ属性名なので engine.start_session() にそのまま渡せる。
+    スレッドは持たず、生成中だけ task / stream を持つ。
+    """
+
+    __slots__ = (
+        "kiosk_id",
+        "temp01",
+        "topk01",
+        "focus",
+        "satisfaction",
+        "reason",
+        "last_question",
+        "phase",
+        "last_seen",
+        "task",
+        "stream",
+    )
+
+    def __init__(self, kiosk_id: str):
+        self.kiosk_id = kiosk_id
+        self.temp01 = 0.5
+        self.topk01 = 0.5
+        self.focus: Optional[str] = None
+        self.satisfaction: Optional[str] = None
+        self.reason: Optional[str] = None
+        self.last_question: Optional[str] = None
+        self.phase = "idle"
+        self.last_seen = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.stream: Optional[_Stream] = None
+
+    @property
+    def busy(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def to_json(self) -> dict:
+        return {
+            "kiosk_id": self.kiosk_id,
+            "phase": self.phase,
+            "focus": self.focus,
+            "satisfaction": self.satisfaction,
+            "reason": self.reason,
+            "last_question": self.last_question,
+            "temp01": self.temp01,
+            "topk01": self.topk01,
+            "generating": self.busy,
+        }
+
+
+class SessionHub:
+    """
+    kiosk_id -> KioskSession。engine（max_tokens 予測器込み）は全キオスクで1つを共有する。
+
+    - セッション数は max_sessions まで。超えたら最後の操作が古い待機中セッションから捨てる
+    - idle_ttl_s 操作がないセッションは掃除タスクが捨てる
+    - upstream への同時生成数は max_inflight で絞る（残りは順番待ち）
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = SESSION_SERVER_MAX_SESSIONS,
+        idle_ttl_s: float = SESSION_SERVER_IDLE_TTL_S,
+        max_inflight: int = SESSION_SERVER_MAX_INFLIGHT,
+    ):
+        self.engine = AsyncToiletFeedbackEngine()
+        self.max_sessions = max_sessions
+        self.idle_ttl_s = idle_ttl_s
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.sessions: "OrderedDict[str, KioskSession]" = OrderedDict()
+        self.stats = {"created": 0, "evicted": 0, "expired": 0, "generations": 0, "cancelled": 0, "errors": 0}
+
+    def find(self, kiosk_id: str) -> Optional[KioskSession]:
+        """
+        読むだけ（GET）の参照。作らない・操作順も last_seen も動かさない（覗いただけで他のセッションを追い出さない）
+        """
+        return self.sessions.get(kiosk_id)
+
+    def get(self, kiosk_id: str) -> KioskSession:
+        s = self.sessions.get(kiosk_id)
+        if s is None:
+            s = KioskSession(kiosk_id)
+            self.sessions[kiosk_id] = s
+            self.stats["created"] += 1
+            self._evict()
+        self.touch(s)
+        return s
+
+    def touch(self, s: KioskSession) -> None:
+        """
+        last_seen を更新して操作順の末尾へ（sweep_loop は操作順＝last_seen 順を前提に先頭から見る）
+        """
+        s.last_seen = time.monotonic()
+        if self.sessions.get(s.kiosk_id) is s:
+            self.sessions.move_to_end(s.kiosk_id)
+
+    def _evict(self) -> None:
+        if len(self.sessions) <= self.max_sessions:
+            return
+        for kid in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions:
+                return
+            if not self.sessions[kid].busy:
+                del self.sessions[kid]
+                self.stats["evicted"] += 1
+
+    async def sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(min(60.0, self.idle_ttl_s))
+            deadline = time.monotonic() - self.idle_ttl_s
+            # OrderedDict は最後の操作順なので、先頭から期限内のものに当たるまで見ればよい
+            for kid in list(self.sessions):
+                s = self.sessions[kid]
+                if s.last_seen > deadline:
+                    break
+                if not s.busy:
+                    del self.sessions[kid]
+                    self.stats["expired"] += 1
+
+    def cancel(self, s: KioskSession) -> None:
+        if s.busy:
+            s.task.cancel()
+            self.stats["cancelled"] += 1
+
+    def reset(self, s: KioskSession) -> None:
+        self.cancel(s)
+        s.focus = s.satisfaction = s.reason = s.last_question = None
+        s.phase = "idle"
+
+    def run(self, s: KioskSession, choice: Optional[str] = None) -> _Stream:
+        """
+        start（choice=None）または choice の生成をタスクとして起動し、その出力ストリームを返す。
+        """
+        stream = _Stream()
+        s.stream = stream
+
+        async def _job():
+            try:
+                async with self.inflight:
+                    self.stats["generations"] += 1
+                    if choice is None:
+                        text = await self.engine.start_session(s, on_delta=stream.push)
+                    else:
+                        text = await self.engine.choice_session(s, choice, on_delta=stream.push)
+                stream.finish(text=text)
+            except asyncio.CancelledError:
+                stream.finish(error="cancelled")
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                stream.finish(error=str(e))
+            finally:
+                if s.stream is stream:
+                    s.stream = None
+                self.touch(s)
+
+        s.task = asyncio.create_task(_job())
+        return stream
+
+    def snapshot(self) -> dict:
+        st = dict(self.stats)
+        st["sessions"] = len(self.sessions)
+        st["generating"] = sum(1 for s in self.sessions.values() if s.busy)
+        st["max_sessions"] = self.max_sessions
+        return st
+
+
+# -----------------------------
+# HTTP
+# -----------------------------
+def _json(obj, status: int = 200) -> web.Response:
+    return web.json_response(obj, status=status, dumps=lambda o: json.dumps(o, ensure_ascii=False))
+
+
+def _wants_stream(request: web.Request) -> bool:
+    return request.query.get("stream") == "1" or "text/event-stream" in request.headers.get("Accept", "")
+
+
+async def _json_body(request: web.Request) -> dict:
+    if not request.can_read_body:
+        return {}
+    try:
+        obj = await request.json()
+    except Exception:
+        raise web.HTTPBadRequest(text="invalid json")
+    return obj if isinstance(obj, dict) else {}
+
+
+def _parse_knobs(body: dict) -> dict:
+    """
+    body の temp01 / topk01 を 0..1 の float にする。数値でなければ 400（セッションに触る前に検査する）
+    """
+    out = {}
+    for k in ("temp01", "topk01"):
+        if k not in body:
+            continue
+        v = body[k]
+        try:
+            if isinstance(v, bool):
+                raise ValueError
+            x = float(v)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text=f"{k} must be a number")
+        if math.isnan(x):
+            raise web.HTTPBadRequest(text=f"{k} must be a number")
+        out[k] = clamp(x, 0.0, 1.0)
+    return out
+
+
+def _apply_knobs(s: KioskSession, knobs: dict) -> None:
+    for k, v in knobs.items():
+        setattr(s, k, v)
+
+
+def _find(request: web.Request) -> KioskSession:
+    s = request.app["hub"].find(request.match_info["kiosk_id"])
+    if s is None:
+        raise web.HTTPNotFound(text="unknown kiosk")
+    return s
+
+
+async def _sse(request: web.Request, s: KioskSession, stream: _Stream) -> web.StreamResponse:
+    resp = web.StreamResponse(
+        status=200,
+        headers={"Content-Type": "text/event-stream; charset=utf-8", "Cache-Control": "no-cache"},
+    )
+    await resp.prepare(request)
+
+    async def send(obj: dict):
+        await resp.write(b"data: " + json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+    try:
+        async for delta in stream.follow():
+            await send({"type": "delta", "text": delta})
+        if stream.error:
+            await send({"type": "error", "message": stream.error, "phase": s.phase})
+        else:
+            await send({"type": "done", "text": stream.text, "phase": s.phase})
+        await resp.write_eof()
+    except ConnectionResetError:
+        # 表示端末が切れても生成は続ける（結果はセッションに残り、再接続した端末が GET で取れる）
+        pass
+    return resp
+
+
+async def _respond(request: web.Request, s: KioskSession, stream: _Stream) -> web.StreamResponse:
+    if _wants_stream(request):
+        return await _sse(request, s, stream)
+    try:
+        await asyncio.shield(s.task)
+    except asyncio.CancelledError:
+        if not stream.done:
+            raise
+    if stream.error:
+        return _json({"error": stream.error, **s.to_json()}, status=409 if stream.error == "cancelled" else 502)
+    return _json({"text": stream.text, **s.to_json()})
+
+
+async def handle_start(request: web.Request) -> web.StreamResponse:
+    hub: SessionHub = request.app["hub"]
+    knobs = _parse_knobs(await _json_body(request))
+    s = hub.get(request.match_info["kiosk_id"])
+    _apply_knobs(s, knobs)
+    # 前の人の生成が残っていたら打ち切って新しいセッションにする
+    hub.cancel(s)
+    return await _respond(request, s, hub.run(s))
+
+
+async def handle_choice(request: web.Request) -> web.StreamResponse:
+    hub: SessionHub = request.app["hub"]
+    body = await _json_body(request)
+    knobs = _parse_knobs(body)
+    choice = str(body.get("choice", ""))
+    if choice not in ("1", "2", "3"):
+        raise web.HTTPBadRequest(text="choice must be 1/2/3")
+    s = hub.get(request.match_info["kiosk_id"])
+    # 断るリクエストでノブを変えない（検査を通ってから反映する）
+    if s.busy:
+        raise web.HTTPConflict(text="generation in progress")
+    if s.phase not in ("await_sat", "await_reason"):
+        raise web.HTTPConflict(text=f"phase={s.phase}")
+    _apply_knobs(s, knobs)
+    return await _respond(request, s, hub.run(s, choice))
+
+
+async def handle_knobs(request: web.Request) -> web.Response:
+    hub: SessionHub = request.app["hub"]
+    knobs = _parse_knobs(await _json_body(request))
+    s = hub.get(request.match_info["kiosk_id"])
+    _apply_knobs(s, knobs)
+    return _json(s.to_json())
+
+
+async def handle_reset(request: web.Request) -> web.Response:
+    hub: SessionHub = request.app["hub"]
+    s = hub.get(request.match_info["kiosk_id"])
+    hub.reset(s)
+    return _json(s.to_json())
+
+
+async def handle_state(request: web.Request) -> web.Response:
+    return _json(_find(request).to_json())
+
+
+async def handle_stream(request: web.Request) -> web.StreamResponse:
+    """
+    表示専用の端末向け: いま生成中のステージを途中から購読する（生成中でなければ即 done）。
+    """
+    s = _find(request)
+    stream = s.stream
+    if stream is None:
+        stream = _Stream()
+        stream.finish(text=s.last_question)
+    return await _sse(request, s, stream)
+
+
+async def handle_stats(request: web.Request) -> web.Response:
+    return _json(request.app["hub"].snapshot())
+
+
+def build_app(hub: Optional[SessionHub] = None) -> web.Application:
+    app = web.Application()
+
+    async def _on_startup(app: web.Application):
+        app["hub"] = hub or SessionHub()
+        app["sweeper"] = asyncio.create_task(app["hub"].sweep_loop())
+
+    async def _on_cleanup(app: web.Application):
+        app["sweeper"].cancel()
+        for s in list(app["hub"].sessions.values()):
+            app["hub"].cancel(s)
+
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+
+    app.router.add_post("/kiosks/{kiosk_id}/start", handle_start)
+    app.router.add_post("/kiosks/{kiosk_id}/choice", handle_choice)
+    app.router.add_post("/kiosks/{kiosk_id}/knobs", handle_knobs)
+    app.router.add_post("/kiosks/{kiosk_id}/reset", handle_reset)
+    app.router.add_get("/kiosks/{kiosk_id}", handle_state)
+    app.router.add_get("/kiosks/{kiosk_id}/stream", handle_stream)
+    app.router.add_get("/stats", handle_stats)
+    return app
+
+
+def main():
+    p = argparse.ArgumentParser(description="multi-kiosk session server")
+    p.add_argument("--host", default=SESSION_SERVER_HOST)
+    p.add_argument("--port", type=int, default=SESSION_SERVER_PORT)
+    p.add_argument("--max-sessions", type=int, default=SESSION_SERVER_MAX_SESSIONS)
+    p.add_argument("--idle-ttl", type=float, default=SESSION_SERVER_IDLE_TTL_S)
+    p.add_argument("--max-inflight", type=int, default=SESSION_SERVER_MAX_INFLIGHT)
+    args = p.parse_args()
+
+    print(f"[session-server] http://{args.host}:{args.port}  max_sessions={args.max_sessions}", flush=True)
+
+    async def _make():
+        return build_app(SessionHub(args.max_sessions, args.idle_ttl, args.max_inflight))
+
+    web.run_app(_make(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
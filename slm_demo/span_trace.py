@@ -0,0 +1,143 @@
+# span_trace.py
+import json
+import os
+import secrets
+import threading
+import time
+from typing import List, Optional
+
+from config import SPAN_TRACE, SPAN_TRACE_MAX_BYTES, SPAN_TRACE_PATH
+from llm_stream import Finish, FirstToken, StreamSink, StreamStart
+
+
+def trace_of(request_id: str) -> str:
+    # request id は "<trace>.<stage>.<連番>"。trace はセッションごと
+    return request_id.split(".", 1)[0]
+
+
+class SpanFileExporter:
+    """
+    span を JSON Lines で追記する（proxy/request_trace.py と同じ形式。waterfall は trace_waterfall.py）。
+    1行 = {"trace", "req", "stage", "proc", "name", "start"(UNIX 秒), "ms", "attrs"}
+    max_bytes を超えたら <path>.1 に回す（古い .1 は消える）
+    """
+
+    def __init__(self, path: str, max_bytes: int = SPAN_TRACE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.exported = 0
+
+    def export(self, spans: List[dict]) -> None:
+        if not spans:
+            return
+        lines = "".join(json.dumps(s, ensure_ascii=False) + "\n" for s in spans)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            try:
+                if os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+            except FileNotFoundError:
+                pass
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            self.exported += len(spans)
+
+
+class SpanTracer:
+    """
+    セッションごとの trace id と、LLM 呼び出しごとの request id を発行し、クライアント側の span を書き出す。
+
+    - request id は X-SLM-Trace ヘッダで proxy へ送られ、proxy は同じ id で自分の span（queue / connect / TTFT / relay）を書く
+    - 時刻は壁時計（time.time()）。proxy とは同じ機械の時計なのでそのまま並べられる
+    - 先行生成・作り置きの呼び出しも、呼んだときのセッションの trace に入る
+    """
+
+    def __init__(self, path: str = SPAN_TRACE_PATH, enabled: bool = SPAN_TRACE):
+        self.enabled = enabled
+        self.exporter = SpanFileExporter(path)
+        self._lock = threading.Lock()
+        self.trace_id: Optional[str] = None
+        self._seq = 0
+
+    def new_trace(self) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.trace_id = secrets.token_hex(8)
+            self._seq = 0
+            return self.trace_id
+
+    def request_id(self, stage: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            if self.trace_id is None:
+                self.trace_id = secrets.token_hex(8)
+            self._seq += 1
+            return f"{self.trace_id}.{stage}.{self._seq}"
+
+    def span(self, request_id: Optional[str], stage: Optional[str], name: str, start: float, ms: float, **attrs) -> dict:
+        return {
+            "trace": trace_of(request_id) if request_id else self.trace_id,
+            "req": request_id,
+            "stage": stage,
+            "proc": "client",
+            "name": name,
+            "start": round(start, 6),
+            "ms": round(ms, 3),
+            "attrs": attrs,
+        }
+
+    def record(self, request_id: Optional[str], stage: Optional[str], name: str, start: float, ms: float, **attrs) -> None:
+        if self.enabled:
+            self.exporter.export([self.span(request_id, stage, name, start, ms, **attrs)])
+
+
+class SpanSink(StreamSink):
+    """
+    1回の LLM 呼び出しを client.connect（送信 → 応答ヘッダ）/ client.ttft（→ 最初のトークン）/
+    client.stream（→ 最後のトークン）に分けて、終わったときにまとめて書く
+    """
+
+    def __init__(self, tracer: SpanTracer, request_id: str, stage: str):
+        self.tracer = tracer
+        self.request_id = request_id
+        self.stage = stage
+        # perf_counter → 壁時計の換算
+        self._offset = time.time() - time.perf_counter()
+        self._sent: Optional[float] = None
+        self._start: Optional[float] = None
+        self._first: Optional[float] = None
+        self._attrs: dict = {}
+
+    def on_start(self, ev: StreamStart) -> None:
+        self._sent = ev.t_sent if ev.t_sent is not None else ev.t
+        self._start = ev.t
+        self._attrs = {"backend": ev.backend, "connect_ms": ev.connect_ms}
+
+    def on_first_token(self, ev: FirstToken) -> None:
+        self._first = ev.t
+
+    def on_finish(self, ev: Finish) -> None:
+        if self._start is None:
+            return
+        res = ev.result
+        attrs = dict(
+            self._attrs,
+            finish_reason=getattr(res, "finish_reason", None),
+            completion_tokens=getattr(res, "completion_tokens", None),
+        )
+
+        def span(name: str, a: float, b: float) -> dict:
+            return self.tracer.span(self.request_id, self.stage, name, a + self._offset, (b - a) * 1000.0, **attrs)
+
+        first = self._first if self._first is not None else ev.t
+        self.tracer.exporter.export([
+            span("client.connect", self._sent, self._start),
+            span("client.ttft", self._start, first),
+            span("client.stream", first, ev.t),
+        ])
+
+
+SPANS = SpanTracer()
@@ -0,0 +1,124 @@
+# speculation.py
+import threading
+from typing import Callable, Dict, Optional
+
+from config import SPECULATION_KNOB_TOLERANCE
+
+
+class _Branch:
+    def __init__(self, key: str):
+        self.key = key
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+        self.result = None          # CompletionResult
+        self.error: Optional[Exception] = None
+        self.thread: Optional[threading.Thread] = None
+
+
+class Speculator:
+    """
+    ユーザーがボタンを選んでいる間に、次ステージを回答 1/2/3 の全パターンで先行生成しておく。
+
+    - launch(): 分岐ごとにスレッドを立てて生成開始（表示はしない）
+    - take(): 選ばれた分岐を返す。ノブが launch 時から動いていたら使わない（= miss）
+    - 使わなかった分岐は cancel（接続を切って upstream の生成も止める）
+    - hit 率と、捨てた分岐が消費したトークン数を記録する
+    """
+
+    def __init__(self, tolerance: float = SPECULATION_KNOB_TOLERANCE):
+        self.tolerance = tolerance
+        self.stage: Optional[str] = None
+        self.knobs: Optional[tuple] = None
+        self.branches: Dict[str, _Branch] = {}
+        self.stats = {
+            "launched": 0,
+            "hits": 0,
+            "miss_knobs": 0,
+            "miss_failed": 0,
+            "miss_slow": 0,
+            "wasted_tokens": 0,
+        }
+
+    def launch(self, stage: str, knobs: tuple, branch_fns: Dict[str, Callable]) -> None:
+        """
+        branch_fns: 分岐キー("1"/"2"/"3") -> fn(cancel_event) -> CompletionResult
+        """
+        self.cancel_all()
+        self.stage = stage
+        self.knobs = knobs
+        self.branches = {}
+        for key, fn in branch_fns.items():
+            br = _Branch(key)
+            br.thread = threading.Thread(target=self._run, args=(br, fn), daemon=True)
+            self.branches[key] = br
+            self.stats["launched"] += 1
+        for br in self.branches.values():
+            br.thread.start()
+
+    def _run(self, br: _Branch, fn: Callable) -> None:
+        try:
+            br.result = fn(br.cancel)
+        except Exception as e:
+            br.error = e
+        finally:
+            br.done.set()
+
+    def _knobs_match(self, knobs: tuple) -> bool:
+        if self.knobs is None:
+            return False
+        return all(abs(a - b) <= self.tolerance for a, b in zip(self.knobs, knobs))
+
+    def take(self, stage: str, key: str, knobs: tuple, timeout: Optional[float] = None):
+        """
+        使える先行生成結果(CompletionResult)があれば返す。無ければ None（呼び出し側がその場で生成）。
+        生成途中の分岐は完了まで待つ（最初から作り直すより早い）。timeout を過ぎたら諦めて cancel する。
+        """
+        if self.stage != stage or key not in self.branches:
+            return None
+
+        if not self._knobs_match(knobs):
+            # set_knobs で値が変わっていたら、古いサンプリング設定の結果は使わない
+            self.stats["miss_knobs"] += 1
+            self.cancel_all()
+            return None
+
+        chosen = self.branches.pop(key)
+        self.cancel_all()
+
+        if not chosen.done.wait(timeout):
+            chosen.cancel.set()
+            self.stats["miss_slow"] += 1
+            return None
+        res = chosen.result
+        if chosen.error is not None or res is None or res.cancelled or res.truncated or not res.text:
+            self.stats["miss_failed"] += 1
+            return None
+
+        self.stats["hits"] += 1
+        return res
+
+    def cancel_all(self) -> None:
+        """
+        残っている分岐を全部止め、消費済みトークンを wasted として数える（完了待ちはしない）。
+        """
+        branches = list(self.branches.values())
+        self.branches = {}
+        self.stage = None
+        for br in branches:
+            br.cancel.set()
+        if branches:
+            threading.Thread(target=self._account_wasted, args=(branches,), daemon=True).start()
+
+    def _account_wasted(self, branches) -> None:
+        for br in branches:
+            br.done.wait()
+            res = br.result
+            if res is not None:
+                n = res.completion_tokens if res.completion_tokens is not None else len(res.text)
+                self.stats["wasted_tokens"] += int(n or 0)
+
+    def snapshot(self) -> dict:
+        st = dict(self.stats)
+        taken = st["hits"] + st["miss_knobs"] + st["miss_failed"] + st["miss_slow"]
+        st["hit_rate"] = (st["hits"] / taken) if taken else None
+        return st
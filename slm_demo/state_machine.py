@@ -1,16 +1,47 @@
 # state_machine.py
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from typing import Optional
 import random
-
-from config import MAX_TOKENS_STAGE1, MAX_TOKENS_STAGE2
-from prompts import (
-    SYSTEM_PROMPT,
-    build_stage0_user_prompt,
-    build_stage1_user_prompt,
-    build_stage2_user_prompt,
+import threading
+import time
+
+from config import (
+    ADAPTIVE_MAX_TOKENS,
+    CASCADE_TIERS,
+    CONSTRAINED_DECODING,
+    FEEDBACK_STORE,
+    GENERATION_MODE,
+    GENERATION_STEM_MAX_TOKENS,
+    LLM_BACKEND,
+    MAX_TOKENS_STAGE1,
+    MAX_TOKENS_STAGE2,
+    PRESENCE_PREFILL,
+    PRETOKENIZED_PROMPTS,
+    QUESTION_BANK,
+    SLO_FALLBACK,
+    SPECULATIVE_PREGEN,
+    THERMAL_CONTROL,
+    THERMAL_PROFILES,
+    THERMAL_SMALL_MODEL_URL,
+    TYPE_AHEAD,
 )
-from llm_client import chat_completion
+from prompts import assemble_stage_text, build_stage_messages, build_stem_messages, template_stage_text
+import constrained
+from llm_client import CompletionResult, LLMClient, chat_completion_ex
+from llm_stream import collect_stream, events_from_result
+from stream_sinks import ConsoleSink, MetricsSink
+from latency_trace import TRACER, TraceSink
+from span_trace import SPANS, SpanSink
+from feedback_store import FeedbackRecord, FeedbackStore
+from fallback import LatencyGuard
+from cascade import ModelCascade
+from type_ahead import TypeAhead
+from thermal import ThermalController
+from pretokenized import PretokenizedPrompter
+from presence_prefill import PresencePrefill
+from question_bank import QuestionBank
+from speculation import Speculator
+from max_tokens_predictor import MaxTokensPredictor
 
 
 FOCUS_LIST = [
@@ -70,11 +101,106 @@ class Session:
     reason: Optional[str] = None        # "1"|"2"|"3"
     last_question: Optional[str] = None
     phase: str = "idle"                 # idle|await_sat|await_reason|done
+    # ステージごとの出力をパースしたもの（constrained.Question / Thanks、書式が崩れていたら None）
+    outputs: dict = field(default_factory=dict)
+    # 保存用: 開始時刻（UNIX 秒）・ステージごとの表示文面と生成時間(ms)
+    started_at: Optional[float] = None
+    texts: dict = field(default_factory=dict)
+    timings_ms: dict = field(default_factory=dict)
+    # 待ち時間の予算を外して定型文を出したステージ → 理由（"ttft" / "total" / "error" / "degraded"）
+    fallbacks: dict = field(default_factory=dict)
+    # 生成中のボタンで打ち切ったステージ → 押されたときの出力トークン数
+    preempted: dict = field(default_factory=dict)
 
 
 class ToiletFeedbackEngine:
     def __init__(self):
         self.session = Session()
+        self.max_tokens = MaxTokensPredictor() if ADAPTIVE_MAX_TOKENS else None
+        # 直近の応答で proxy が返した backend（max_tokens の学習キーに使う）
+        self.backend: Optional[str] = None
+        # 定型部分を事前トークナイズして /completion に投げる経路（local backend のみ）
+        inproc = LLM_BACKEND == "inproc"
+        self.pretokenized = PretokenizedPrompter() if PRETOKENIZED_PROMPTS and not inproc else None
+        # 人感センサの反応で Q1 のプロンプトを prefill しておき、本番の Q1 を同じ slot に固定する
+        self.presence = PresencePrefill(self.pretokenized) if PRESENCE_PREFILL else None
+        # on_presence() で先に決めた今回の観点（start() が使う）
+        self._pending_focus: Optional[str] = None
+        # ボタン待ちの間に次ステージを 1/2/3 全パターンで先行生成する
+        # inproc はモデル1つを直列に使うので、先行生成が本番の生成を待たせないよう止める
+        self.speculator = Speculator() if SPECULATIVE_PREGEN and not inproc else None
+        # ステージごとの待ち時間の予算。外したら定型文を出す
+        self.slo = LatencyGuard() if SLO_FALLBACK else None
+        # Q1/Q2 の生成中に押されたボタンを先取りして、残りの生成を打ち切る（開閉は入力側が行う）
+        self.type_ahead = TypeAhead() if TYPE_AHEAD else None
+        # 出力書式の制約（None / "gbnf" / "json"）
+        self.constrained = CONSTRAINED_DECODING
+        # "full" | "stem"（LLM は1文だけ書き、選択肢は定型から組み立てる）
+        self.generation_mode = GENERATION_MODE
+        # 出力が検査を通らなければ大きいモデルへ上げる（stem は組み立て済みで常に形が整うので使わない）
+        self.cascade = ModelCascade() if CASCADE_TIERS and self.generation_mode != "stem" else None
+        # 表示中の生成のイベント購読者（LCD・記録など）。MetricsSink はステージ別 TTFT 集計用
+        self.stream_metrics = MetricsSink()
+        self.sinks = [self.stream_metrics]
+        if TRACER.enabled:
+            self.sinks.append(TraceSink(TRACER))
+        # 終わったセッションを SQLite に保存する（書き込みは別スレッドでまとめて）
+        self.store = FeedbackStore() if FEEDBACK_STORE else None
+        # 待機中に Q1 を作り置きする
+        self.bank = None
+        if QUESTION_BANK:
+            self.bank = QuestionBank(FOCUS_LIST, self._bank_generate)
+            self.bank.set_knobs(self.session.temp01, self.session.topk01)
+            self.bank.set_idle(True)
+        # 熱・負荷に応じた動作プロファイル（thermal.py が apply_profile で切り替える）
+        self.profile = THERMAL_PROFILES[0]
+        self.profile_client: Optional[LLMClient] = None
+        self.thermal = None
+        if THERMAL_CONTROL:
+            self.thermal = ThermalController(self.stream_metrics, self.apply_profile)
+        self._background_started = False
+
+    def start_background(self) -> None:
+        """
+        作り置きの補充などのバックグラウンドスレッドを起動する（何度呼んでもよい）。
+        エンジンを作っただけではスレッドは動かない。run_* は作った直後に呼び、start() も念のため呼ぶ
+        """
+        if self._background_started:
+            return
+        self._background_started = True
+        if self.bank is not None:
+            self.bank.start()
+        if self.store is not None:
+            self.store.start()
+        if self.thermal is not None:
+            self.thermal.start()
+        if LLM_BACKEND == "inproc":
+            # モデルのロードと共通 prefix の評価を起動時に済ませておく（最初の来訪者を待たせない）
+            threading.Thread(target=self._warmup_inproc, daemon=True).start()
+
+    def apply_profile(self, profile: dict) -> None:
+        """
+        先行生成・作り置きの停止 / max_tokens の上限 / 生成スレッド数（inproc）/ 小さいモデルへの切り替え
+        """
+        self.profile = profile
+        if self.bank is not None:
+            self.bank.set_paused(not profile["pregen"])
+        if not profile["pregen"] and self.speculator is not None:
+            self.speculator.cancel_all()
+        small = profile["small_model"] and THERMAL_SMALL_MODEL_URL
+        self.profile_client = LLMClient(THERMAL_SMALL_MODEL_URL, uds_path=None) if small else None
+        if LLM_BACKEND == "inproc":
+            from llm_inproc import get_inproc
+
+            get_inproc().set_threads(profile["threads"])
+
+    def _warmup_inproc(self) -> None:
+        from llm_inproc import get_inproc
+
+        try:
+            get_inproc().warmup(build_stage_messages("stage0", {"focus": FOCUS_LIST[0], "temp01": self.session.temp01}))
+        except Exception as e:
+            print(f"[inproc] warmup failed: {e}", flush=True)
 
     # 互換のため残す（CH0だけ更新したい場合）
     def set_temp01(self, temp01: float):
@@ -88,8 +214,14 @@ class ToiletFeedbackEngine:
     def set_knobs(self, temp01: float, topk01: float):
         self.session.temp01 = clamp(temp01, 0.0, 1.0)
         self.session.topk01 = clamp(topk01, 0.0, 1.0)
+        if self.bank is not None:
+            self.bank.set_knobs(self.session.temp01, self.session.topk01)
 
     def reset(self):
+        if self.speculator is not None:
+            self.speculator.cancel_all()
+        if self.bank is not None:
+            self.bank.set_idle(True)
         # ノブ値は引き継ぐ（これが便利）
         self.session = Session(
             temp01=self.session.temp01,
@@ -99,39 +231,402 @@ class ToiletFeedbackEngine:
     def _params(self) -> dict:
         return sampling_from_knobs(self.session.temp01, self.session.topk01)
 
-    def start(self) -> str:
+    def _knobs(self) -> tuple:
+        return (self.session.temp01, self.session.topk01)
+
+    def _tpl(self, stage: str) -> str:
+        # 出力長の学習キー。stem モードは1文だけなので別に数える
+        return f"{stage}_stem" if self.generation_mode == "stem" else stage
+
+    def _cap(self, stage: str, ceiling: int) -> int:
+        if self.max_tokens is not None:
+            return self.max_tokens.predict(self._tpl(stage), self.backend, ceiling)
+        return ceiling
+
+    def _generate(self, stage: str, values: dict, params: dict, ceiling: int, spec_key: Optional[str] = None) -> str:
         """
-        セッション開始：最初の満足度質問をLLMに生成させる
+        1ステージ分の生成。max_tokens は予測値で絞り、打ち切られたら上限(ceiling)で1回だけ再試行する。
+        spec_key があれば、先行生成済みの分岐を（ノブが動いていなければ）そのまま使う。
+        待ち時間の予算（self.slo）を外したら定型文を返す。
         """
-        self.session.satisfaction = None
-        self.session.reason = None
-        self.session.phase = "await_sat"
+        started = time.monotonic()
+        # 熱・負荷で絞っている間は上限ごと下げる（打ち切り時の再生成もこの上限まで）
+        ceiling = max(16, int(ceiling * self.profile["max_tokens_scale"]))
+        if spec_key is not None and self.speculator is not None:
+            wait = self.slo.ttft_s.get(stage) if self.slo is not None else None
+            res = self.speculator.take(stage, spec_key, self._knobs(), timeout=wait)
+            if res is not None:
+                self._replay(stage, res)
+                self.backend = res.backend or self.backend
+                if self.max_tokens is not None and res.completion_tokens is not None:
+                    cap = self._cap(stage, ceiling)
+                    self.max_tokens.observe(self._tpl(stage), self.backend, res.completion_tokens, cap, ceiling)
+                return self._parse(stage, res)
+
+        cap = self._cap(stage, ceiling)
 
-        #今回のセッションの論点を固定
-        focus = random.choice(FOCUS_LIST)
-        self.session.focus = focus
+        print("LLM: ", end="", flush=True)
+        res, reason = self._visible_call(stage, values, params, cap, started)
+        if reason == "preempted" or (res is not None and res.cancelled and self._pressed()):
+            return self._preempted(stage, values, res, started)
+        if res is None:
+            return self._fallback(stage, values, reason)
+
+        if res.truncated and cap < ceiling:
+            wasted = res.completion_tokens or cap
+            if self.max_tokens is not None:
+                self.max_tokens.observe_truncated(self._tpl(stage), self.backend, wasted)
+            print(f"\n[max_tokens] {stage}: cap={cap} で打ち切り → {ceiling} で再生成", flush=True)
+            print("LLM: ", end="", flush=True)
+            cap = ceiling
+            res, reason = self._visible_call(stage, values, params, cap)
+            if reason == "preempted" or (res is not None and res.cancelled and self._pressed()):
+                return self._preempted(stage, values, res, started)
+            if res is None:
+                return self._fallback(stage, values, reason)
+        if self._buffered():
+            # 生成中に流さなかった文面をここで表示する
+            collect_stream(events_from_result(res, stage), [ConsoleSink()] + self.sinks)
+        print("")
+        if res.connect_ms is not None:
+            how = f"new connection {res.connect_ms:.1f}ms" if res.connect_ms > 0 else "keep-alive"
+            ttft = f" ttft={res.ttft_ms:.0f}ms" if res.ttft_ms is not None else ""
+            print(f"[conn] {stage}: {how}{ttft}", flush=True)
+
+        self.backend = res.backend or self.backend
+        if self.max_tokens is not None and not res.truncated:
+            # usage が取れない upstream では文字数で近似する（日本語は概ね 1文字≒1トークン以上）
+            n = res.completion_tokens if res.completion_tokens is not None else len(res.text)
+            self.max_tokens.observe(self._tpl(stage), self.backend, n, cap, ceiling)
+        return self._parse(stage, res)
+
+    def _buffered(self) -> bool:
+        # JSON / stem / カスケードは生成中に流さず、整形・組み立て・検査を済ませた文面をあとで表示する
+        return self.constrained == "json" or self.generation_mode == "stem" or self.cascade is not None
+
+    def _pressed(self) -> bool:
+        # 先取りを受け付けている生成（Q1/Q2）の間だけ。THANKS は前の回答で打ち切らない
+        return self.type_ahead is not None and self.type_ahead.is_open and self.type_ahead.pressed is not None
+
+    def _slot(self, stage: str) -> Optional[int]:
+        # prefill した slot に乗せるのは表示する Q1 だけ（先行生成・作り置きは llama.cpp に任せる）
+        return self.presence.slot if self.presence is not None and stage == "stage0" else None
+
+    def _visible_call(self, stage: str, values: dict, params: dict, cap: int, started: Optional[float] = None):
+        """
+        表示する生成。(CompletionResult, None) か、予算を外したら (None, 理由)。
+        生成中にボタンが押されたら打ち切って (途中までの結果 or None, "preempted")
+        """
+        id_slot = self._slot(stage)
+        if self.slo is None:
+            cancel = threading.Event()
+            if self.type_ahead is not None:
+                self.type_ahead.arm(cancel)
+            res = self._call_llm(stage, values, params, cap, cancel=cancel, id_slot=id_slot)
+            return res, "preempted" if self._pressed() else None
+        return self.slo.run(
+            stage,
+            lambda cancel, sinks: self._call_llm(stage, values, params, cap, cancel=cancel, extra_sinks=sinks, id_slot=id_slot),
+            started,
+            preempt=self.type_ahead,
+        )
 
-        params = self._params()
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            # ※ prompts.py を直すまでは temp01 を渡してOK
-            {"role": "user", "content": build_stage0_user_prompt(self.session.focus, self.session.temp01)},
-            # {"role": "user", "content": build_stage0_user_prompt(self.session.temp01)},
-        ]
+    def _preempted(self, stage: str, values: dict, res, started: float) -> str:
+        """
+        来訪者が生成より先に答えた。残りは生成せず、記録用の文面だけ決めて返す（表示し直さない）。
+        流していれば見えていた途中までの文面、流していない（見えていない）なら定型文を記録する
+        """
+        shown = res.text if res is not None and not self._buffered() else ""
+        text = shown or template_stage_text(stage, values, self.session.focus)
+        tokens = res.completion_tokens if res is not None else 0
+        self.session.preempted[stage] = tokens
+        elapsed = (time.monotonic() - started) * 1000.0
+        typical = self.stream_metrics.snapshot().get(stage, {}).get("total_ms_p50")
+        self.type_ahead.record(stage, tokens, typical - elapsed if typical is not None else None)
+        print(f"\n[type-ahead] {stage}: ボタン {self.type_ahead.pressed} で打ち切り（{tokens or 0} tokens）", flush=True)
+        self.session.outputs[stage] = constrained.parse_output(stage, text)
+        return text
 
+    def _fallback(self, stage: str, values: dict, reason: Optional[str]) -> str:
+        """
+        定型文をその場で出す。選択肢の意味はプロンプトで固定したものと同じなので、次のステージはそのまま続けられる
+        """
+        print(f"\n[slo] {stage}: {reason} → 定型文", flush=True)
+        self.session.fallbacks[stage] = reason
+        res = CompletionResult(text=template_stage_text(stage, values, self.session.focus), finish_reason="stop", backend="template")
+        self._replay(stage, res)
+        return self._parse(stage, res)
+
+    def _parse(self, stage: str, res) -> str:
+        """
+        表示用の文面を Question / Thanks にパースして session.outputs に残す（書式の妥当率も記録）
+        """
+        parsed = constrained.parse_output(stage, res.text)
+        constrained.STATS.record(stage, self.constrained, parsed is not None, res.completion_tokens)
+        self.session.outputs[stage] = parsed
+        return parsed.render() if parsed is not None else res.text
+
+    def _replay(self, stage: str, res) -> None:
+        """
+        先行生成・作り置きの結果を、生成したときと同じイベントで表示側へ流す（TTFT=0）
+        """
         print("LLM: ", end="", flush=True)
-        text = chat_completion(
-            messages,
+        collect_stream(events_from_result(res, stage), [ConsoleSink()] + self.sinks)
+        print("", flush=True)
+
+    def _record(self, stage: str, text: str, t0: float) -> None:
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.session.texts[stage] = text
+        self.session.timings_ms[stage] = round(ms, 1)
+        # ステージ全体（先行生成の待ち・再生成・定型文を含む）を engine の span として残す
+        SPANS.record(
+            None, stage, "engine.stage", time.time() - ms / 1000.0, ms,
+            fallback=self.session.fallbacks.get(stage),
+            preempted=stage in self.session.preempted,
+        )
+
+    def _persist(self) -> None:
+        """
+        終わったセッションを保存キューに積む（ここでは書かない）
+        """
+        if self.store is None:
+            return
+        s = self.session
+        self.store.submit(FeedbackRecord(
+            ts=s.started_at or time.time(),
+            focus=s.focus,
+            satisfaction=s.satisfaction,
+            reason=s.reason,
+            temp01=s.temp01,
+            topk01=s.topk01,
+            q1=s.texts.get("stage0"),
+            q2=s.texts.get("stage1"),
+            thanks=s.texts.get("stage2"),
+            backend=self.backend,
+            timings=self._timings(),
+        ))
+
+    def _timings(self) -> dict:
+        s = self.session
+        out = dict(s.timings_ms)
+        if s.fallbacks:
+            out["fallback"] = dict(s.fallbacks)
+        if s.preempted:
+            out["preempted"] = dict(s.preempted)
+        return out
+
+    def _bank_generate(self, focus: str, temp01: float, topk01: float, cancel):
+        """
+        QuestionBank の補充用。バケット中心のノブ値で Q1 を生成する（表示なし）。
+        """
+        params = sampling_from_knobs(temp01, topk01)
+        values = {"focus": focus, "temp01": temp01}
+        return self._call_llm("stage0", values, params, self._cap("stage0", MAX_TOKENS_STAGE1), print_stream=False, cancel=cancel)
+
+    def _speculate(self, stage: str, values_by_key: dict, ceiling: int) -> None:
+        """
+        次ステージの各分岐をバックグラウンドで生成開始する（表示なし）。
+        """
+        if self.speculator is None or not self.profile["pregen"]:
+            return
+        params = self._params()
+        cap = self._cap(stage, ceiling)
+
+        def _branch(values):
+            return lambda cancel: self._call_llm(stage, values, params, cap, print_stream=False, cancel=cancel)
+
+        self.speculator.launch(
+            stage,
+            self._knobs(),
+            {key: _branch(values) for key, values in values_by_key.items()},
+        )
+
+    def _call_llm(
+        self,
+        stage: str,
+        values: dict,
+        params: dict,
+        max_tokens: int,
+        print_stream: bool = True,
+        cancel=None,
+        extra_sinks=(),
+        id_slot: Optional[int] = None,
+    ):
+        """
+        json 制約のときは結果の text を「質問\n1:… 2:… 3:…」の表示形式に直して返す
+        （先行生成・作り置きも同じ形で持つ）。stem モードも同じく組み立て済みの文面を返す。
+        カスケードが有効なら、検査を通るまで大きい tier へ上げた結果を返す。
+        id_slot は既定の経路（と熱プロファイルの小さいモデル）だけに付ける（カスケードの上位 tier は別のサーバ）。
+        """
+        if self.generation_mode == "stem":
+            return self._call_llm_stem(stage, values, params, max_tokens, cancel, extra_sinks, id_slot)
+        constraint = constrained.constraint_for(stage, self.constrained)
+        if self._buffered():
+            print_stream = False
+        sinks = (list(self.sinks) if print_stream else []) + list(extra_sinks)
+
+        def _once(client=None):
+            slot = id_slot if client is None else None
+            client = client or self.profile_client
+            trace = SPANS.request_id(stage)
+            traced = sinks + [SpanSink(SPANS, trace, stage)] if trace else sinks
+            res = self._call_llm_raw(stage, values, params, max_tokens, print_stream, cancel, constraint, traced, client, trace, slot)
+            if self.constrained == "json" and res is not None:
+                parsed = constrained.parse_json(stage, res.text)
+                if parsed is not None:
+                    res = replace(res, text=parsed.render())
+            return res
+
+        if self.cascade is None:
+            return _once()
+        return self.cascade.run(stage, _once, values.get("focus") or self.session.focus, values.get("prev_question"))
+
+    def _call_llm_stem(self, stage, values, params, max_tokens, cancel, extra_sinks, id_slot=None):
+        """
+        1文だけを書かせて（stage 名は "<stage>_stem" で proxy・統計を分ける）、選択肢を定型から付ける
+        """
+        trace = SPANS.request_id(f"{stage}_stem")
+        sinks = list(extra_sinks) + ([SpanSink(SPANS, trace, f"{stage}_stem")] if trace else [])
+        res = chat_completion_ex(
+            build_stem_messages(stage, values),
             temperature=params["temperature"],
             top_p=params["top_p"],
             top_k=params["top_k"],
             repeat_penalty=params["repeat_penalty"],
-            max_tokens=MAX_TOKENS_STAGE1,
+            max_tokens=min(max_tokens, GENERATION_STEM_MAX_TOKENS),
             stream=True,
-            print_stream=True,
+            print_stream=False,
+            stage=f"{stage}_stem",
+            cancel=cancel,
+            sinks=sinks,
+            trace=trace,
+            client=self.profile_client,
+            id_slot=id_slot,
         )
-        print("")
+        if res is None or res.cancelled:
+            return res
+        focus = values.get("focus") or self.session.focus
+        # 組み立てた文面は常に完結しているので、1文が max_tokens で切れても再生成しない
+        return replace(res, text=assemble_stage_text(stage, res.text, values, focus), finish_reason="stop")
+
+    def _call_llm_raw(
+        self, stage, values, params, max_tokens, print_stream, cancel, constraint, sinks=(), client=None, trace=None, id_slot=None
+    ):
+        if client is None and self.pretokenized is not None and self.pretokenized.available:
+            res = self.pretokenized.completion_ex(
+                stage,
+                values,
+                temperature=params["temperature"],
+                top_p=params["top_p"],
+                top_k=params["top_k"],
+                repeat_penalty=params["repeat_penalty"],
+                max_tokens=max_tokens,
+                print_stream=print_stream,
+                cancel=cancel,
+                sinks=sinks,
+                constraint=constraint,
+                trace=trace,
+                id_slot=id_slot,
+            )
+            if res is not None:
+                return res
+
+        return chat_completion_ex(
+            build_stage_messages(stage, values),
+            temperature=params["temperature"],
+            top_p=params["top_p"],
+            top_k=params["top_k"],
+            repeat_penalty=params["repeat_penalty"],
+            max_tokens=max_tokens,
+            stream=True,
+            print_stream=print_stream,
+            stage=stage,
+            cancel=cancel,
+            sinks=sinks,
+            constraint=constraint,
+            client=client,
+            trace=trace,
+            id_slot=id_slot,
+        )
+
+    def on_presence(self) -> None:
+        """
+        人感センサが反応した直後（ノブを読む前）に呼ぶ。今回の観点をここで決め、
+        先行生成・作り置きを止めて、Q1 のプロンプトを prefill だけしておく（待たない）。
+        作り置きの Q1 が出せる観点なら LLM は使わないので prefill しない
+        """
+        SPANS.new_trace()
+        if self.speculator is not None:
+            self.speculator.cancel_all()
+        if self.bank is not None:
+            self.bank.set_idle(False)
+        focus = random.choice(FOCUS_LIST)
+        self._pending_focus = focus
+        if self.presence is None:
+            return
+        if self.bank is not None and self.bank.ready(focus, self.session.temp01, self.session.topk01):
+            self.presence.skip()
+            return
+        values = {"focus": focus, "temp01": self.session.temp01}
+        if self.generation_mode == "stem":
+            self.presence.fire("stage0_stem", build_stem_messages("stage0", values), values, tokens=False, client=self.profile_client)
+        else:
+            self.presence.fire("stage0", build_stage_messages("stage0", values), values, client=self.profile_client)
+
+    def start(self) -> str:
+        """
+        セッション開始：最初の満足度質問をLLMに生成させる
+        """
+        self.start_background()
+        self.session.satisfaction = None
+        self.session.reason = None
+        self.session.phase = "await_sat"
+        self.session.started_at = time.time()
+        self.session.texts = {}
+        self.session.timings_ms = {}
+        self.session.fallbacks = {}
+        self.session.preempted = {}
+        # on_presence() を通っていれば trace と観点はそこで決まっている
+        focus, self._pending_focus = self._pending_focus, None
+        if focus is None:
+            SPANS.new_trace()
+        t0 = time.perf_counter()
+        if self.speculator is not None:
+            self.speculator.cancel_all()
+        if self.bank is not None:
+            # セッション中は作り置きの補充を止めて llama.cpp を空ける
+            self.bank.set_idle(False)
+
+        #今回のセッションの論点を固定
+        if focus is None:
+            focus = random.choice(FOCUS_LIST)
+        self.session.focus = focus
+
+        text = None
+        if self.bank is not None:
+            text = self.bank.take(focus, self.session.temp01, self.session.topk01)
+            if text is not None:
+                res = CompletionResult(text=text, finish_reason="stop")
+                self._replay("stage0", res)
+                text = self._parse("stage0", res)
+        if text is None:
+            if self.presence is not None:
+                self.presence.claim()
+            params = self._params()
+            values = {"focus": self.session.focus, "temp01": self.session.temp01}
+            text = self._generate("stage0", values, params, ceiling=MAX_TOKENS_STAGE1)
         self.session.last_question = text
+        self._record("stage0", text, t0)
+
+        # Q1 表示中に Q2 を 1/2/3 の3通り先行生成
+        self._speculate(
+            "stage1",
+            {
+                k: {"satisfaction": k, "prev_question": text.strip(), "temp01": self.session.temp01}
+                for k in ("1", "2", "3")
+            },
+            MAX_TOKENS_STAGE1,
+        )
         return text
 
     def handle_choice(self, choice_123: str) -> str:
@@ -154,53 +649,44 @@ class ToiletFeedbackEngine:
     def _handle_satisfaction(self, ch: str) -> str:
         self.session.satisfaction = ch
         self.session.phase = "await_reason"
+        t0 = time.perf_counter()
 
         params = self._params()
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            # ※ prompts.py を直すまでは temp01 を渡してOK
-            #{"role": "user", "content": build_stage1_user_prompt(ch, self.session.temp01)},
-            {"role": "user", "content": build_stage1_user_prompt(ch, self.session.last_question or "", self.session.temp01)},
-
-        ]
-
-        print("LLM: ", end="", flush=True)
-        text = chat_completion(
-            messages,
-            temperature=params["temperature"],
-            top_p=params["top_p"],
-            top_k=params["top_k"],
-            repeat_penalty=params["repeat_penalty"],
-            max_tokens=MAX_TOKENS_STAGE1,
-            stream=True,
-            print_stream=True,
-        )
-        print("")
+        values = {
+            "satisfaction": ch,
+            "prev_question": (self.session.last_question or "").strip(),
+            "temp01": self.session.temp01,
+        }
+        text = self._generate("stage1", values, params, ceiling=MAX_TOKENS_STAGE1, spec_key=ch)
         self.session.last_question = text
+        self._record("stage1", text, t0)
+
+        # Q2 表示中に THANKS を 1/2/3 の3通り先行生成
+        self._speculate(
+            "stage2",
+            {
+                k: {"satisfaction": ch, "reason": k, "temp01": self.session.temp01}
+                for k in ("1", "2", "3")
+            },
+            MAX_TOKENS_STAGE2,
+        )
         return text
 
     def _handle_reason(self, ch: str) -> str:
         self.session.reason = ch
         self.session.phase = "done"
+        t0 = time.perf_counter()
 
         params = self._params()
-
-        # ★ stage2 は prompts.py の build_stage2_user_prompt をそのまま効かせたいので
-        # ★ SYSTEM_PROMPT(3択強制) を入れない
-        messages = [
-            {"role": "user", "content": build_stage2_user_prompt(self.session.satisfaction or "2", ch, self.session.temp01)},
-        ]
-
-        print("LLM: ", end="", flush=True)
-        text = chat_completion(
-            messages,
-            temperature=params["temperature"],
-            top_p=params["top_p"],
-            top_k=params["top_k"],
-            repeat_penalty=params["repeat_penalty"],
-            max_tokens=MAX_TOKENS_STAGE2,
-            stream=True,
-            print_stream=True,
-        )
-        print("")
+        values = {
+            "satisfaction": self.session.satisfaction or "2",
+            "reason": ch,
+            "temp01": self.session.temp01,
+        }
+        text = self._generate("stage2", values, params, ceiling=MAX_TOKENS_STAGE2, spec_key=ch)
+        self._record("stage2", text, t0)
+        self._persist()
+        if self.bank is not None:
+            # セッション終了 → 次の人が来るまで作り置きを補充
+            self.bank.set_idle(True)
         return text
@@ -0,0 +1,135 @@
+# state_machine_async.py
+import random
+from typing import Callable, Optional
+
+import constrained
+from config import ADAPTIVE_MAX_TOKENS, CONSTRAINED_DECODING, MAX_TOKENS_STAGE1, MAX_TOKENS_STAGE2
+from llm_client_async import chat_completion_async
+from max_tokens_predictor import MaxTokensPredictor
+from prompts import build_stage_messages
+from state_machine import FOCUS_LIST, Session, clamp, norm_choice_123, sampling_from_knobs
+
+
+class AsyncToiletFeedbackEngine:
+    """
+    ToiletFeedbackEngine の asyncio 版。フロー・プロンプト・Session は同期版と同じ。
+
+    各ステージは await 1回で完結するので、呼び出し側がタスクにして cancel すれば
+    生成途中でも upstream への接続ごと打ち切れる（cancel 後は reset() で待機状態へ）。
+    """
+
+    def __init__(self, max_tokens: Optional[MaxTokensPredictor] = None):
+        self.session = Session()
+        if max_tokens is None and ADAPTIVE_MAX_TOKENS:
+            max_tokens = MaxTokensPredictor()
+        self.max_tokens = max_tokens
+        self.backend: Optional[str] = None
+        self.constrained = CONSTRAINED_DECODING
+
+    def set_knobs(self, temp01: float, topk01: float):
+        self.session.temp01 = clamp(temp01, 0.0, 1.0)
+        self.session.topk01 = clamp(topk01, 0.0, 1.0)
+
+    def reset(self):
+        # ノブ値は引き継ぐ
+        self.session = Session(
+            temp01=self.session.temp01,
+            topk01=self.session.topk01,
+        )
+
+    async def _generate(
+        self,
+        s,
+        stage: str,
+        values: dict,
+        ceiling: int,
+        on_delta: Optional[Callable[[str], None]],
+    ) -> str:
+        params = sampling_from_knobs(s.temp01, s.topk01)
+        cap = ceiling
+        if self.max_tokens is not None:
+            cap = self.max_tokens.predict(stage, self.backend, ceiling)
+
+        async def _call(max_tokens: int):
+            return await chat_completion_async(
+                build_stage_messages(stage, values),
+                temperature=params["temperature"],
+                top_p=params["top_p"],
+                top_k=params["top_k"],
+                repeat_penalty=params["repeat_penalty"],
+                max_tokens=max_tokens,
+                stage=stage,
+                # JSON はそのまま流しても読めないので、整形後の文面だけ返す
+                on_delta=on_delta if self.constrained != "json" else None,
+                constraint=constrained.constraint_for(stage, self.constrained),
+            )
+
+        res = await _call(cap)
+        if res.truncated and cap < ceiling:
+            if self.max_tokens is not None:
+                self.max_tokens.observe_truncated(stage, self.backend, res.completion_tokens or cap)
+            cap = ceiling
+            res = await _call(cap)
+
+        self.backend = res.backend or self.backend
+        if self.max_tokens is not None and not res.truncated:
+            n = res.completion_tokens if res.completion_tokens is not None else len(res.text)
+            self.max_tokens.observe(stage, self.backend, n, cap, ceiling)
+
+        parsed = constrained.parse_output(stage, res.text, self.constrained)
+        constrained.STATS.record(stage, self.constrained, parsed is not None, res.completion_tokens)
+        if parsed is None:
+            return res.text
+        if self.constrained == "json" and on_delta is not None:
+            on_delta(parsed.render())
+        return parsed.render()
+
+    async def start(self, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        return await self.start_session(self.session, on_delta)
+
+    async def handle_choice(self, choice_123: str, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        return await self.choice_session(self.session, choice_123, on_delta)
+
+    # -------- セッションを外から渡す版（session_server が複数キオスクで共有する） --------
+    # s は Session と同じ属性（temp01/topk01/focus/satisfaction/reason/last_question/phase）を持てばよい
+    async def start_session(self, s, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        s.satisfaction = None
+        s.reason = None
+        s.phase = "await_sat"
+        s.focus = random.choice(FOCUS_LIST)
+
+        values = {"focus": s.focus, "temp01": s.temp01}
+        text = await self._generate(s, "stage0", values, MAX_TOKENS_STAGE1, on_delta)
+        s.last_question = text
+        return text
+
+    async def choice_session(self, s, choice_123: str, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        ch = norm_choice_123(choice_123)
+        if ch is None:
+            return "入力エラー。1/2/3 を入力してください。"
+
+        if s.phase == "await_sat":
+            s.satisfaction = ch
+            s.phase = "await_reason"
+            values = {
+                "satisfaction": ch,
+                "prev_question": (s.last_question or "").strip(),
+                "temp01": s.temp01,
+            }
+            text = await self._generate(s, "stage1", values, MAX_TOKENS_STAGE1, on_delta)
+            s.last_question = text
+            return text
+
+        if s.phase == "await_reason":
+            s.reason = ch
+            s.phase = "done"
+            values = {
+                "satisfaction": s.satisfaction or "2",
+                "reason": ch,
+                "temp01": s.temp01,
+            }
+            return await self._generate(s, "stage2", values, MAX_TOKENS_STAGE2, on_delta)
+
+        if s.phase == "idle":
+            return "まだ開始していません。/start を実行してください。"
+        return "このセッションは完了しています。/start で新しく開始できます。"
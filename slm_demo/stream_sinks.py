@@ -0,0 +1,171 @@
+# stream_sinks.py
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from llm_stream import Delta, Finish, FirstToken, StreamSink, StreamStart
+from max_tokens_predictor import quantile
+
+
+class ConsoleSink(StreamSink):
+    """
+    delta を届いた順にそのまま表示する（従来の print_stream=True と同じ表示）
+    """
+
+    def on_delta(self, ev: Delta) -> None:
+        print(ev.text, end="", flush=True)
+
+
+class LCDSink(StreamSink):
+    """
+    表示器向け。最初のトークンが届いた時点で描画し、以降は min_interval_s ごとにまとめて再描画する。
+    render(text_so_far, final) を呼ぶ（I2C LCD 等の書き込みは遅いので毎 delta では描かない）。
+    """
+
+    def __init__(self, render: Callable[[str, bool], None], min_interval_s: float = 0.1):
+        self.render = render
+        self.min_interval_s = min_interval_s
+        self._buf: List[str] = []
+        self._last = 0.0
+
+    def on_start(self, ev: StreamStart) -> None:
+        self._buf = []
+        self._last = 0.0
+
+    def on_delta(self, ev: Delta) -> None:
+        self._buf.append(ev.text)
+        if ev.t - self._last >= self.min_interval_s:
+            self._last = ev.t
+            self.render("".join(self._buf), False)
+
+    def on_finish(self, ev: Finish) -> None:
+        self.render("".join(self._buf).strip(), True)
+
+
+class RecorderSink(StreamSink):
+    """
+    イベントを JSONL で追記する（あとで表示タイミングを再現・解析する用）
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._t0: Optional[float] = None
+        self._stage: Optional[str] = None
+
+    def _write(self, obj: dict) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+
+    def _ms(self, t: float) -> float:
+        return round((t - (self._t0 or t)) * 1000.0, 2)
+
+    def on_start(self, ev: StreamStart) -> None:
+        self._t0 = ev.t
+        self._stage = ev.stage
+        self._write({"ev": "start", "ts": time.time(), "stage": ev.stage, "backend": ev.backend, "connect_ms": ev.connect_ms})
+
+    def on_first_token(self, ev: FirstToken) -> None:
+        self._write({"ev": "first_token", "stage": self._stage, "ms": self._ms(ev.t), "ttft_ms": round(ev.ttft_ms, 2)})
+
+    def on_delta(self, ev: Delta) -> None:
+        self._write({"ev": "delta", "stage": self._stage, "ms": self._ms(ev.t), "text": ev.text})
+
+    def on_finish(self, ev: Finish) -> None:
+        res = ev.result
+        self._write({
+            "ev": "finish",
+            "stage": self._stage,
+            "ms": self._ms(ev.t),
+            "finish_reason": getattr(res, "finish_reason", None),
+            "usage": ev.usage,
+        })
+
+
+class MetricsSink(StreamSink):
+    """
+    ステージ別の TTFT / 生成時間 / tokens/s を集計する（/status 表示用）
+
+    - 先行生成・作り置きの再生（StreamStart.replayed）は 0ms になって分位点を歪めるので集計せず、replayed に数だけ数える
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._stage: Optional[str] = None
+        self._first: Optional[float] = None
+        self._ttft: Dict[str, List[float]] = {}
+        self._total: Dict[str, List[float]] = {}
+        self._tps: Dict[str, List[float]] = {}
+        self._replaying = False
+        self.replayed = 0
+        # 最後まで終わった生成の数（thermal.py が新しい実測が来たかを見る）
+        self.finished = 0
+
+    def _push(self, table: Dict[str, List[float]], stage: str, v: float) -> None:
+        xs = table.setdefault(stage, [])
+        xs.append(v)
+        if len(xs) > self.window:
+            del xs[: len(xs) - self.window]
+
+    def on_start(self, ev: StreamStart) -> None:
+        self._stage = ev.stage or "unknown"
+        self._first = None
+        self._replaying = ev.replayed
+        if ev.replayed:
+            with self._lock:
+                self.replayed += 1
+
+    def on_first_token(self, ev: FirstToken) -> None:
+        if self._replaying:
+            return
+        self._first = ev.t
+        with self._lock:
+            self._push(self._ttft, self._stage or "unknown", ev.ttft_ms)
+
+    def on_finish(self, ev: Finish) -> None:
+        if self._replaying:
+            return
+        if getattr(ev.result, "cancelled", False):
+            # 途中で打ち切った生成は完了時間に入れない（ボタンの先取り・予算切れ）
+            return
+        stage = self._stage or "unknown"
+        n = ev.usage.get("completion_tokens")
+        with self._lock:
+            self.finished += 1
+            self._push(self._total, stage, ev.elapsed_ms)
+            if n and self._first is not None and ev.t > self._first:
+                self._push(self._tps, stage, n / (ev.t - self._first))
+
+    def recent_tokens_per_s(self, n: int = 5) -> Optional[float]:
+        """
+        各ステージの直近 n 回の tokens/s の中央値（熱・負荷の制御用。まだ無ければ None）
+        """
+        with self._lock:
+            xs = [v for vs in self._tps.values() for v in vs[-n:]]
+        return quantile(xs, 0.5) if xs else None
+
+    def recent_total_ms(self, n: int = 5) -> Dict[str, float]:
+        """
+        ステージ → 直近 n 回の生成時間(ms)の中央値
+        """
+        with self._lock:
+            return {stage: quantile(vs[-n:], 0.5) for stage, vs in self._total.items() if vs}
+
+    def snapshot(self) -> dict:
+        out = {}
+        with self._lock:
+            for stage in sorted(set(self._ttft) | set(self._total)):
+                ttft = self._ttft.get(stage) or []
+                total = self._total.get(stage) or []
+                tps = self._tps.get(stage) or []
+                out[stage] = {
+                    "n": len(total),
+                    "ttft_ms_p50": round(quantile(ttft, 0.5), 1) if ttft else None,
+                    "ttft_ms_p95": round(quantile(ttft, 0.95), 1) if ttft else None,
+                    "total_ms_p50": round(quantile(total, 0.5), 1) if total else None,
+                    "tokens_per_s_p50": round(quantile(tps, 0.5), 1) if tps else None,
+                }
+        return out
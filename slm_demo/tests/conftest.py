@@ -0,0 +1,6 @@
+# conftest.py
+# slm_demo のモジュールは同じディレクトリからの import 前提なので、tests からも同じように読めるようにする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,74 @@
+# test_early_stop.py
+import early_stop
+from early_stop import EarlyStop, EarlyStopStats, question_complete
+
+Q = "清潔さはいかがでしたか？\n"
+
+
+def test_question_complete_waits_for_option3_to_close():
+    assert question_complete(Q + "1:満足した 2:普通だった 3:気になった") is None
+    text = Q + "1:満足した 2:普通だった 3:気になった\n"
+    assert question_complete(text) == len(text) - 1
+
+
+def test_question_complete_ignores_space_inside_option3():
+    # 「少し 気になった」の空白で閉じたとみなさない
+    assert question_complete(Q + "1:満足 2:普通 3:少し ") is None
+    assert question_complete(Q + "1:満足 2:普通 3:少し 気になった") is None
+    text = Q + "1:満足 2:普通 3:少し 気になった\n"
+    assert text[: question_complete(text)].endswith("少し 気になった")
+
+
+def test_question_complete_includes_full_stop():
+    text = Q + "1:満足\n2:普通\n3:気になった。補足です"
+    assert text[: question_complete(text)].endswith("気になった。")
+
+
+def test_question_complete_accepts_fullwidth_digits_and_colons():
+    text = Q + "１：満足 ２：普通 ３：気になった\n"
+    assert question_complete(text) == len(text) - 1
+
+
+def test_question_complete_needs_question_before_options():
+    assert question_complete("1:満足 2:普通 3:気になった\n") is None
+    assert question_complete(Q + "1:満足 3:気になった\n") is None
+
+
+def test_early_stop_cuts_delta_at_completion(monkeypatch):
+    monkeypatch.setattr(early_stop, "STATS", EarlyStopStats())
+    es = EarlyStop("stage1", 64, verbose=False)
+    assert es.check(Q) == (Q, False)
+    assert es.check("1:満足 2:普通 3:気") == ("1:満足 2:普通 3:気", False)
+    assert es.check("になった\nありがとう") == ("になった", True)
+    assert es.stopped
+    assert es.finish() == 3
+
+
+def test_saving_is_estimated_only_after_natural_samples(monkeypatch):
+    stats = EarlyStopStats()
+    monkeypatch.setattr(early_stop, "STATS", stats)
+
+    def run(chunks):
+        es = EarlyStop("stage1", 64, verbose=False)
+        for c in chunks:
+            _, stop = es.check(c)
+            if stop:
+                break
+        return es.finish()
+
+    natural = [Q, "1:満足 ", "2:普通 ", "3:気に", "なった"]   # 改行が来ないまま終わる（自然終了・5 chunk）
+    early = [Q, "1:満足 2:普通 3:気になった\n", "余計な続き"]
+
+    run(early)
+    st = stats.snapshot()["stage1"]
+    assert st["early"] == 1 and st["estimated"] == 0 and st["tokens_saved_est"] == 0
+
+    for _ in range(EarlyStopStats.NATURAL_MIN_SAMPLES):
+        run(natural)
+    assert stats.natural_length("stage1") == 5.0
+
+    run(early)
+    st = stats.snapshot()["stage1"]
+    # max_tokens(64) との差ではなく、自然終了の中央値(5) との差で見積もる
+    assert st["estimated"] == 1
+    assert st["tokens_saved_est"] == 5 - 2
@@ -0,0 +1,118 @@
+# test_engine.py
+# ToiletFeedbackEngine を、SSE を返すだけの偽の upstream（llama.cpp / proxy の代わり）につないで1セッション通す
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import llm_client
+import span_trace
+import state_machine
+from llm_client import STAGE_HEADER, LLMClient
+from max_tokens_predictor import MaxTokensPredictor
+
+REPLIES = {
+    "stage0": "清潔さはいかがでしたか？\n1:満足した 2:普通だった 3:気になった\n",
+    "stage1": "特に気になった点はどれですか？\n1:床 2:便器 3:におい\n",
+    "stage2": "ご協力ありがとうございました。またのご利用をお待ちしております。",
+}
+
+
+class FakeUpstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        stage = self.headers.get(STAGE_HEADER)
+        self.requests.append((stage, body))
+        text = REPLIES[stage]
+        frames = [{"choices": [{"index": 0, "delta": {"content": text[i:i + 4]}, "finish_reason": None}]}
+                  for i in range(0, len(text), 4)]
+        frames.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                       "usage": {"prompt_tokens": 50, "completion_tokens": len(frames)}})
+        out = b"".join(b"data: " + json.dumps(f, ensure_ascii=False).encode() + b"\n\n" for f in frames)
+        out += b"data: [DONE]\n\n"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    FakeUpstream.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = LLMClient(f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions", uds_path=None)
+    monkeypatch.setattr(llm_client, "_default_client", client)
+    # リポジトリの var/ に学習結果や span を書かない
+    monkeypatch.setattr(state_machine, "MaxTokensPredictor", lambda: MaxTokensPredictor(path=None))
+    monkeypatch.setattr(span_trace.SPANS, "enabled", False)
+    yield client
+    server.shutdown()
+    server.server_close()
+
+
+def run_session(eng):
+    q1 = eng.start()
+    q2 = eng.handle_choice("3")
+    thanks = eng.handle_choice("2")
+    return q1, q2, thanks
+
+
+def test_session_runs_all_stages_over_one_connection(upstream):
+    eng = state_machine.ToiletFeedbackEngine()
+    q1, q2, thanks = run_session(eng)
+
+    assert "清潔さはいかがでしたか？" in q1 and "3:気になった" in q1
+    assert "1:床" in q2
+    assert "お待ちしております" in thanks
+    assert eng.session.phase == "done"
+    assert (eng.session.satisfaction, eng.session.reason) == ("3", "2")
+    assert set(eng.session.texts) == {"stage0", "stage1", "stage2"}
+
+    assert [stage for stage, _ in FakeUpstream.requests] == ["stage0", "stage1", "stage2"]
+    assert all(body["stream"] for _, body in FakeUpstream.requests)
+    # Q2 のプロンプトには表示した Q1 が入る
+    assert "清潔さはいかがでしたか？" in json.dumps(FakeUpstream.requests[1][1]["messages"], ensure_ascii=False)
+
+    st = upstream.snapshot()
+    assert st["calls"] == 3 and st["connects"] == 1 and st["reused"] == 2
+    assert set(eng.stream_metrics.snapshot()) == {"stage0", "stage1", "stage2"}
+    assert eng.stream_metrics.replayed == 0
+
+
+def test_speculative_replay_stays_out_of_stream_metrics(upstream, monkeypatch):
+    monkeypatch.setattr(state_machine, "SPECULATIVE_PREGEN", True)
+    eng = state_machine.ToiletFeedbackEngine()
+    q1, q2, thanks = run_session(eng)
+
+    assert "1:床" in q2 and "お待ちしております" in thanks
+    assert eng.speculator.stats["hits"] == 2
+    # Q2 と THANKS は先行生成の再生なので、TTFT・生成時間の集計には入らない
+    assert set(eng.stream_metrics.snapshot()) == {"stage0"}
+    assert eng.stream_metrics.replayed == 2
+
+
+def test_thanks_is_not_preempted_after_type_ahead_answer(upstream):
+    eng = state_machine.ToiletFeedbackEngine()
+    ta = eng.type_ahead
+    eng.start()
+
+    # Q2 の生成中（= 受け付け中）に押された回答
+    ta.open()
+    ta.press("1")
+    eng.handle_choice("3")
+    assert ta.close() == "1"
+
+    # THANKS は受け付けの外なので、先取りした回答で打ち切らない
+    thanks = eng.handle_choice("1")
+    assert "お待ちしております" in thanks
+    assert "stage2" not in eng.session.preempted
+    assert [stage for stage, _ in FakeUpstream.requests] == ["stage0", "stage1", "stage2"]
@@ -0,0 +1,86 @@
+# test_max_tokens_predictor.py
+import json
+
+from max_tokens_predictor import MaxTokensPredictor, quantile
+
+
+def make(tmp_path=None, **kw):
+    kw.setdefault("q", 0.99)
+    kw.setdefault("margin", 16)
+    kw.setdefault("min_samples", 8)
+    kw.setdefault("floor", 32)
+    kw.setdefault("window", 200)
+    return MaxTokensPredictor(path=str(tmp_path / "mt.json") if tmp_path else None, **kw)
+
+
+def test_quantile_nearest_rank():
+    assert quantile([], 0.5) == 0.0
+    assert quantile([5, 1, 3], 0.5) == 3.0
+    assert quantile(range(1, 101), 0.99) == 99.0
+    assert quantile([7], 0.99) == 7.0
+
+
+def test_uses_ceiling_until_min_samples():
+    p = make()
+    for _ in range(7):
+        p.observe("stage1", "llama", 40, cap=128, ceiling=128)
+    assert p.predict("stage1", "llama", 128) == 128
+    p.observe("stage1", "llama", 40, cap=128, ceiling=128)
+    assert p.predict("stage1", "llama", 128) == 40 + 16
+
+
+def test_prediction_is_bounded_by_floor_and_ceiling():
+    p = make()
+    for _ in range(10):
+        p.observe("short", None, 3, cap=128, ceiling=128)
+        p.observe("long", None, 500, cap=128, ceiling=128)
+    assert p.predict("short", None, 128) == 32        # 3 + 16 < floor
+    assert p.predict("long", None, 128) == 128        # 呼び出し側の上限は超えない
+    assert p.predict("long", None, 1024) == 500 + 16
+
+
+def test_keys_are_per_template_and_backend():
+    p = make()
+    for _ in range(10):
+        p.observe("stage1", "llama", 60, cap=128, ceiling=128)
+    assert p.predict("stage1", "llama", 128) == 76
+    assert p.predict("stage1", "gemini", 128) == 128
+    assert p.predict("stage2", "llama", 128) == 128
+    # backend=None は "default" として別に学習する
+    assert p.predict("stage1", None, 128) == 128
+
+
+def test_window_forgets_old_samples():
+    p = make(window=10, min_samples=5)
+    for _ in range(10):
+        p.observe("stage1", None, 200, cap=256, ceiling=256)
+    for _ in range(10):
+        p.observe("stage1", None, 50, cap=256, ceiling=256)
+    assert p.predict("stage1", None, 256) == 66
+
+
+def test_budget_reduced_and_truncation_stats():
+    p = make()
+    p.observe("stage1", "llama", 40, cap=56, ceiling=128)
+    p.observe("stage1", "llama", 40, cap=128, ceiling=128)
+    p.observe_truncated("stage1", "llama", wasted_tokens=56)
+    st = p.snapshot()["stage1@llama"]
+    assert st["requests"] == 2
+    assert st["budget_reduced"] == 128 - 56
+    assert st["truncated"] == 1 and st["retry_wasted_tokens"] == 56
+
+
+def test_samples_persist_across_restart(tmp_path):
+    p = make(tmp_path)
+    for _ in range(8):
+        p.observe("stage0", "llama", 30, cap=128, ceiling=128)
+    p.observe_truncated("stage0", "llama", wasted_tokens=40)
+    # observe のたびには書かない
+    assert not (tmp_path / "mt.json").exists()
+    p.flush()
+    with open(tmp_path / "mt.json", encoding="utf-8") as f:
+        assert json.load(f)["samples"]["stage0@llama"] == [30] * 8
+    again = make(tmp_path)
+    assert again.predict("stage0", "llama", 128) == 46
+    st = again.snapshot()["stage0@llama"]
+    assert st["requests"] == 8 and st["truncated"] == 1 and st["retry_wasted_tokens"] == 40
@@ -0,0 +1,98 @@
+# test_question_bank.py
+import time
+from collections import deque
+
+from question_bank import QuestionBank, bucket_center, knob_bucket
+
+
+def make_bank(tmp_path, **kw):
+    kw.setdefault("ttl_s", 60.0)
+    return QuestionBank(["清潔さ", "におい"], generate_fn=None, path=str(tmp_path / "bank.json"), steps=5, **kw)
+
+
+def put(bank, focus, bucket, text, age_s=0.0):
+    bank._pool.setdefault((focus,) + bucket, deque()).append(
+        {"text": text, "created": time.time() - age_s}
+    )
+
+
+def test_knob_bucket_rounds_and_clamps():
+    assert knob_bucket(0.0, 1.0, steps=5) == (0, 4)
+    assert knob_bucket(0.5, 0.5, steps=5) == (2, 2)
+    assert knob_bucket(0.37, 0.63, steps=5) == (1, 3)
+    assert knob_bucket(-0.2, 1.7, steps=5) == (0, 4)
+    assert bucket_center((1, 3), steps=5) == (0.25, 0.75)
+
+
+def test_knob_bucket_of_center_is_same_bucket():
+    for b in [(0, 0), (1, 2), (4, 3)]:
+        assert knob_bucket(*bucket_center(b, steps=5), steps=5) == b
+
+
+def test_take_returns_oldest_for_matching_bucket(tmp_path):
+    bank = make_bank(tmp_path)
+    put(bank, "清潔さ", (2, 2), "Q-a", age_s=10)
+    put(bank, "清潔さ", (2, 2), "Q-b", age_s=5)
+    assert bank.ready("清潔さ", 0.55, 0.45)
+    assert bank.take("清潔さ", 0.55, 0.45) == "Q-a"
+    assert bank.take("におい", 0.55, 0.45) is None     # 観点が違う
+    assert bank.take("清潔さ", 0.0, 0.45) is None      # バケットが違う
+    assert bank.take("清潔さ", 0.5, 0.5) == "Q-b"
+    assert bank.take("清潔さ", 0.5, 0.5) is None
+    st = bank.snapshot()
+    assert st["hits"] == 2 and st["misses"] == 3
+
+
+def test_take_skips_expired_entries(tmp_path):
+    bank = make_bank(tmp_path, ttl_s=60.0)
+    put(bank, "清潔さ", (2, 2), "old", age_s=120)
+    put(bank, "清潔さ", (2, 2), "fresh", age_s=1)
+    assert bank.take("清潔さ", 0.5, 0.5) == "fresh"
+    assert bank.stats["expired"] == 1
+
+    put(bank, "におい", (2, 2), "old", age_s=120)
+    assert not bank.ready("におい", 0.5, 0.5)
+    assert bank.take("におい", 0.5, 0.5) is None
+    assert bank.stats["expired"] == 2
+
+
+def test_save_and_load_drop_expired_and_unknown_focus(tmp_path):
+    bank = make_bank(tmp_path, ttl_s=60.0)
+    put(bank, "清潔さ", (1, 3), "keep", age_s=1)
+    put(bank, "におい", (1, 3), "expired", age_s=120)
+    put(bank, "明るさ", (1, 3), "unknown focus", age_s=1)
+    bank.save()
+
+    again = make_bank(tmp_path, ttl_s=60.0)
+    assert again.take("清潔さ", 0.25, 0.75) == "keep"
+    assert again.take("におい", 0.25, 0.75) is None
+    assert ("明るさ", 1, 3) not in again._pool
+
+
+def test_taken_entries_are_not_served_after_restart(tmp_path):
+    bank = make_bank(tmp_path)
+    put(bank, "清潔さ", (2, 2), "Q-a", age_s=10)
+    put(bank, "清潔さ", (2, 2), "Q-b", age_s=5)
+    bank.save()
+
+    assert bank.take("清潔さ", 0.5, 0.5) == "Q-a"
+    # take() 自体は書かない（表示経路）。補充スレッドの次の周回か stop() で保存する
+    assert make_bank(tmp_path).take("清潔さ", 0.5, 0.5) == "Q-a"
+    bank.stop()
+    again = make_bank(tmp_path)
+    assert again.take("清潔さ", 0.5, 0.5) == "Q-b"
+    assert again.take("清潔さ", 0.5, 0.5) is None
+
+
+def test_hit_ages_are_bounded(tmp_path):
+    bank = make_bank(tmp_path)
+    for i in range(QuestionBank.HIT_AGES_WINDOW + 50):
+        put(bank, "清潔さ", (2, 2), f"Q{i}")
+        assert bank.take("清潔さ", 0.5, 0.5) == f"Q{i}"
+    assert len(bank._hit_ages) == QuestionBank.HIT_AGES_WINDOW
+    assert bank.snapshot()["hits"] == QuestionBank.HIT_AGES_WINDOW + 50
+
+
+def test_construction_does_not_start_filling(tmp_path):
+    bank = make_bank(tmp_path)
+    assert bank._thread is None
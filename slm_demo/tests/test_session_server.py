@@ -0,0 +1,45 @@
+# test_session_server.py
+import asyncio
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+from session_server import SessionHub, build_app
+
+
+def request_all(calls):
+    """
+    calls: [(method, path, json)] を順に投げて [(status, body)] を返す
+    """
+    async def run():
+        async with TestServer(build_app(SessionHub())) as server:
+            async with ClientSession() as session:
+                out = []
+                for method, path, body in calls:
+                    async with session.request(method, server.make_url(path), json=body) as resp:
+                        out.append((resp.status, await resp.json(content_type=None) if resp.status == 200 else None))
+                return out
+
+    return asyncio.run(run())
+
+
+def test_rejected_choice_does_not_change_knobs():
+    out = request_all([
+        ("POST", "/kiosks/k1/knobs", {"temp01": 0.2, "topk01": 0.3}),
+        ("POST", "/kiosks/k1/choice", {"choice": "1", "temp01": 0.9, "topk01": 0.9}),   # まだ開始していない → 409
+        ("POST", "/kiosks/k1/choice", {"choice": "9", "temp01": 0.9}),                  # 不正な choice → 400
+        ("GET", "/kiosks/k1", None),
+    ])
+    assert [status for status, _ in out] == [200, 409, 400, 200]
+    assert (out[-1][1]["temp01"], out[-1][1]["topk01"]) == (0.2, 0.3)
+
+
+def test_touch_keeps_order_by_last_seen():
+    hub = SessionHub(max_sessions=10)
+    a = hub.get("a")
+    b = hub.get("b")
+    hub.touch(a)     # 生成が終わったときなど get() を通らない更新
+    assert list(hub.sessions) == ["b", "a"]
+    assert b.last_seen <= a.last_seen
+    hub.find("b")    # GET は順番を変えない
+    assert list(hub.sessions) == ["b", "a"]
@@ -0,0 +1,16 @@
+# test_stream_parsers.py
+from llm_client import parse_chat_chunk
+from pretokenized import parse_completion_chunk
+
+
+def test_chat_chunk():
+    assert parse_chat_chunk({"choices": [{"delta": {"content": "清潔"}, "finish_reason": None}]}) == ("清潔", None, None, False)
+    last = {"choices": [{"delta": {}, "finish_reason": "length"}], "usage": {"completion_tokens": 12}}
+    delta, reason, tokens, done = parse_chat_chunk(last)
+    assert not delta and (reason, tokens, done) == ("length", 12, False)   # 終わりは [DONE] で判断する
+
+
+def test_completion_chunk():
+    assert parse_completion_chunk({"content": "清潔", "stop": False}) == ("清潔", None, None, False)
+    assert parse_completion_chunk({"content": "", "stop": True, "stop_type": "eos", "tokens_predicted": 9}) == ("", "stop", 9, True)
+    assert parse_completion_chunk({"content": "", "stop": True, "stop_type": "limit"}) == ("", "length", None, True)
@@ -0,0 +1,232 @@
+# thermal.py
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from config import (
+    SESSION_LATENCY_TARGET_S,
+    THERMAL_DOWN_HOLD_S,
+    THERMAL_FREQ_RATIO,
+    THERMAL_HYSTERESIS_C,
+    THERMAL_INTERVAL_S,
+    THERMAL_LATENCY_RELAX,
+    THERMAL_LOAD_PER_CPU,
+    THERMAL_PROFILES,
+    THERMAL_RETRY_S,
+    THERMAL_SENSOR_ROOT,
+    THERMAL_TEMP_C,
+    THERMAL_UP_SAMPLES,
+)
+
+# root からの相対パス（シミュレーションでは同じ構成の合成ファイルを置く）
+TEMP_PATH = "sys/class/thermal/thermal_zone0/temp"                  # ミリ℃
+FREQ_PATH = "sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq"  # kHz
+MAX_FREQ_PATH = "sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq"
+LOADAVG_PATH = "proc/loadavg"
+CPU_ONLINE_PATH = "sys/devices/system/cpu/online"                   # "0-3"
+
+
+class SensorReader:
+    """
+    CPU 温度・周波数・loadavg を読む。読めないもの（Pi 以外・コンテナ内など）は None
+    """
+
+    def __init__(self, root: str = THERMAL_SENSOR_ROOT):
+        self.root = root
+
+    def _read(self, rel: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.root, rel)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _num(self, rel: str) -> Optional[float]:
+        s = self._read(rel)
+        try:
+            return float(s.split()[0]) if s else None
+        except ValueError:
+            return None
+
+    def _cpus(self) -> int:
+        s = self._read(CPU_ONLINE_PATH)
+        if not s:
+            return os.cpu_count() or 1
+        n = 0
+        for part in s.split(","):
+            lo, _, hi = part.partition("-")
+            n += int(hi) - int(lo) + 1 if hi else 1
+        return max(1, n)
+
+    def read(self) -> Dict[str, Optional[float]]:
+        temp = self._num(TEMP_PATH)
+        freq = self._num(FREQ_PATH)
+        max_freq = self._num(MAX_FREQ_PATH)
+        load = self._num(LOADAVG_PATH)
+        return {
+            "temp_c": temp / 1000.0 if temp is not None else None,
+            "freq_ratio": freq / max_freq if freq and max_freq else None,
+            "load_per_cpu": load / self._cpus() if load is not None else None,
+        }
+
+
+class ThermalController:
+    """
+    センサと生成の実測（tokens/s・ステージごとの生成時間）から、THERMAL_PROFILES のどれで動くかを決める。
+
+    - 温度は THERMAL_TEMP_C を超えるごとに1段、周波数が落ちていれば（throttle）2段以上、loadavg が高ければ1段以上
+    - 直近の Q1+Q2+THANKS の生成時間が SESSION_LATENCY_TARGET_S を超えていれば今より1段重く。
+      切り替え後に新しい生成の実測が揃うまでは、この判断に使わない（古い実測で段を上げ続けない）
+    - ヒステリシス: 重くするのは THERMAL_UP_SAMPLES 回続いたら（必要な段まで一気に）、
+      軽くするのは温度が閾値を THERMAL_HYSTERESIS_C 下回り、かつ生成時間に余裕がある状態が THERMAL_DOWN_HOLD_S 続いたら1段ずつ。
+      切り替え後の実測が揃うまで（セッションが来ていて測り途中のとき）は軽くしない。
+      生成時間が目標を超えて離れたプロファイルへは THERMAL_RETRY_S 経つまで戻らない
+    - 切り替えは apply(profile) で engine に渡す
+    """
+
+    def __init__(
+        self,
+        metrics,
+        apply: Callable[[dict], None],
+        sensors: Optional[SensorReader] = None,
+        profiles=THERMAL_PROFILES,
+        interval_s: float = THERMAL_INTERVAL_S,
+    ):
+        """
+        metrics は recent_tokens_per_s() / recent_total_ms() / finished を持つもの（stream_sinks.MetricsSink）
+        """
+        self.metrics = metrics
+        self.apply = apply
+        self.sensors = sensors or SensorReader()
+        self.profiles = profiles
+        self.interval_s = interval_s
+        self.level = 0
+        self._up = 0
+        self._calm_since: Optional[float] = None
+        self._seen = 0
+        self._missed: Dict[int, float] = {}
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last: dict = {}
+        self.switches = 0
+        self._time_in: Dict[str, float] = {}
+        self._t_level: Optional[float] = None
+
+    @property
+    def profile(self) -> dict:
+        return self.profiles[self.level]
+
+    def _latency_s(self) -> Optional[float]:
+        # 切り替え後、1セッション分（3ステージ）の新しい実測が揃うまでは使わない
+        if self.metrics.finished < self._seen + 3:
+            return None
+        totals = self.metrics.recent_total_ms(3)
+        if not totals:
+            return None
+        return sum(ms for stage, ms in totals.items() if stage in ("stage0", "stage1", "stage2")) / 1000.0
+
+    def _wanted(self, s: dict, latency_s: Optional[float], hysteresis_c: float) -> int:
+        top = len(self.profiles) - 1
+        level = 0
+        if s["temp_c"] is not None:
+            level = sum(1 for th in THERMAL_TEMP_C if s["temp_c"] > th - hysteresis_c)
+        if s["freq_ratio"] is not None and s["freq_ratio"] < THERMAL_FREQ_RATIO:
+            level = max(level, 2)
+        if s["load_per_cpu"] is not None and s["load_per_cpu"] > THERMAL_LOAD_PER_CPU:
+            level = max(level, 1)
+        if latency_s is not None:
+            if latency_s > SESSION_LATENCY_TARGET_S:
+                level = max(level, self.level + 1)
+            elif latency_s > SESSION_LATENCY_TARGET_S * THERMAL_LATENCY_RELAX:
+                level = max(level, self.level)
+        return min(level, top)
+
+    def _switch(self, level: int, now: float, why: str) -> None:
+        self._account(now)
+        old = self.profiles[self.level]["name"]
+        self.level = level
+        self.switches += 1
+        self._up = 0
+        self._calm_since = None
+        self._seen = self.metrics.finished
+        print(f"\n[thermal] {old} → {self.profile['name']}（{why}）", flush=True)
+        self.apply(self.profile)
+
+    def _account(self, now: float) -> None:
+        if self._t_level is not None:
+            name = self.profile["name"]
+            self._time_in[name] = self._time_in.get(name, 0.0) + (now - self._t_level)
+        self._t_level = now
+
+    def step(self, now: Optional[float] = None) -> dict:
+        """
+        1回サンプリングして、必要ならプロファイルを切り替える（シミュレーションでは now を進めて呼ぶ）
+        """
+        now = time.monotonic() if now is None else now
+        if self._t_level is None:
+            self._t_level = now
+        s = self.sensors.read()
+        latency_s = self._latency_s()
+        up = self._wanted(s, latency_s, 0.0)
+        down = self._wanted(s, latency_s, THERMAL_HYSTERESIS_C)
+        self.last = dict(s, tokens_per_s=self.metrics.recent_tokens_per_s(), latency_s=latency_s, wanted=up)
+
+        if up > self.level:
+            self._up += 1
+            if self._up >= THERMAL_UP_SAMPLES:
+                if latency_s is not None and latency_s > SESSION_LATENCY_TARGET_S:
+                    self._missed[self.level] = now
+                self._switch(up, now, self._why(s, latency_s))
+            return self.last
+        self._up = 0
+        measuring = latency_s is None and self.metrics.finished > self._seen
+        retry_at = self._missed.get(self.level - 1, float("-inf")) + THERMAL_RETRY_S
+        if down < self.level and not measuring and now >= retry_at:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= THERMAL_DOWN_HOLD_S:
+                self._switch(self.level - 1, now, "余裕あり")
+        else:
+            self._calm_since = None
+        return self.last
+
+    def _why(self, s: dict, latency_s: Optional[float]) -> str:
+        parts = []
+        if s["temp_c"] is not None:
+            parts.append(f"{s['temp_c']:.1f}℃")
+        if s["freq_ratio"] is not None:
+            parts.append(f"freq {s['freq_ratio'] * 100:.0f}%")
+        if s["load_per_cpu"] is not None:
+            parts.append(f"load/cpu {s['load_per_cpu']:.2f}")
+        if latency_s is not None:
+            parts.append(f"生成 {latency_s:.1f}s")
+        return " ".join(parts)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _loop(self) -> None:
+        while not self._stopped.wait(self.interval_s):
+            try:
+                self.step()
+            except Exception as e:
+                print(f"\n[thermal] {e}", flush=True)
+
+    def snapshot(self, now: Optional[float] = None) -> dict:
+        now = time.monotonic() if now is None else now
+        time_in = dict(self._time_in)
+        if self._t_level is not None:
+            name = self.profile["name"]
+            time_in[name] = time_in.get(name, 0.0) + (now - self._t_level)
+        return {
+            "profile": self.profile["name"],
+            "switches": self.switches,
+            "last": {k: round(v, 3) if isinstance(v, float) else v for k, v in self.last.items()},
+            "time_in_s": {k: round(v, 1) for k, v in time_in.items()},
+        }
@@ -0,0 +1,152 @@
+# thermal_sim.py
+"""
+thermal.py の制御を、合成センサファイルと簡単な発熱・throttle のモデルで動かす（Pi でなくても試せる）。
+
+各ステップで「今のプロファイルでの発熱 → 温度 → 周波数 → tokens/s → セッションの生成時間」を計算し、
+/sys/class/thermal/... と同じ構成のファイルを --root に書いてから ThermalController.step() を呼ぶ。
+制御なし（normal 固定）と並べて、目標超えのセッションの割合・最高温度・切り替え回数を比べる。
+
+例:
+  python thermal_sim.py
+  python thermal_sim.py --hours 4 --peak-ambient 38 --print-every 60
+  python thermal_sim.py --root /tmp/sensors   # 最後の状態のファイルが残る（SLM_SENSOR_ROOT=/tmp/sensors で本体にも読ませられる）
+"""
+import argparse
+import math
+import os
+import random
+import tempfile
+
+import thermal
+from config import SESSION_LATENCY_TARGET_S, THERMAL_INTERVAL_S, THERMAL_PROFILES
+
+MAX_FREQ_KHZ = 2_400_000
+CPUS = 4
+
+
+class SimMetrics:
+    """
+    MetricsSink の代わり（thermal が使う3つだけ）
+    """
+
+    def __init__(self):
+        self.finished = 0
+        self.tps = None
+        self.totals = {}
+
+    def recent_tokens_per_s(self, n: int = 5):
+        return self.tps
+
+    def recent_total_ms(self, n: int = 5):
+        return dict(self.totals)
+
+
+class Plant:
+    """
+    Pi 5 + llama.cpp のおおまかなモデル。数字は形を見るためのもので実機の値ではない
+    """
+
+    def __init__(self, ambient: float, rng: random.Random):
+        self.temp = ambient + 25.0
+        self.rng = rng
+
+    def step(self, profile: dict, ambient: float, base_tps: float) -> dict:
+        pregen = profile["pregen"]
+        threads = profile["threads"]
+        # 発熱: 本番の生成 + 先行生成・作り置き。スレッドを減らす・出力を短くする・小さいモデルで下がる
+        heat = 0.5 * profile["max_tokens_scale"] * (0.8 if threads else 1.0) * (0.6 if profile["small_model"] else 1.0)
+        heat += 0.35 if pregen else 0.0
+        target = ambient + 60.0 * heat
+        self.temp += (target - self.temp) * 0.08 + self.rng.uniform(-0.3, 0.3)
+        ratio = 1.0 if self.temp < 80.0 else max(0.6, 1.0 - (self.temp - 80.0) * 0.06)
+        tps = base_tps * ratio * (0.75 if pregen else 1.0) * (0.85 if threads else 1.0) * (1.8 if profile["small_model"] else 1.0)
+        tokens = 110.0 * profile["max_tokens_scale"]
+        latency_s = tokens / tps + 1.2   # + 3ステージ分の prefill
+        load = 1.0 + (1.5 if pregen else 0.0) + (0.0 if threads else 0.5)
+        return {"temp": self.temp, "freq_khz": int(MAX_FREQ_KHZ * ratio), "tps": tps, "latency_s": latency_s, "load": load}
+
+
+def write_sensors(root: str, temp_c: float, freq_khz: int, load: float) -> None:
+    files = {
+        thermal.TEMP_PATH: f"{int(temp_c * 1000)}\n",
+        thermal.FREQ_PATH: f"{freq_khz}\n",
+        thermal.MAX_FREQ_PATH: f"{MAX_FREQ_KHZ}\n",
+        thermal.LOADAVG_PATH: f"{load:.2f} {load:.2f} {load:.2f} 1/200 12345\n",
+        thermal.CPU_ONLINE_PATH: f"0-{CPUS - 1}\n",
+    }
+    for rel, body in files.items():
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(body)
+        os.replace(tmp, path)
+
+
+def run(root: str, args, control: bool) -> dict:
+    rng = random.Random(args.seed)
+    metrics = SimMetrics()
+    current = {"profile": THERMAL_PROFILES[0]}
+    ctl = thermal.ThermalController(metrics, lambda p: current.update(profile=p), thermal.SensorReader(root))
+    plant = Plant(args.base_ambient, rng)
+    steps = int(args.hours * 3600 / THERMAL_INTERVAL_S)
+    over = sessions = 0
+    max_temp = 0.0
+    for i in range(steps):
+        now = i * THERMAL_INTERVAL_S
+        # 昼に向けて室温が上がって下がる
+        ambient = args.base_ambient + (args.peak_ambient - args.base_ambient) * math.sin(math.pi * i / steps)
+        st = plant.step(current["profile"], ambient, args.base_tps)
+        max_temp = max(max_temp, st["temp"])
+        write_sensors(root, st["temp"], st["freq_khz"], st["load"])
+        if i % args.session_every == 0:
+            sessions += 1
+            over += int(st["latency_s"] > SESSION_LATENCY_TARGET_S)
+            metrics.finished += 3
+            metrics.tps = st["tps"]
+            metrics.totals = {s: st["latency_s"] * 1000.0 / 3 for s in ("stage0", "stage1", "stage2")}
+        if control:
+            before = ctl.level
+            ctl.step(now)
+            if args.print_every and (i % args.print_every == 0 or ctl.level != before):
+                print(
+                    f"{now / 60:>7.1f}min ambient={ambient:>4.1f} temp={st['temp']:>5.1f} "
+                    f"freq={st['freq_khz'] / MAX_FREQ_KHZ * 100:>3.0f}% tps={st['tps']:>5.1f} "
+                    f"session={st['latency_s']:>5.1f}s profile={ctl.profile['name']}"
+                )
+    snap = ctl.snapshot(steps * THERMAL_INTERVAL_S) if control else {}
+    return {
+        "sessions": sessions,
+        "over_target": round(over / max(1, sessions), 3),
+        "max_temp": round(max_temp, 1),
+        "switches": snap.get("switches", 0),
+        "time_in_min": {k: round(v / 60, 1) for k, v in snap.get("time_in_s", {}).items()},
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--root", help="合成センサファイルを書くディレクトリ（省略時は一時ディレクトリ）")
+    p.add_argument("--hours", type=float, default=8.0)
+    p.add_argument("--base-ambient", type=float, default=22.0)
+    p.add_argument("--peak-ambient", type=float, default=34.0)
+    p.add_argument("--base-tps", type=float, default=24.0, help="冷えているときの tokens/s")
+    p.add_argument("--session-every", type=int, default=6, help="このステップ数ごとに1セッション")
+    p.add_argument("--print-every", type=int, default=120, help="このステップ数ごとと切り替え時に1行（0 で切り替え時だけ）")
+    p.add_argument("--seed", type=int, default=0)
+    args = p.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="slm_sensors_")
+    print(f"[sim] sensors: {root}  target={SESSION_LATENCY_TARGET_S}s interval={THERMAL_INTERVAL_S}s")
+    controlled = run(root, args, control=True)
+    baseline = run(root, args, control=False)
+    print(f"\n{'':<10} {'sessions':>8} {'over_target':>12} {'max_temp':>9} {'switches':>9}  time_in_min")
+    print(f"{'normal固定':<10} {baseline['sessions']:>8} {baseline['over_target'] * 100:>11.1f}% {baseline['max_temp']:>9.1f} {'-':>9}")
+    print(
+        f"{'制御あり':<10} {controlled['sessions']:>8} {controlled['over_target'] * 100:>11.1f}% {controlled['max_temp']:>9.1f} "
+        f"{controlled['switches']:>9}  {controlled['time_in_min']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# trace_summary.py
+"""
+latency_trace.py が書いたトレースを読み、ステージ別に各区間の分位点（ms）を表示する。
+
+各ステージは pir（stage0）/ button（stage1, stage2）から始まり、
+  trigger→knob → knob→send → send→first（TTFT）→ first→last（生成）→ last→display
+と進む。trigger→display が来訪者の見た待ち時間、display→button は次のステージで考えた時間。
+最大トークン数の再試行で送信が2回ある場合は、最初の send / first_token と最後の last_token を使う。
+
+例:
+  python trace_summary.py
+  python trace_summary.py --path var/latency_trace.bin --last 200
+"""
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+from config import LATENCY_TRACE_PATH
+from latency_trace import read_records
+from max_tokens_predictor import quantile
+
+SPANS = (
+    ("trigger→knob", "trigger", "knob"),
+    ("knob→send", "knob", "send"),
+    ("send→first", "send", "first_token"),
+    ("first→last", "first_token", "last_token"),
+    ("last→display", "last_token", "display"),
+    ("trigger→display", "trigger", "display"),
+)
+_KEEP_LAST = ("last_token",)
+
+
+def collect(path: str) -> Dict[Tuple[int, str], Dict[str, int]]:
+    """
+    (session, stage) → {event: t_ns}
+    """
+    out: Dict[Tuple[int, str], Dict[str, int]] = {}
+    for sid, stage, event, t_ns in read_records(path):
+        if event == "open" or not stage:
+            continue
+        if event in ("pir", "button"):
+            event = "trigger"
+        ev = out.setdefault((sid, stage), {})
+        if event in _KEEP_LAST or event not in ev:
+            ev[event] = t_ns
+    return out
+
+
+def think_times(rows: Dict[Tuple[int, str], Dict[str, int]]) -> List[float]:
+    """
+    表示 → 次のボタンまで（来訪者が読んで押すまで）
+    """
+    out = []
+    for (sid, stage), ev in rows.items():
+        nxt = {"stage0": "stage1", "stage1": "stage2"}.get(stage)
+        if nxt is None or "display" not in ev:
+            continue
+        b = rows.get((sid, nxt), {}).get("trigger")
+        if b is not None and b >= ev["display"]:
+            out.append((b - ev["display"]) / 1e6)
+    return out
+
+
+def _fmt(v: Optional[float]) -> str:
+    return f"{v:.1f}" if v is not None else "-"
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--path", default=LATENCY_TRACE_PATH)
+    p.add_argument("--last", type=int, default=0, help="直近 N セッションだけ集計（0 = すべて）")
+    args = p.parse_args()
+
+    rows = collect(args.path)
+    if args.last > 0:
+        keep = set(sorted({sid for sid, _ in rows})[-args.last:])
+        rows = {k: v for k, v in rows.items() if k[0] in keep}
+    n_sessions = len({sid for sid, _ in rows})
+    print(f"sessions={n_sessions} path={args.path}")
+
+    print(f"\n{'stage':<8} {'span':<16} {'n':>5} {'p50':>7} {'p90':>7} {'p99':>7} {'max':>7}")
+    for stage in sorted({st for _, st in rows}):
+        evs = [ev for (_, st), ev in rows.items() if st == stage]
+        for name, a, b in SPANS:
+            xs = [(ev[b] - ev[a]) / 1e6 for ev in evs if a in ev and b in ev and ev[b] >= ev[a]]
+            if not xs:
+                continue
+            print(
+                f"{stage:<8} {name:<16} {len(xs):>5} {_fmt(quantile(xs, 0.5)):>7} "
+                f"{_fmt(quantile(xs, 0.9)):>7} {_fmt(quantile(xs, 0.99)):>7} {_fmt(max(xs)):>7}"
+            )
+
+    xs = think_times(rows)
+    if xs:
+        print(
+            f"{'-':<8} {'display→button':<16} {len(xs):>5} {_fmt(quantile(xs, 0.5)):>7} "
+            f"{_fmt(quantile(xs, 0.9)):>7} {_fmt(quantile(xs, 0.99)):>7} {_fmt(max(xs)):>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
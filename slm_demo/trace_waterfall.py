@@ -0,0 +1,103 @@
+# trace_waterfall.py
+"""
+span_trace.py（クライアント）と proxy/request_trace.py（proxy）が書いた span を trace id でまとめ、
+1セッション分を waterfall で表示する。どの区間（client の接続・proxy の待ち・upstream の接続・
+prefill・生成・中継）に時間が行ったかを見る。
+
+例:
+  python trace_waterfall.py --list            # 最近のセッション（trace id）一覧
+  python trace_waterfall.py                   # 最後のセッション
+  python trace_waterfall.py --trace 3f2a9c0d41b7e655 --width 80
+"""
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+from config import SPAN_TRACE_PATH
+
+PROXY_SPAN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "proxy", "var", "spans.jsonl")
+
+
+def read_spans(paths: List[str]) -> Dict[str, List[dict]]:
+    """
+    trace id → span の list（書きかけの行・壊れた行は飛ばす）
+    """
+    out: Dict[str, List[dict]] = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                if span.get("trace"):
+                    out.setdefault(span["trace"], []).append(span)
+    return out
+
+
+def render(spans: List[dict], width: int) -> List[str]:
+    # 同じ呼び出し（req）の span をまとめ、呼び出しの開始順 → 各呼び出しの中は開始順に並べる
+    spans = sorted(spans, key=lambda s: s["start"])
+    t0 = spans[0]["start"]
+    t1 = max(s["start"] + s["ms"] / 1000.0 for s in spans)
+    total_ms = max(1e-3, (t1 - t0) * 1000.0)
+    first_of = {}
+    for s in spans:
+        first_of.setdefault(s.get("req"), s["start"])
+    spans.sort(key=lambda s: (first_of[s.get("req")], s.get("req") or "", s["start"]))
+
+    lines = [f"{'stage':<12} {'req':>4} {'name':<16} {'start':>8} {'ms':>8}  waterfall（全体 {total_ms:.0f} ms）"]
+    last_req = None
+    for s in spans:
+        req = s.get("req")
+        if req != last_req and last_req is not None:
+            lines.append("")
+        last_req = req
+        off_ms = (s["start"] - t0) * 1000.0
+        a = int(off_ms / total_ms * width)
+        n = max(1, int(round(s["ms"] / total_ms * width)))
+        bar = " " * a + ("█" if s["proc"] == "client" else "▒") * min(n, width - a)
+        seq = req.rsplit(".", 1)[-1] if req else "-"
+        lines.append(f"{s.get('stage') or '':<12} {seq:>4} {s['name']:<16} {off_ms:>8.1f} {s['ms']:>8.1f}  |{bar:<{width}}|")
+    return lines
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--trace", help="trace id（省略時は最後のセッション）")
+    p.add_argument("--list", action="store_true", help="trace id と開始時刻・span 数を一覧する")
+    p.add_argument("--last", type=int, default=20, help="--list で出す件数")
+    p.add_argument("--client-path", default=SPAN_TRACE_PATH)
+    p.add_argument("--proxy-path", default=PROXY_SPAN_PATH)
+    p.add_argument("--width", type=int, default=60)
+    args = p.parse_args()
+
+    traces = read_spans([args.client_path, args.proxy_path])
+    if not traces:
+        print("span がありません（config.SPAN_TRACE と proxy の --trace / --trace-path を確認）")
+        return
+    by_start = sorted(traces, key=lambda t: min(s["start"] for s in traces[t]))
+
+    if args.list:
+        for t in by_start[-args.last:]:
+            spans = traces[t]
+            start = min(s["start"] for s in spans)
+            procs = sorted({s["proc"] for s in spans})
+            print(f"{t}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))}  spans={len(spans):>3}  {','.join(procs)}")
+        return
+
+    trace = args.trace or by_start[-1]
+    if trace not in traces:
+        print(f"trace {trace} が見つかりません")
+        return
+    print(f"trace {trace}  (█ client / ▒ proxy)")
+    for line in render(traces[trace], args.width):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# type_ahead.py
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TypeAhead:
+    """
+    Q1/Q2 の生成中に押されたボタンを先取りし、表示中の生成を打ち切る合図にする。
+
+    - 入力層のスレッド（gpiozero のコールバック / 端末の読み取りスレッド）から press() を呼ぶ
+    - 受け付けるのは open() から close() までの間の最初の1回だけ（2回目以降は無視）
+    - 生成側は arm() で「押されたらセットする Event」（llm_client の cancel、LatencyGuard の待ちなど）を登録する。
+      すでに押されていれば即セットされる。受け付けていない間（THANKS など）の arm() は何もしない
+    - close() で先取りした番号は返して消す（次の生成を打ち切らない）。t_press は read_answer のトレース用に次の open() まで残す
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = False
+        self._events = []
+        self.choice: Optional[str] = None
+        # 押された時刻（time.perf_counter()。トレースの button に使う）
+        self.t_press: Optional[float] = None
+        self.stats: Dict[str, dict] = {}
+
+    def open(self) -> None:
+        with self._lock:
+            self._open = True
+            self._events = []
+            self.choice = None
+            self.t_press = None
+
+    def close(self) -> Optional[str]:
+        """
+        受け付けを閉じて、先取りした番号（なければ None）を返す
+        """
+        with self._lock:
+            self._open = False
+            self._events = []
+            choice, self.choice = self.choice, None
+            return choice
+
+    def press(self, choice: str) -> bool:
+        with self._lock:
+            if not self._open or self.choice is not None:
+                return False
+            self.choice = choice
+            self.t_press = time.perf_counter()
+            events = list(self._events)
+        for ev in events:
+            ev.set()
+        return True
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    @property
+    def pressed(self) -> Optional[str]:
+        return self.choice
+
+    def arm(self, *events: threading.Event) -> None:
+        with self._lock:
+            if not self._open:
+                return
+            if self.choice is None:
+                self._events.extend(events)
+                return
+        for ev in events:
+            ev.set()
+
+    def record(self, stage: str, tokens: Optional[int], saved_ms: Optional[float]) -> None:
+        """
+        打ち切った生成を数える。saved_ms は「いつもの完了時間 − 押されるまでの時間」の見積もり
+        """
+        with self._lock:
+            st = self.stats.setdefault(stage, {"n": 0, "tokens": 0, "saved_ms_est": 0.0})
+            st["n"] += 1
+            st["tokens"] += tokens or 0
+            st["saved_ms_est"] += max(0.0, saved_ms or 0.0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                stage: {
+                    "n": st["n"],
+                    "avg_tokens_before_press": round(st["tokens"] / st["n"], 1),
+                    "saved_ms_avg_est": round(st["saved_ms_est"] / st["n"], 1),
+                }
+                for stage, st in sorted(self.stats.items())
+            }